@@ -0,0 +1,101 @@
+"""
+Benchmark comparing the data transferred from the Knowledge Graph, and the time taken,
+to obtain a page of filtered computation records, with and without pushing the filters
+down into the KG query.
+
+Without pushdown, the records are retrieved page by page and filtered in the API
+until the requested number of matching records have been found.
+The KG is simulated in memory, with a fixed latency per request
+plus a transfer time proportional to the size of the response.
+
+Usage:
+
+    $ python benchmarks/filter_pushdown.py [number of records] [fraction matching] [page size]
+"""
+
+import asyncio
+import json
+from datetime import datetime
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(".")  # run in root directory of project
+from provenance.common.filters import QueryFilters, list_computations
+
+
+LATENCY = 0.02  # seconds per request
+BANDWIDTH = 20e6  # bytes per second
+
+
+class InMemoryKG:
+    """Stands in for an AsyncKGClient"""
+
+    def __init__(self, records):
+        self.records = records
+        self.bytes_transferred = 0
+        self.requests = 0
+
+    async def list(self, cls, scope, api, space, size, from_index, **filters):
+        matches = [
+            record for record in self.records
+            if all(getattr(record, name).uuid == value.uuid for name, value in filters.items())
+        ]
+        page = matches[from_index:from_index + size]
+        n_bytes = sum(len(record.json) for record in page)
+        self.requests += 1
+        self.bytes_transferred += n_bytes
+        await asyncio.sleep(LATENCY + n_bytes / BANDWIDTH)
+        return page
+
+
+def make_records(n_records, fraction_matching):
+    period = round(1 / fraction_matching)
+    records = []
+    for i in range(n_records):
+        environment = SimpleNamespace(uuid="target-env" if i % period == 0 else f"env-{i % 17}")
+        data = {
+            "@id": f"https://kg.ebrains.eu/api/instances/{i:08d}",
+            "environment": environment.uuid,
+            "inputs": [f"https://kg.ebrains.eu/api/instances/file-{j}" for j in range(10)],
+            "description": "x" * 500
+        }
+        records.append(SimpleNamespace(uuid=str(i), environment=environment, json=json.dumps(data),
+                                       start_time=datetime.fromtimestamp(1640995200 + i), end_time=None))
+    return records
+
+
+async def without_pushdown(kg, environment, size):
+    matching = []
+    from_index = 0
+    while len(matching) < size:
+        page = await kg.list(None, scope="any", api="query", space=None, size=size, from_index=from_index)
+        matching.extend(record for record in page if record.environment.uuid == environment.uuid)
+        if len(page) < size:
+            break
+        from_index += size
+    return matching[:size]
+
+
+async def with_pushdown(kg, environment, size):
+    filters = QueryFilters()
+    filters.require("environment", environment)
+    return await list_computations(kg, None, filters.compile(), size=size)
+
+
+def main(n_records=20000, fraction_matching=0.02, size=100):
+    records = make_records(n_records, fraction_matching)
+    environment = SimpleNamespace(uuid="target-env")
+    print(f"{n_records} records, {fraction_matching:.1%} matching, page size {size}")
+    for label, query in (("without pushdown:", without_pushdown), ("with pushdown:   ", with_pushdown)):
+        kg = InMemoryKG(records)
+        start = time.perf_counter()
+        results = asyncio.run(query(kg, environment, size))
+        elapsed = time.perf_counter() - start
+        print(f"{label} {len(results)} records, {kg.requests} KG requests, "
+              f"{kg.bytes_transferred / 1e6:.2f} MB, {elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    converters = (int, float, int)
+    main(*[convert(arg) for convert, arg in zip(converters, sys.argv[1:])])
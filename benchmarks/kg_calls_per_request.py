@@ -0,0 +1,167 @@
+"""
+Count the KG requests needed to convert one page of simulation records
+into API data models: resolving references one at a time, with the
+per-request identity map, with bulk prefetching of references,
+and for a repeat request, when the shared sub-model cache is warm.
+
+The records share a handful of people and computing environments,
+as is typical for the results of `GET /simulations/`.
+
+Usage:
+
+    $ python benchmarks/kg_calls_per_request.py [number of records]
+"""
+
+import sys
+from copy import deepcopy
+from types import SimpleNamespace
+from datetime import datetime, timezone
+from uuid import uuid4
+import json
+
+from fairgraph.base import KGProxy, KGObject, IRI
+import fairgraph.openminds.core as omcore
+import fairgraph.openminds.computation as omcmp
+
+sys.path.append(".")  # run in root directory of project
+from provenance.common.kg_client import KGIdentityMap
+from provenance.common.data_models import (
+    ACTION_STATUS_TYPES, UNITS, CONTENT_TYPES, HARDWARE_SYSTEMS, Units, SUBMODEL_CACHE
+)
+from provenance.simulation.data_models import Simulation
+
+
+ID_PREFIX = "https://kg.ebrains.eu/api/instances"
+
+
+class FakeKGClient:
+    """Serves JSON-LD documents from memory, counting each request"""
+
+    def __init__(self):
+        self.documents = {}
+        self.requests = 0
+        self._kg_client = SimpleNamespace(instances=SimpleNamespace(get_by_ids=self._get_by_ids))
+
+    def add(self, obj):
+        if obj.id is None:
+            obj.id = f"{ID_PREFIX}/{uuid4()}"
+        data = obj._build_data(self)
+        data.update({"@id": obj.id, "@type": obj.type, "@context": obj.context,
+                     "http://schema.org/identifier": [obj.id]})
+        self.documents[obj.id] = data
+        return KGProxy(obj.__class__, obj.id)
+
+    def instance_from_full_uri(self, uri, use_cache=True, scope="released", resolved=False):
+        self.requests += 1
+        return deepcopy(self.documents.get(uri))
+
+    def _get_by_ids(self, payload, stage, extended_response_configuration):
+        self.requests += 1
+        return SimpleNamespace(
+            data={
+                uuid: SimpleNamespace(data=deepcopy(self.documents.get(self.uri_from_uuid(uuid))))
+                for uuid in payload
+            }
+        )
+
+    def _check_response(self, response, **kwargs):
+        return response
+
+    def uri_from_uuid(self, uuid):
+        return f"{ID_PREFIX}/{uuid}"
+
+    def uuid_from_uri(self, uri):
+        return uri.split("/")[-1]
+
+
+def build_page(client, n_records):
+    status = client.add(ACTION_STATUS_TYPES["completed"])
+    core_hour = client.add(UNITS[Units("core-hour")])
+    byte = client.add(UNITS[Units("byte")])
+    content_type = client.add(next(iter(CONTENT_TYPES.values())))
+    hardware = client.add(next(iter(HARDWARE_SYSTEMS.values())))
+    people = [
+        client.add(omcore.Person(given_name=f"Given{i}", family_name=f"Family{i}"))
+        for i in range(3)
+    ]
+    software = [
+        client.add(omcore.SoftwareVersion(name=name, alias=name, version_identifier="1.0"))
+        for name in ("NEST", "NEURON", "numpy", "neo")
+    ]
+    environments = [
+        client.add(
+            omcmp.Environment(
+                name=f"environment {i}",
+                hardware=hardware,
+                configuration=client.add(
+                    omcore.Configuration(configuration=json.dumps({"i": i}), format=content_type)
+                ),
+                software=software[i::2]
+            )
+        )
+        for i in range(2)
+    ]
+    launch_config = client.add(omcmp.LaunchConfiguration(executable="/usr/bin/python"))
+    records = []
+    for i in range(n_records):
+        outputs = [
+            client.add(
+                omcore.File(
+                    name=f"output{j}.nwb",
+                    iri=IRI(f"https://data-proxy.ebrains.eu/api/v1/buckets/bench/run{i}/output{j}.nwb"),
+                    format=content_type,
+                    storage_size=omcore.QuantitativeValue(value=1000.0, unit=byte)
+                )
+            )
+            for j in range(5)
+        ]
+        records.append(
+            omcmp.Simulation(
+                id=f"{ID_PREFIX}/{uuid4()}",
+                space="myspace",
+                lookup_label=f"benchmark simulation {i}",
+                inputs=software[:1],
+                outputs=outputs,
+                environment=environments[i % 2],
+                launch_configuration=launch_config,
+                start_time=datetime(2022, 1, 1, tzinfo=timezone.utc),
+                started_by=people[i % 3],
+                status=status,
+                resource_usages=[omcore.QuantitativeValue(value=1.5, unit=core_hour)],
+            )
+        )
+    return records
+
+
+def count_requests(fake_client, records, use_identity_map, prefetch=False, warm_cache=False):
+    KGObject.object_cache.clear()
+    if not warm_cache:
+        SUBMODEL_CACHE.clear()
+    fake_client.requests = 0
+    if use_identity_map:
+        client = KGIdentityMap(fake_client)
+    else:
+        client = fake_client
+    if prefetch:
+        client.prefetch(records)
+    for record in records:
+        Simulation.from_kg_object(record, client)
+    return fake_client.requests
+
+
+def main(n_records=100):
+    client = FakeKGClient()
+    records = build_page(client, n_records)
+    before = count_requests(client, records, use_identity_map=False)
+    after = count_requests(client, records, use_identity_map=True)
+    bulk = count_requests(client, records, use_identity_map=True, prefetch=True)
+    warm = count_requests(client, records, use_identity_map=True, prefetch=True, warm_cache=True)
+    print(f"Converting {n_records} simulation records")
+    print(f"KG calls per request without identity map: {before}")
+    print(f"KG calls per request with identity map:    {after}")
+    print(f"KG calls per request with bulk prefetch:   {bulk}")
+    print(f"KG calls per repeat request (warm cache):  {warm}")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
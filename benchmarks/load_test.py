@@ -0,0 +1,95 @@
+"""
+Load test comparing the throughput of a sync endpoint, run in FastAPI's thread pool,
+with an async endpoint using the async KG access layer, when each KG call is slow.
+
+Both endpoints retrieve and convert an (unreleased) record, which takes three KG calls.
+The requests, from 50 different users, are made concurrently, in-process, through the ASGI interface.
+
+Usage:
+
+    $ python benchmarks/load_test.py [number of concurrent requests] [KG latency in ms]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+import httpx
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+sys.path.append(".")  # run in root directory of project
+from provenance.common import utils as common_utils
+from provenance.common.kg_client import AsyncKGClient, KGIdentityMap
+
+
+class SlowKGClient:
+    """Stands in for a KGClient, with a fixed latency for each request"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+
+class FakeRecordType:
+
+    @classmethod
+    def from_uuid(cls, uuid, client, scope):
+        time.sleep(client.latency)
+        if scope == "released":
+            return None
+        return SimpleNamespace(data={}, space="myspace")
+
+
+class Record(BaseModel):
+    id: str
+
+    @classmethod
+    def from_kg_object(cls, kg_object, client):
+        time.sleep(client.latency)  # resolving references
+        return cls(id="record")
+
+
+def build_app(latency):
+    common_utils.get_async_kg_client_for_user_account = (
+        lambda token: AsyncKGClient(KGIdentityMap(SlowKGClient(latency)), user=token)
+    )
+    app = FastAPI()
+
+    @app.get("/sync/records/{record_id}")
+    def get_record_sync(record_id: str):
+        # the previous implementation of retrieve_computation()
+        kg_client = KGIdentityMap(SlowKGClient(latency))
+        FakeRecordType.from_uuid(record_id, kg_client, scope="released")
+        kg_object = FakeRecordType.from_uuid(record_id, kg_client, scope="any")
+        return Record.from_kg_object(kg_object, kg_client)
+
+    @app.get("/async/records/{record_id}")
+    async def get_record_async(record_id: str):
+        return await common_utils.retrieve_computation(
+            Record, FakeRecordType, "record", record_id,
+            SimpleNamespace(credentials=f"user{int(record_id) % 50}")
+        )
+
+    return app
+
+
+async def run_load(app, path, n_requests):
+    async with httpx.AsyncClient(app=app, base_url="http://test", timeout=None) as client:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[client.get(f"{path}/{i}") for i in range(n_requests)])
+        elapsed = time.perf_counter() - start
+    assert all(response.status_code == 200 for response in responses)
+    return n_requests / elapsed
+
+
+def main(n_requests=400, latency_ms=50):
+    app = build_app(latency_ms / 1000)
+    print(f"{n_requests} concurrent requests, KG latency {latency_ms} ms")
+    for label, path in (("sync endpoint: ", "/sync/records"), ("async endpoint:", "/async/records")):
+        throughput = asyncio.run(run_load(app, path, n_requests))
+        print(f"{label} {throughput:.0f} requests/s")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
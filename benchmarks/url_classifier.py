@@ -0,0 +1,103 @@
+"""
+Micro-benchmark of file URL classification (repository host, IRI, name and type),
+comparing the compiled classifier in provenance.common.repositories with
+the previous approach of scanning the rules one by one for each of the four properties.
+
+Usage:
+
+    $ python benchmarks/url_classifier.py [number of URLs]
+"""
+
+import re
+import sys
+import timeit
+
+sys.path.append(".")  # run in root directory of project
+from provenance.common.repositories import classify_url, HOST_PREFIXES, REPOSITORY_TYPE_PREFIXES
+
+
+# --- previous implementation, for comparison ---
+
+CSCS_pattern = r"https://object\.cscs\.ch/v1/(?P<proj>\w+)/(?P<container_name>[\w\.-]+)/(?P<path>\S*)"
+GPFS_proxy_pattern = r"https://gpfs-proxy\.brainsimulation\.eu/(?P<site>\w+)/(?P<project_name>[\w-]+)/(?P<path>\S*)"
+EBRAINS_Gitlab_pattern = r"https://gitlab\.ebrains\.eu/(?P<org>[\w-]+)/(?P<project_name>[/\w-]+)/-/"
+EBRAINS_Gitlab_pattern2 = r"https://gitlab\.ebrains\.eu/(?P<org>[\w-]+)/(?P<project_name>[/\w-]+)"
+EBRAINS_data_proxy_pattern = r"https://data-proxy\.ebrains\.eu/api/v1/buckets/(?P<bucket_name>[\w-]+)/[/\w\.-]+"
+
+
+def legacy_host(url):
+    for fragment, org in HOST_PREFIXES.items():
+        if fragment in url:
+            return org
+    return None
+
+
+def legacy_iri(url):
+    templates = (
+        (CSCS_pattern, "https://object.cscs.ch/v1/{proj}/{container_name}"),
+        (GPFS_proxy_pattern, "https://gpfs-proxy.brainsimulation.eu/{site}/{project_name}"),
+        (EBRAINS_Gitlab_pattern, "https://gitlab.ebrains.eu/{org}/{project_name}"),
+        (EBRAINS_Gitlab_pattern2, "https://gitlab.ebrains.eu/{org}/{project_name}"),
+        (EBRAINS_data_proxy_pattern, "https://data-proxy.ebrains.eu/api/v1/buckets/{bucket_name}"),
+    )
+    for pattern, template in templates:
+        match = re.match(pattern, url)
+        if match:
+            return template.format(**match.groupdict())
+    if url.startswith("https://drive.ebrains.eu"):
+        return "https://drive.ebrains.eu"
+
+
+def legacy_name(url):
+    templates = (
+        (CSCS_pattern, "container_name"),
+        (GPFS_proxy_pattern, "project_name"),
+        (EBRAINS_Gitlab_pattern, "project_name"),
+        (EBRAINS_Gitlab_pattern2, "project_name"),
+        (EBRAINS_data_proxy_pattern, "bucket_name"),
+    )
+    for pattern, key in templates:
+        match = re.match(pattern, url)
+        if match:
+            return match[key]
+    if url.startswith("https://drive.ebrains.eu"):
+        return "EBRAINS Drive"
+
+
+def legacy_type(url):
+    for prefix, repository_type in REPOSITORY_TYPE_PREFIXES.items():
+        if url.startswith(prefix):
+            return repository_type
+
+
+def legacy_classify(url):
+    return (legacy_host(url), legacy_iri(url), legacy_name(url), legacy_type(url))
+
+
+# --- benchmark ---
+
+def build_urls(n_urls):
+    # typical workflow outputs: many files in a small number of buckets/containers
+    templates = (
+        "https://data-proxy.ebrains.eu/api/v1/buckets/my-collab/run{i}/output{i}.nwb",
+        "https://object.cscs.ch/v1/AUTH_c0a333ecf7c045809321ce9d9ecdfdea/simulation_results/run{i}/spikes.h5",
+        "https://gpfs-proxy.brainsimulation.eu/cscs/myproject/output_data/result{i}.nwb",
+        "https://drive.ebrains.eu/lib/0fee1620-062d-4643-865b-951de1eee355/file/figure{i}.png",
+    )
+    return [templates[i % len(templates)].format(i=i) for i in range(n_urls)]
+
+
+def main(n_urls=10000):
+    urls = build_urls(n_urls)
+    for url in urls[:100]:
+        assert tuple(classify_url(url)) == legacy_classify(url), url
+    legacy = min(timeit.repeat(lambda: [legacy_classify(url) for url in urls], number=1, repeat=5))
+    compiled = min(timeit.repeat(lambda: [classify_url(url) for url in urls], number=1, repeat=5))
+    print(f"Classifying {n_urls} file URLs")
+    print(f"previous implementation: {legacy * 1e6 / n_urls:.2f} µs per URL")
+    print(f"compiled classifier:     {compiled * 1e6 / n_urls:.2f} µs per URL")
+    print(f"speed-up: {legacy / compiled:.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,100 @@
+"""
+Shared HTTP client for requests to the EBRAINS IAM and Collaboratory services
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import asyncio
+import logging
+
+import httpx
+
+from ..common.metrics import register_metrics
+from .. import settings
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# The client keeps a pool of open connections, which belong to the event loop
+# in which they were created, so we keep one client per event loop
+# (in production there is a single loop per worker).
+_client = None
+_client_loop = None
+
+counts = {"requests": 0, "retries": 0, "failures": 0}
+register_metrics("auth_http", lambda: dict(counts))
+
+
+def _create_client():
+    return httpx.AsyncClient(
+        timeout=settings.AUTH_HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+    )
+
+
+def get_client():
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop or _client.is_closed:
+        _client = _create_client()
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client = _client_loop = None
+
+
+async def get(url, headers=None, retries=None, backoff=None):
+    """
+    Make a GET request, retrying with exponential backoff
+    if the connection fails or the service is temporarily unavailable.
+    """
+    if retries is None:
+        retries = settings.AUTH_HTTP_RETRIES
+    if backoff is None:
+        backoff = settings.AUTH_HTTP_BACKOFF
+    client = get_client()
+    for attempt in range(retries + 1):
+        counts["requests"] += 1
+        try:
+            response = await client.get(url, headers=headers)
+        except httpx.TransportError as err:
+            if attempt == retries:
+                counts["failures"] += 1
+                raise
+            logger.warning(f"Request to {url} failed ({err!r}), retrying")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if attempt == retries:
+                counts["failures"] += 1
+                return response
+            logger.warning(f"Request to {url} returned status {response.status_code}, retrying")
+        counts["retries"] += 1
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def get_json(url, **kwargs):
+    response = await get(url, **kwargs)
+    response.raise_for_status()
+    return response.json()
@@ -29,7 +29,7 @@ auth = HTTPBearer()
 
 
 @router.get("/")
-def about_this_api():
+async def about_this_api():
     return {
         "about": "This is the EBRAINS Provenance API.",
         "links": {
@@ -0,0 +1,139 @@
+"""
+Local validation of EBRAINS IAM access tokens,
+using the signing keys published by the identity provider.
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import time
+
+from authlib.jose import JsonWebToken, JsonWebKey
+from authlib.jose.errors import JoseError
+
+from .. import settings
+from . import http_client
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+jwt = JsonWebToken(["RS256", "RS384", "RS512"])
+
+LEEWAY = 10  # seconds of clock skew allowed when checking token expiry
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class JWKSCache:
+    """
+    Signing keys of the identity provider, retrieved from the JWKS endpoint
+    given in its OpenID configuration.
+
+    The keys are refreshed every `ttl` seconds, or sooner if we see a token signed
+    with a key we don't know (i.e. the provider has rotated its keys),
+    but at most once every `min_refresh_interval` seconds.
+    """
+
+    def __init__(self, conf_url, ttl=3600, min_refresh_interval=60, fetch_json=http_client.get_json):
+        self.conf_url = conf_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._fetch_json = fetch_json
+        self.issuer = None
+        self._keys = None
+        self._key_ids = set()
+        self._fetched_at = None
+        self._lock = None
+        self.refresh_count = 0
+
+    async def refresh(self):
+        conf = await self._fetch_json(self.conf_url)
+        jwks = await self._fetch_json(conf["jwks_uri"])
+        self._keys = JsonWebKey.import_key_set(jwks)
+        self._key_ids = {key.get("kid") for key in jwks["keys"]}
+        self.issuer = conf.get("issuer")
+        self._fetched_at = time.monotonic()
+        self.refresh_count += 1
+        logger.info(f"Retrieved {len(self._key_ids)} token signing keys from {conf['jwks_uri']}")
+
+    def _needs_refresh(self, kid):
+        if self._fetched_at is None:
+            return True
+        age = time.monotonic() - self._fetched_at
+        if age > self.ttl:
+            return True
+        return kid is not None and kid not in self._key_ids and age > self.min_refresh_interval
+
+    async def get_keys(self, kid=None):
+        if self._needs_refresh(kid):
+            if self._lock is None:
+                # created here rather than in __init__, so it belongs to the running event loop
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                # another request may have refreshed the keys while we were waiting
+                if self._needs_refresh(kid):
+                    await self.refresh()
+        return self._keys
+
+
+iam_keys = JWKSCache(settings.EBRAINS_IAM_CONF_URL, ttl=settings.JWKS_CACHE_TTL)
+
+
+def _decode_segment(segment):
+    return json.loads(base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4)))
+
+
+async def decode_token(token, keys=iam_keys):
+    """
+    Check the signature, issuer and expiry of an access token, and return its claims.
+
+    Raises InvalidToken if the token is not valid.
+    """
+    try:
+        header = _decode_segment(token.split(".")[0])
+    except (ValueError, TypeError):
+        raise InvalidToken("Malformed token")
+    if not isinstance(header, dict):
+        raise InvalidToken("Malformed token")
+    key_set = await keys.get_keys(header.get("kid"))
+    claims_options = {"exp": {"essential": True}}
+    if keys.issuer:
+        claims_options["iss"] = {"essential": True, "value": keys.issuer}
+    try:
+        claims = jwt.decode(token, key_set, claims_options=claims_options)
+        claims.validate(leeway=LEEWAY)
+    except (JoseError, ValueError) as err:
+        raise InvalidToken(str(err))
+    return dict(claims)
+
+
+def user_info_from_claims(claims):
+    """
+    Return user information in the same format as the IAM userinfo endpoint,
+    or None if the token does not contain the team and group roles needed for permission checks.
+    """
+    if "team" not in claims.get("roles", {}) or "groups" not in claims:
+        return None
+    user_info = dict(claims)
+    user_info["id"] = user_info["sub"]
+    user_info["username"] = user_info.get("preferred_username", "unknown")
+    return user_info
@@ -5,13 +5,17 @@
 
 import logging
 import json
-import requests
+import httpx
 from fastapi import HTTPException, status
 
 from fairgraph.client import KGClient
 
 from .. import settings
-from . import oauth
+from ..common.kg_client import KGIdentityMap, AsyncKGClient, KGClientPool, token_key, token_ttl, readable_spaces
+from ..common.metrics import register_metrics
+from ..common.cache import AsyncTTLCache
+from . import http_client
+from .tokens import decode_token, user_info_from_claims, InvalidToken
 
 logger = logging.getLogger("ebrains-prov-api")
 
@@ -29,13 +33,52 @@ def get_kg_client_for_service_account():
     return kg_client_for_service_account
 
 
+user_kg_clients = KGClientPool(
+    lambda token: KGClient(token=token, host=settings.KG_CORE_API_HOST),
+    max_clients=settings.KG_CLIENT_POOL_SIZE,
+    ttl=settings.KG_CLIENT_POOL_TTL
+)
+register_metrics("kg_client_pool", user_kg_clients.metrics)
+
+
 def get_kg_client_for_user_account(token):
-    return KGClient(token=token, host=settings.KG_CORE_API_HOST)
+    # the underlying KGClient is reused between requests with the same token,
+    # but we use a new identity map for each request, so each KG instance is retrieved at most once per request
+    return KGIdentityMap(user_kg_clients.get(token), user=token_key(token))
+
+
+def get_async_kg_client_for_user_account(token):
+    return AsyncKGClient(get_kg_client_for_user_account(token), user=token_key(token))
+
+
+# user info, keyed by a hash of the token, and collab permissions, keyed by (token hash, collab id)
+_user_info_cache = AsyncTTLCache(ttl=settings.USER_INFO_CACHE_TTL, max_bytes=settings.AUTH_CACHE_MAX_BYTES)
+_collab_permissions_cache = AsyncTTLCache(ttl=settings.COLLAB_PERMISSIONS_CACHE_TTL,
+                                          max_bytes=settings.AUTH_CACHE_MAX_BYTES)
+register_metrics("user_info_cache", _user_info_cache.metrics)
+register_metrics("collab_permissions_cache", _collab_permissions_cache.metrics)
+
+
+def get_readable_spaces(token, kg_client=None):
+    return readable_spaces(token_key(token), kg_client or get_kg_client_for_user_account(token))
+
+
+def access_key(token, spaces):
+    """
+    Return a key identifying the KG data visible to a user who can read the given spaces,
+    so that results computed for one user can be shared with users who have the same access.
+
+    Each user's private space ("myspace") is their own, so if it is readable the key is specific to the user.
+    """
+    spaces = frozenset(spaces)
+    if "myspace" in spaces:
+        return (token_key(token), spaces)
+    return (None, spaces)
 
 
 async def can_read_space(space, token):
-    user_client = get_kg_client_for_user_account(token=token)
-    return space in user_client.spaces(permissions=["read"], names_only=True)
+    kg = get_async_kg_client_for_user_account(token)
+    return space in await kg.run(get_readable_spaces, token, kg.client)
 
 
 async def get_user_from_token(user_token):
@@ -46,14 +89,43 @@ async def get_user_from_token(user_token):
     :returns: res._content
     :rtype: str
     """
+    return await _user_info_cache.get_or_compute(
+        token_key(user_token),
+        lambda: _get_user_info(user_token),
+        size=lambda user_info: len(json.dumps(user_info)),
+        ttl=lambda user_info: token_ttl(user_token, settings.USER_INFO_CACHE_TTL)
+    )
+
+
+async def _get_user_info(user_token):
+    if settings.LOCAL_TOKEN_VALIDATION:
+        try:
+            claims = await decode_token(user_token)
+        except InvalidToken as err:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid token: {err}"
+            )
+        except (httpx.HTTPError, KeyError, ValueError) as err:
+            # signing keys not available, let the IAM service check the token
+            logger.warning(f"Unable to retrieve token signing keys: {err}")
+        else:
+            user_info = user_info_from_claims(claims)
+            if user_info is not None:
+                return user_info
+            # token is valid but does not contain the roles we need
     # collab v2 only
-    user_info = await oauth.ebrains.user_info(
-        token={"access_token": user_token, "token_type": "bearer"}
+    res = await http_client.get(
+        f"{settings.HBP_IDENTITY_SERVICE_URL_V2}/userinfo",
+        headers={"Authorization": f"Bearer {user_token}"}
     )
-    if "error" in user_info:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, detail=user_info["error_description"]
-        )
+    if res.status_code in (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN):
+        try:
+            detail = res.json()["error_description"]
+        except (ValueError, KeyError):
+            detail = "Invalid token"
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=detail)
+    res.raise_for_status()
+    user_info = res.json()
     user_info["id"] = user_info["sub"]
     user_info["username"] = user_info.get("preferred_username", "unknown")
     return user_info
@@ -62,7 +134,7 @@ async def get_user_from_token(user_token):
 async def get_collab_info(collab_id, user_token):
     collab_info_url = f"{settings.HBP_COLLAB_SERVICE_URL_V2}collabs/{collab_id}"
     headers = {"Authorization": f"Bearer {user_token}"}
-    res = requests.get(collab_info_url, headers=headers)
+    res = await http_client.get(collab_info_url, headers=headers)
     try:
         response = res.json()
     except json.decoder.JSONDecodeError:
@@ -75,7 +147,25 @@ async def get_collab_info(collab_id, user_token):
 async def get_collab_permissions(collab_id, user_token):
     if collab_id.startswith("collab-"):
         collab_id = collab_id[7:]
-    user_info = get_user_from_token(user_token)
+
+    def permissions_ttl(permissions):
+        if permissions["VIEW"]:
+            ttl = settings.COLLAB_PERMISSIONS_CACHE_TTL
+        else:
+            # negative result, the user may be added to the collab at any time
+            ttl = settings.COLLAB_PERMISSIONS_NEGATIVE_CACHE_TTL
+        return token_ttl(user_token, ttl)
+
+    return await _collab_permissions_cache.get_or_compute(
+        (token_key(user_token), collab_id),
+        lambda: _get_collab_permissions(collab_id, user_token),
+        size=lambda permissions: len(collab_id) + 100,
+        ttl=permissions_ttl
+    )
+
+
+async def _get_collab_permissions(collab_id, user_token):
+    user_info = await get_user_from_token(user_token)
     target_team_names = {role: f"collab-{collab_id}-{role}"
                          for role in ("viewer", "editor", "administrator")}
 
@@ -124,7 +214,7 @@ async def is_collab_admin(collab_id, user_token):
 
 
 async def is_global_admin(user_token):
-    user_info = get_user_from_token(user_token)
+    user_info = await get_user_from_token(user_token)
     return f"group-{settings.ADMIN_GROUP_ID}" in user_info["groups"]
 
 
@@ -134,7 +224,6 @@ async def can_view_collab(collab_id, user_token):
     try:
         int(collab_id)
     except ValueError:
-        get_collab_permissions = get_collab_permissions_v2
         permissions = await get_collab_permissions(collab_id, user_token)
         return permissions.get("VIEW", False)
     else:
@@ -143,7 +232,7 @@ async def can_view_collab(collab_id, user_token):
 
 async def get_editable_collabs(user_token):
     # collab v2 only
-    user_info = get_user_from_token(user_token)
+    user_info = await get_user_from_token(user_token)
     editable_collab_ids = set()
     for team_name in user_info["roles"]["team"]:
         if team_name.endswith("-editor") or team_name.endswith("-administrator"):
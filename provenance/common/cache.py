@@ -0,0 +1,219 @@
+"""
+In-process caches shared between requests
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import asyncio
+from collections import OrderedDict
+from functools import partial
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache, in which each entry expires `ttl` seconds after it was added.
+
+    The total size of the entries is limited to `max_bytes`. Since the real memory usage of
+    Python objects is hard to measure, the size of each entry is given by the caller
+    when it is added (for example the length of its JSON serialization).
+    Alternatively, or in addition, the number of entries may be limited to `max_entries`.
+    """
+
+    def __init__(self, ttl, max_bytes=None, max_entries=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key: (expiry time, size, value)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, size, value = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=1, ttl=None):
+        """
+        Add an entry to the cache. `ttl` may be given to override
+        the default time-to-live for this entry.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if (self.max_bytes is not None and size > self.max_bytes) or ttl <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self.total_bytes += size
+            while self._over_limit():
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def _over_limit(self):
+        return (
+            (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        )
+
+    def _remove(self, key):
+        expires, size, value = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+_missing = object()
+
+
+class _Flight:
+    """A computation in progress, and the number of calls waiting for its result"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single in-flight computation and its result
+    (or exception). Nothing is kept once the computation has finished.
+
+    The computation runs in a task of its own, so cancelling one of the calls (for example
+    when a client disconnects) does not affect the others. It is only cancelled if every call
+    waiting for it has been cancelled.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, compute):
+        """Await `compute()`, unless a computation for `key` is already in progress, then await that."""
+        self.calls += 1
+        loop = asyncio.get_running_loop()
+        flight = self._pending.get(key)
+        if flight is not None and flight.task.get_loop() is loop:
+            self.coalesced += 1
+        else:
+            flight = _Flight(loop.create_task(compute()))
+            self._pending[key] = flight
+            flight.task.add_done_callback(partial(self._finished, key, flight))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def _finished(self, key, flight, task):
+        if self._pending.get(key) is flight:
+            del self._pending[key]
+        if not task.cancelled():
+            task.exception()  # avoid warnings if nobody was waiting for the result any more
+
+    def metrics(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._pending),
+        }
+
+
+class AsyncTTLCache(TTLCache):
+    """
+    TTLCache for values computed by coroutines.
+
+    If several tasks ask for the same missing key at the same time,
+    the value is computed only once, and shared between them.
+    Exceptions are passed on to all waiting tasks, but not cached.
+    """
+
+    def __init__(self, ttl, max_bytes):
+        super().__init__(ttl, max_bytes)
+        self._single_flight = SingleFlight()
+
+    async def get_or_compute(self, key, compute, size=None, ttl=None):
+        """
+        Return the cached value for `key`, or else await `compute()` and cache the result.
+
+        `size` and `ttl`, if given, are functions which take the computed value and
+        return the size and time-to-live of the cache entry.
+        """
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        async def compute_and_store():
+            value = await compute()
+            self.put(key, value,
+                     size=size(value) if size else 1,
+                     ttl=ttl(value) if ttl else None)
+            return value
+
+        return await self._single_flight.do(key, compute_and_store)
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics["coalesced"] = self._single_flight.coalesced
+        return metrics
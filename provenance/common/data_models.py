@@ -18,11 +18,12 @@ docstring goes here
    limitations under the License.
 """
 
+from collections import Counter
 from enum import Enum
+from functools import wraps
 from os import environ
 from uuid import UUID
 from typing import List, Union, Optional, Any
-import re
 import hashlib
 import json
 from fairgraph.utility import as_list
@@ -43,7 +44,13 @@ import fairgraph.openminds.computation as omcmp
 from fairgraph.openminds.controlledterms import FileRepositoryType, UnitOfMeasurement, ActionStatusType
 
 from .examples import EXAMPLES
-from ..auth.utils import get_kg_client_for_service_account
+from .cache import TTLCache
+from .metrics import register_metrics
+from .kg_client import register_shared_instances
+from .repositories import classify_url
+from ..vocab.snapshot import load_vocabularies
+from ..vocab.registry import VocabularyRegistry, ControlledTerm
+from .. import settings
 
 
 
@@ -57,22 +64,29 @@ status_name_map = {
     "paused": None
 }
 
-def _get_action_status_types():
-    kg_client_service_account = get_kg_client_for_service_account()
-    return ActionStatusType.list(kg_client_service_account, scope="released",
-                                 api="core", space="controlled", size=10)
+# controlled vocabularies are loaded from the on-disk snapshot where possible,
+# so that starting the API does not require access to the KG.
+# The lookup tables (ACTION_STATUS_TYPES, UNITS, etc.) are views onto the registry,
+# so they reflect any later refresh of the vocabularies from the KG.
+_vocabularies = load_vocabularies()
 
+VOCABULARIES = VocabularyRegistry(lambda vocabularies: _build_lookup_tables(vocabularies))
+
+
+def _get_action_status_types(vocabularies):
+    return {
+        status_name_map[ast.name]: ast
+        for ast in vocabularies["action_status_types"]
+        if status_name_map[ast.name]
+    }
 
-ACTION_STATUS_TYPES = _get_action_status_types()
 
 Status = Enum(
     "Status",
-    [(status_name_map[ast.name], status_name_map[ast.name])
-     for ast in ACTION_STATUS_TYPES
-     if status_name_map[ast.name]]
+    [(name, name) for name in _get_action_status_types(_vocabularies)]
 )
 
-ACTION_STATUS_TYPES = {status_name_map[ast.name]: ast for ast in ACTION_STATUS_TYPES if status_name_map[ast.name]}
+ACTION_STATUS_TYPES = VOCABULARIES.view("action_status_types")
 
 
 class CryptographicHashFunction(str, Enum):
@@ -83,44 +97,29 @@ class CryptographicHashFunction(str, Enum):
     todo = "list to be completed"
 
 
-def get_identifier(iri, prefix):
-    """Return a valid Python variable name based on a KG object UUID"""
-    return prefix + "_" + iri.split("/")[-1].replace("-", "")
-
-
-def _get_units_of_measurement():
-    # pre-fetch units of measurement
-    kg_client_service_account = get_kg_client_for_service_account()
-    units_objects = UnitOfMeasurement.list(kg_client_service_account, api="core", scope="released", space="controlled")
+def _get_units_of_measurement(vocabularies):
+    units_objects = list(vocabularies["units_of_measurement"])
     # the follow addition is a temporary workaround with a locally-generated id until core-hour is added
     units_objects.append(UnitOfMeasurement(name="core-hour", id="https://kg.ebrains.eu/api/instances/686f4d65-bdc7-4f69-bf32-4c9f09028541"))
-    return units_objects
+    return {unit.name: unit for unit in units_objects}
 
-UNITS = _get_units_of_measurement()
 
-Units = Enum(
-    "Units",
-    [(get_identifier(unit.id, "u"), unit.name) for unit in UNITS]
-)
+class Units(ControlledTerm):
+    _vocabulary = (VOCABULARIES, "units")
 
-UNITS = {u: unit_obj for u, unit_obj in zip(Units, UNITS)}
 
+UNITS = VOCABULARIES.view("units")
 
-def _get_content_types():
-    kg_client_service_account = get_kg_client_for_service_account()
-    content_types = omcore.ContentType.list(kg_client_service_account, api="core", scope="released", space="controlled", size=10000)
-    return content_types
 
+def _get_content_types(vocabularies):
+    return {ct.name: ct for ct in vocabularies["content_types"]}
 
-CONTENT_TYPES = _get_content_types()
 
+class ContentType(ControlledTerm):
+    _vocabulary = (VOCABULARIES, "content_types")
 
-ContentType = Enum(
-    "ContentType",
-    [(get_identifier(ct.id, "ct"), ct.name) for ct in CONTENT_TYPES]
-)
 
-CONTENT_TYPES = {ct: ct_obj for ct, ct_obj in zip(ContentType, CONTENT_TYPES)}
+CONTENT_TYPES = VOCABULARIES.view("content_types")
 
 
 class ComputationType(str, Enum):
@@ -133,6 +132,14 @@ class ComputationType(str, Enum):
     #preprocessing = "pre-processing"
 
 
+class SortOrder(str, Enum):
+    """Order of the records returned by the list endpoints; a leading "-" means most recent first"""
+    start_time = "start_time"
+    start_time_descending = "-start_time"
+    end_time = "end_time"
+    end_time_descending = "-end_time"
+
+
 class Digest(BaseModel):
     """Hash value of the content of a file, used as a simple way to check if the contents have changed"""
 
@@ -140,12 +147,8 @@ class Digest(BaseModel):
     value: str
 
 
-def _get_hosting_organizations():
-    kg_client_service_account = get_kg_client_for_service_account()
-    hosting_orgs = {
-        name: omcore.Organization.list(kg_client_service_account, scope="any", space="common", alias=name)[0]
-        for name in ("EBRAINS", "GitHub", "Yale", "EBI", "CERN", "CSCS", "CNRS")
-    }
+def _get_hosting_organizations(vocabularies):
+    hosting_orgs = dict(vocabularies["hosting_organizations"])
     # CSCS = KGProxy(omcore.Organization, "https://kg.ebrains.eu/api/instances/e3f16a1a-184e-447d-aced-375c00ec4d41")
     # GitHub = KGProxy(omcore.Organization, "https://kg.ebrains.eu/api/instances/8e16b752-a95a-41f9-acc7-7f7e7c950f1d")
     # Yale = KGProxy(omcore.Organization, "https://kg.ebrains.eu/api/instances/5093d906-e058-47e9-a9eb-ac56354f79fc")  # create ModelDB as an org?
@@ -158,100 +161,53 @@ def _get_hosting_organizations():
     return hosting_orgs
 
 
-FILE_HOSTS = _get_hosting_organizations()
-
-
-file_location_patterns = {
-    "https://object.cscs.ch": FILE_HOSTS["EBRAINS"],
-    "swift://cscs.ch": FILE_HOSTS["EBRAINS"],
-    "https://ksproxy.cscs.ch": FILE_HOSTS["EBRAINS"],
-    "https://kg.humanbrainproject.org/proxy/export": FILE_HOSTS["EBRAINS"],
-    "https://github.com": FILE_HOSTS["GitHub"],
-    "https://senselab.med.yale.edu": FILE_HOSTS["Yale"],
-    "http://modeldb.yale.edu": FILE_HOSTS["Yale"],
-    "http://example.com": None,
-    "https://collab.humanbrainproject.eu": FILE_HOSTS["EBRAINS"],
-    "collab://": FILE_HOSTS["EBRAINS"],
-    "https://drive.ebrains.eu": FILE_HOSTS["EBRAINS"],
-    "https://zenodo.org": FILE_HOSTS["CERN"],
-    "https://www.ebi.ac.uk": FILE_HOSTS["EBI"],
-    #"https://CrimsonWhite@bitbucket.org": FILE_HOSTS["Bitbucket"],
-    "http://cns.iaf.cnrs-gif.fr": FILE_HOSTS["CNRS"],
-    "https://gpfs-proxy.brainsimulation.eu/cscs": FILE_HOSTS["CSCS"],
-    #"https://gpfs-proxy.brainsimulation.eu/jsc": JSC,
-    "https://data-proxy.ebrains.eu": FILE_HOSTS["EBRAINS"],
-}
+FILE_HOSTS = VOCABULARIES.view("hosting_organizations")
 
 
 def get_repository_host(url):
-    for fragment, org in file_location_patterns.items():
-        if fragment in url:
-            return org
-    return None
+    host = classify_url(url).host
+    return FILE_HOSTS[host] if host else None
 
 
-CSCS_pattern = r"https://object\.cscs\.ch/v1/(?P<proj>\w+)/(?P<container_name>[\w\.-]+)/(?P<path>\S*)"
-GPFS_proxy_pattern = r"https://gpfs-proxy\.brainsimulation\.eu/(?P<site>\w+)/(?P<project_name>[\w-]+)/(?P<path>\S*)"
-EBRAINS_Gitlab_pattern = r"https://gitlab\.ebrains\.eu/(?P<org>[\w-]+)/(?P<project_name>[/\w-]+)/-/"
-EBRAINS_Gitlab_pattern2 = r"https://gitlab\.ebrains\.eu/(?P<org>[\w-]+)/(?P<project_name>[/\w-]+)"
-EBRAINS_data_proxy_pattern = r"https://data-proxy\.ebrains\.eu/api/v1/buckets/(?P<bucket_name>[\w-]+)/[/\w\.-]+"
-
 def get_repository_iri(url):
-    templates = (
-        (CSCS_pattern, "https://object.cscs.ch/v1/{proj}/{container_name}"),
-        (GPFS_proxy_pattern, "https://gpfs-proxy.brainsimulation.eu/{site}/{project_name}"),
-        (EBRAINS_Gitlab_pattern, "https://gitlab.ebrains.eu/{org}/{project_name}"),
-        (EBRAINS_Gitlab_pattern2, "https://gitlab.ebrains.eu/{org}/{project_name}"),
-        (EBRAINS_data_proxy_pattern, "https://data-proxy.ebrains.eu/api/v1/buckets/{bucket_name}"),
-    )
-    for pattern, template in templates:
-        match = re.match(pattern, url)
-        if match:
-            return IRI(template.format(**match.groupdict()))
-
-    if url.startswith("https://drive.ebrains.eu"):
-        return IRI("https://drive.ebrains.eu")
-    raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    iri = classify_url(url).iri
+    if iri is None:
+        raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    return IRI(iri)
 
 
 def get_repository_name(url):
-    templates = (
-        (CSCS_pattern, "container_name"),
-        (GPFS_proxy_pattern, "project_name"),
-        (EBRAINS_Gitlab_pattern, "project_name"),
-        (EBRAINS_Gitlab_pattern2, "project_name"),
-        (EBRAINS_data_proxy_pattern, "bucket_name"),
-    )
-    for pattern, key in templates:
-        match = re.match(pattern, url)
-        if match:
-            return match[key]
-
-    if url.startswith("https://drive.ebrains.eu"):
-        return "EBRAINS Drive"
-    raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    name = classify_url(url).name
+    if name is None:
+        raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    return name
 
 
-def _get_repository_types():
-    kg_client_service_account = get_kg_client_for_service_account()
+def _get_repository_types(vocabularies):
     return {
-        obj.name: obj for obj in FileRepositoryType.list(kg_client_service_account, scope="released")
+        obj.name: obj for obj in vocabularies["repository_types"]
     }
 
-REPOSITORY_TYPES = _get_repository_types()
+REPOSITORY_TYPES = VOCABULARIES.view("repository_types")
 
 def get_repository_type(url):
-    if url.startswith("https://object.cscs.ch") or url.startswith("https://data-proxy.ebrains.eu"):
-        return REPOSITORY_TYPES["Swift repository"]
-    elif url.startswith("https://gpfs-proxy.brainsimulation.eu"):
-        return REPOSITORY_TYPES["GPFS repository"]
-    elif url.startswith("https://drive.ebrains.eu"):
-        return REPOSITORY_TYPES["Seafile repository"]
-    elif url.startswith("https://gitlab.ebrains.eu"):
-        return REPOSITORY_TYPES["GitLab repository"]
-    elif url.startswith("https://github.com"):
-        return REPOSITORY_TYPES["GitHub repository"]
-    raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    repository_type = classify_url(url).type
+    if repository_type is None:
+        raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    return REPOSITORY_TYPES[repository_type]
+
+
+def get_file_repository(url):
+    """Return a FileRepository object for the repository containing the file at the given URL"""
+    info = classify_url(url)
+    if info.iri is None or info.type is None:
+        raise NotImplementedError(f"Repository IRI format not yet supported. Value was {url}")
+    return omcore.FileRepository(
+        hosted_by=FILE_HOSTS[info.host] if info.host else None,
+        iri=IRI(info.iri),
+        name=info.name,
+        type=REPOSITORY_TYPES[info.type]
+    )
 
 
 class File(BaseModel):
@@ -274,7 +230,7 @@ class File(BaseModel):
         if isinstance(file_object, KGProxy):
             file_object = file_object.resolve(client, scope="any")
         if file_object.format:
-            name = file_object.format.resolve(client, scope="any").name
+            name = resolve_controlled_term(file_object.format, client).name
             format = ContentType(name)
         else:
             format = None
@@ -307,16 +263,11 @@ class File(BaseModel):
 
     def to_kg_object(self, client):
         if self.location and self.location.startswith("http"):
-            file_repository = omcore.FileRepository(
-                hosted_by=get_repository_host(self.location),
-                iri=get_repository_iri(self.location),
-                name=get_repository_name(self.location),
-                type=get_repository_type(self.location)
-            )
+            file_repository = get_file_repository(self.location)
         else:
             file_repository = None
         if self.format:
-            content_type = omcore.ContentType(name=self.format.value)
+            content_type = get_content_type(self.format, client)
         else:
             # todo: if self.format is empty, we should try to infer it
             content_type = None
@@ -354,9 +305,8 @@ class File(BaseModel):
         return file_obj
 
 
-def _get_hardware_systems():
-    kg_client_service_account = get_kg_client_for_service_account()
-    hardware_systems = omcmp.HardwareSystem.list(kg_client_service_account, scope="any", space="common")
+def _get_hardware_systems(vocabularies):
+    hardware_systems = vocabularies["hardware_systems"]
     for obj in hardware_systems:
         obj.allow_update = False
     return {
@@ -364,13 +314,77 @@ def _get_hardware_systems():
     }
 
 
-HARDWARE_SYSTEMS = _get_hardware_systems()
+HARDWARE_SYSTEMS = VOCABULARIES.view("hardware_systems")
 
 
-HardwareSystem = Enum(
-    "HardwareSystem",
-    [(name.lower().replace(" ", ""), name) for name in HARDWARE_SYSTEMS]
-)
+def _build_lookup_tables(vocabularies):
+    tables = {
+        "action_status_types": _get_action_status_types(vocabularies),
+        "units": _get_units_of_measurement(vocabularies),
+        "content_types": _get_content_types(vocabularies),
+        "hosting_organizations": _get_hosting_organizations(vocabularies),
+        "repository_types": _get_repository_types(vocabularies),
+        "hardware_systems": _get_hardware_systems(vocabularies),
+    }
+    # reverse index, so that references to controlled terms can be resolved without contacting the KG
+    tables["controlled_terms_by_id"] = {
+        obj.id: obj
+        for name in ("action_status_types", "units", "content_types", "repository_types", "hardware_systems")
+        for obj in tables[name].values()
+        if obj.id
+    }
+    # instance data for the controlled terms, so that checking whether they exist
+    # (e.g. when saving an object which refers to them) doesn't need to contact the KG
+    tables["controlled_term_data_by_id"] = {
+        id: obj.data
+        for id, obj in tables["controlled_terms_by_id"].items()
+        if obj.data
+    }
+    return tables
+
+
+VOCABULARIES.load(_vocabularies)
+register_metrics("vocabularies", VOCABULARIES.metrics)
+
+CONTROLLED_TERMS_BY_ID = VOCABULARIES.view("controlled_terms_by_id")
+register_shared_instances(VOCABULARIES.view("controlled_term_data_by_id"))
+
+controlled_term_lookups = Counter()
+register_metrics("controlled_term_lookups", lambda: dict(controlled_term_lookups))
+
+
+def resolve_controlled_term(term, client):
+    """
+    Return the KG object for a reference to a controlled term (status, units, content type, hardware),
+    from the locally-held vocabularies if possible, otherwise retrieving it from the KG.
+    """
+    if isinstance(term, KGProxy):
+        obj = CONTROLLED_TERMS_BY_ID.get(term.id)
+        if obj is None:
+            controlled_term_lookups["misses"] += 1
+            obj = term.resolve(client, scope="any")
+        else:
+            controlled_term_lookups["hits"] += 1
+        return obj
+    return term
+
+
+def get_content_type(name, client):
+    """
+    Return the ContentType object with the given name.
+
+    We use the locally-held vocabulary, so that the object already has an id
+    and saving objects which refer to it doesn't need to look it up in the KG.
+    """
+    try:
+        return CONTENT_TYPES[name]
+    except KeyError:
+        return omcore.ContentType.by_name(name, client)
+
+
+class HardwareSystem(ControlledTerm):
+    _vocabulary = (VOCABULARIES, "hardware_systems")
+
 
 
 class StringParameter(BaseModel):
@@ -467,6 +481,37 @@ class ParameterSet(BaseModel):
         )
 
 
+# Converted versions of the sub-models (people, software, environments) which are referenced
+# by many records, shared between requests. References are resolved with the permissions
+# of the requesting user, so entries are keyed by user as well as by KG id.
+SUBMODEL_CACHE = TTLCache(ttl=settings.SUBMODEL_CACHE_TTL, max_bytes=settings.SUBMODEL_CACHE_MAX_BYTES)
+register_metrics("submodel_cache", SUBMODEL_CACHE.metrics)
+
+
+def cached_conversion(from_kg_object):
+    """
+    Decorator for the from_kg_object() method of sub-models, which caches
+    the converted object in SUBMODEL_CACHE, using the user and the KG id as key.
+
+    Only references (KGProxy objects) are looked up in the cache, since it is resolving them
+    which is expensive; objects which have already been retrieved are converted directly,
+    as are references resolved by a client which is not associated with a user.
+    """
+    @wraps(from_kg_object)
+    def wrapper(cls, kg_object, client):
+        user = getattr(client, "user", None)
+        if not isinstance(kg_object, KGProxy) or user is None:
+            return from_kg_object(cls, kg_object, client)
+        key = (user, cls.__name__, kg_object.id)
+        model = SUBMODEL_CACHE.get(key)
+        if model is None:
+            model = from_kg_object(cls, kg_object, client)
+            SUBMODEL_CACHE.put(key, model, size=len(model.json()))
+        # callers may modify the object they receive
+        return model.copy(deep=True)
+    return wrapper
+
+
 class Person(BaseModel):
     """A human person responsible for launching a computation"""
 
@@ -484,6 +529,7 @@ class Person(BaseModel):
         }
 
     @classmethod
+    @cached_conversion
     def from_kg_object(cls, person, client):
         person = person.resolve(client, scope="any")
         orcid = None
@@ -526,7 +572,7 @@ class ResourceUsage(BaseModel):
     def from_kg_object(cls, resource_usage, client):
         return cls(
             value=resource_usage.value,
-            units=Units(resource_usage.unit.resolve(client, scope="any").name)
+            units=Units(resolve_controlled_term(resource_usage.unit, client).name)
         )
 
     def to_kg_object(self, client):
@@ -550,6 +596,7 @@ class SoftwareVersion(BaseModel):
         }
 
     @classmethod
+    @cached_conversion
     def from_kg_object(cls, software_version_object, client):
         svo = software_version_object.resolve(client, scope="any")
         return cls(
@@ -583,13 +630,14 @@ class ComputationalEnvironment(BaseModel):
         schema_extra = {"example": EXAMPLES["ComputationalEnvironment"]}
 
     @classmethod
+    @cached_conversion
     def from_kg_object(cls, env_object, client):
         env = env_object.resolve(client, scope="any")
         hardware = None
         config = None
         if env:
             if env.hardware:
-                hardware_obj = env.hardware.resolve(client, scope="any")
+                hardware_obj = resolve_controlled_term(env.hardware, client)
                 if hardware_obj:
                     hardware = HardwareSystem(hardware_obj.name)
 
@@ -609,10 +657,10 @@ class ComputationalEnvironment(BaseModel):
     def to_kg_object(self, client):
         return omcmp.Environment(
             name=self.name,
-            hardware=HARDWARE_SYSTEMS[self.hardware.value],
+            hardware=HARDWARE_SYSTEMS[self.hardware],
             configuration=omcore.Configuration(
                 configuration=json.dumps(self.configuration, indent=2),
-                format=omcore.ContentType(name="application/json")
+                format=get_content_type("application/json", client)
             ),
             software=[sv.to_kg_object(client) for sv in as_list(self.software)],
             description=self.description
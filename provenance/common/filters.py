@@ -0,0 +1,495 @@
+"""
+Compilation of the query parameters of the list endpoints into Knowledge Graph query filters
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import asyncio
+import base64
+import hashlib
+import heapq
+import json
+import logging
+from uuid import UUID
+
+from fastapi import HTTPException, status as status_codes
+
+from fairgraph.base import as_list, KGObject
+import fairgraph.openminds.core as omcore
+import fairgraph.openminds.computation as omcmp
+
+from .data_models import ACTION_STATUS_TYPES, HARDWARE_SYSTEMS, SortOrder
+from .indexes import environment_index, record_index, as_timestamp
+from .utils import expand_combinations
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+MAX_FILES = 100  # todo: figure out what a reasonable limit is
+# Each combination of filter values is a separate KG query,
+# so beyond this number further conditions are checked on the returned records
+MAX_COMBINATIONS = 20
+
+
+def _uuid(value):
+    return str(getattr(value, "uuid", value))
+
+
+class QueryFilters:
+    """
+    Filters for a query of computation records.
+
+    Each condition is a field name and a list of acceptable values, any one of which
+    must be present in that field of a record; conditions are combined with AND.
+    Calling `compile()` decides which conditions are sent to the Knowledge Graph
+    (one query per combination of values) and which are checked on the returned records.
+    Required tags and time limits are looked up in the record index.
+
+    Queries by tag or time, or with an explicit `order_by`, are ordered (by default,
+    most recent first) with ties broken by record id, so that a page can be identified
+    by the position of the last record of the previous page, and records added or removed
+    while a client is paging do not shift the following pages. Other queries are answered
+    by the KG, in the order it returns the records, and a page is identified by the KG query
+    it starts in and its offset within that query's results, which records added or removed
+    in the meantime do shift. Either is encoded in an opaque cursor.
+    `parameters` are the query parameters as received, which a cursor must have been created with.
+    """
+
+    def __init__(self, parameters=None):
+        self.parameters = parameters or {}
+        self.conditions = []
+        self.required_tags = []
+        self.empty = False  # True if no record can match
+        self.kg_filters = {}
+        self.post_filters = []
+        # time limits, as timestamps
+        self.started_after = None
+        self.started_before = None
+        self.ended_after = None
+        self.order_by = None
+        # position of the last record of the previous page, for ordered queries,
+        # or KG query and offset within its results at which the page starts, for the others
+        self.after = None
+        self.combination = 0
+        self.offset = 0
+        # set by list_computations() if there may be further results
+        self.next_cursor = None
+
+    def require(self, field_name, values):
+        """Records must have one of `values` in the given field"""
+        values = as_list(values)
+        self.conditions.append((field_name, values))
+        if len(values) == 0:
+            self.empty = True
+
+    def require_tags(self, tags):
+        """Records must have all of these tags"""
+        self.required_tags.extend(as_list(tags))
+
+    def require_time_range(self, started_after=None, started_before=None, ended_after=None):
+        """Records must have started and ended within these limits"""
+        self.started_after = as_timestamp(started_after)
+        self.started_before = as_timestamp(started_before)
+        self.ended_after = as_timestamp(ended_after)
+
+    @property
+    def is_ordered(self):
+        """Whether the results are sorted, and so must be selected using the record index"""
+        return bool(self.required_tags) or self.has_time_range or self.order_by is not None
+
+    @property
+    def has_time_range(self):
+        return any(limit is not None for limit in (self.started_after, self.started_before, self.ended_after))
+
+    def in_time_range(self, record):
+        start_time = as_timestamp(record.start_time)
+        end_time = as_timestamp(record.end_time)
+        if self.started_after is not None and (start_time is None or start_time < self.started_after):
+            return False
+        if self.started_before is not None and (start_time is None or start_time >= self.started_before):
+            return False
+        if self.ended_after is not None and (end_time is None or end_time < self.ended_after):
+            return False
+        return True
+
+    def sort_key(self, record, id=None):
+        """
+        Sort key for KG objects or IndexedRecords (for which the `id` must be given),
+        in the requested order (by default, most recent first)
+        """
+        order_by = (self.order_by or SortOrder.start_time_descending).value
+        value = as_timestamp(record.end_time if order_by.endswith("end_time") else record.start_time)
+        if value is None:
+            value = float("inf")  # records without a start/end time come last
+        elif order_by.startswith("-"):
+            value = -value
+        return (value, str(id or record.uuid))
+
+    def is_after_cursor(self, record, id=None):
+        return self.after is None or self.sort_key(record, id) > self.after
+
+    def fingerprint(self):
+        """Hash of the query parameters, to check that a cursor is used with the query it came from"""
+        parameters = json.dumps(self.parameters, sort_keys=True, default=str)
+        return hashlib.sha1(parameters.encode("utf-8")).hexdigest()[:16]
+
+    def _encode_cursor(self, position):
+        position = dict(position, q=self.fingerprint())
+        return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii").rstrip("=")
+
+    def cursor_after(self, record, id=None):
+        """
+        Return a cursor for the page of an ordered query which follows `record`
+        (a KG object, or an IndexedRecord, for which the `id` must be given)
+        """
+        value, id = self.sort_key(record, id)
+        return self._encode_cursor({"k": None if value == float("inf") else value, "i": id})
+
+    def cursor_at(self, offset, combination=0):
+        """
+        Return a cursor for the page of an unordered query which starts at `offset`
+        in the results of the KG query for the given combination of filter values
+        """
+        return self._encode_cursor({"c": combination, "n": offset})
+
+    def resume_from(self, cursor):
+        """Start from the position encoded in `cursor`"""
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            query = position["q"]
+            if "n" in position:
+                offset = int(position["n"])
+                combination = int(position.get("c", 0))
+                if offset < 0 or combination < 0:
+                    raise ValueError("negative offset")
+                after = None
+            else:
+                offset = combination = 0
+                value = position["k"]
+                after = (float("inf") if value is None else float(value), str(position["i"]))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise HTTPException(
+                status_code=status_codes.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        if query != self.fingerprint():
+            raise HTTPException(
+                status_code=status_codes.HTTP_400_BAD_REQUEST,
+                detail="This cursor was created for a different query"
+            )
+        self.after = after
+        self.combination = combination
+        self.offset = offset
+
+    def compile(self):
+        self.kg_filters = {}
+        self.post_filters = []
+        n_combinations = 1
+        # the most selective conditions are sent to the KG first
+        for field_name, values in sorted(self.conditions, key=lambda item: len(item[1])):
+            if field_name not in self.kg_filters and n_combinations * len(values) <= MAX_COMBINATIONS:
+                self.kg_filters[field_name] = values[0] if len(values) == 1 else values
+                n_combinations *= len(values)
+            else:
+                self.post_filters.append((field_name, set(_uuid(value) for value in values)))
+        return self
+
+    @staticmethod
+    def _check(kg_object, conditions):
+        for field_name, allowed in conditions:
+            if not any(_uuid(value) in allowed for value in as_list(getattr(kg_object, field_name, None))):
+                return False
+        return True
+
+    def matches(self, kg_object):
+        """Check the conditions that could not be included in the KG query"""
+        return self._check(kg_object, self.post_filters)
+
+
+def _intersection(objects, other_objects):
+    if objects is None:
+        return as_list(other_objects)
+    allowed = set(_uuid(obj) for obj in as_list(other_objects))
+    return [obj for obj in objects if _uuid(obj) in allowed]
+
+
+async def _get_input_files(kg, repository):
+    files = await kg.list(omcore.File, file_repository=repository)
+    if len(files) > MAX_FILES:
+        raise HTTPException(
+            status_code=status_codes.HTTP_400_BAD_REQUEST,
+            detail="This dataset has too many files for this query"
+        )
+    # todo: support FileBundle
+    return files
+
+
+async def build_filters(
+    kg, space=None, model_version=None, simulator=None, dataset=None, simulation=None,
+    research_product=None, input_data=None, software=None, platform=None, status=None,
+    tags=None, started_after=None, started_before=None, ended_after=None, order_by=None, cursor=None
+):
+    """
+    Translate the query parameters shared by the computation endpoints into a QueryFilters object.
+
+    References to other records are resolved, which may raise HTTP 404 errors.
+    An invalid `cursor` raises an HTTP 400 error.
+    """
+    filters = QueryFilters(parameters=dict(
+        space=space, model_version=model_version, simulator=simulator, dataset=dataset,
+        simulation=simulation, research_product=research_product, input_data=input_data,
+        software=software, platform=platform, status=status, tags=tags, started_after=started_after,
+        started_before=started_before, ended_after=ended_after, order_by=order_by
+    ))
+    if cursor:
+        filters.resume_from(cursor)
+    # filter by model version
+    if model_version:
+        # todo: add a query for un-released model versions
+        model_version_obj = await kg.from_id(omcore.ModelVersion, str(model_version), scope="released")
+        if model_version_obj is None:
+            raise HTTPException(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                detail="No such model version, or you don't have access."
+            )
+        filters.require("inputs", model_version_obj)
+    # filter by dataset
+    if dataset:
+        dataset_obj = await kg.from_id(omcore.DatasetVersion, str(dataset))
+        if dataset_obj is None:
+            raise HTTPException(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                detail="No such dataset"
+            )
+        filters.require("inputs", await _get_input_files(kg, dataset_obj.repository))
+    # filter by research product
+    if research_product:
+        rp_obj = await kg.from_id(KGObject, research_product)
+        if rp_obj is None:
+            raise HTTPException(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                detail="No such research product"
+            )
+        filters.require("inputs", await _get_input_files(kg, rp_obj.repository))
+    # filter by simulation
+    if simulation:
+        # todo: add a query for released simulations
+        simulation_obj = await kg.from_id(omcmp.Simulation, str(simulation), scope="any")
+        if simulation_obj is None:
+            raise HTTPException(
+                status_code=status_codes.HTTP_404_NOT_FOUND,
+                detail="No such simulation, or you don't have access."
+            )
+        filters.require("inputs", simulation_obj.outputs)
+    # filter by input_data
+    if input_data:
+        filters.require("inputs", input_data)
+    # filter by simulator, software and hardware platform.
+    # These are all properties of the environment, and a record has a single environment,
+    # so we combine them into a single condition
+    environments = None
+    if simulator:
+        # environments containing any version of the simulator
+        simulator_obj = await kg.by_name(omcore.Software, simulator.value, scope="any")
+        simulator_environments = []
+        if simulator_obj and simulator_obj.versions:
+            simulator_environments = await kg.list(
+                omcmp.Environment, software=as_list(simulator_obj.versions), scope="any", space=space)
+        environments = _intersection(environments, simulator_environments)
+    if software:
+        # environments containing this software version
+        environments = _intersection(environments, await kg.list(
+            omcmp.Environment, software=software, scope="any", space=space))
+    if platform:
+        # todo: handle different versions of hardware platforms
+        hardware_obj = HARDWARE_SYSTEMS.get(platform)
+        platform_environments = []
+        if hardware_obj is not None:
+            environment_ids = await environment_index.environment_ids(kg, hardware_obj, space)
+            platform_environments = [UUID(id) for id in sorted(environment_ids)]
+        environments = _intersection(environments, platform_environments)
+    if environments is not None:
+        filters.require("environment", environments)
+    # filter by status
+    if status:
+        filters.require("status", ACTION_STATUS_TYPES[status.value])
+    # filter by tag
+    if tags:
+        filters.require_tags(tags)
+    # filter by time
+    filters.require_time_range(started_after, started_before, ended_after)
+    filters.order_by = order_by
+    return filters.compile()
+
+
+def _matches_query(kg_object, kg_filters):
+    return QueryFilters._check(kg_object, [(field_name, {_uuid(value)}) for field_name, value in kg_filters.items()])
+
+
+async def _list_in_turn(kg, cls, filters, combinations, space, size, from_index):
+    """
+    Retrieve a page of the results of the KG queries for several combinations of filter values,
+    taking the queries one after the other. Records that do not match the post-filters,
+    or that are also results of an earlier query, are left out.
+
+    The cursor for the next page records the query and the offset within its results
+    at which the page ends, so that each page carries on from there
+    rather than going through the results of the previous pages again.
+    """
+    page_size = max(size, 100)
+    n_skipped = 0
+    page = []
+    combination, offset = filters.combination, filters.offset
+    while combination < len(combinations):
+        kg_filters = combinations[combination]
+        objects = await kg.list(cls, scope="any", api="query", space=space,
+                                size=page_size, from_index=offset, **kg_filters)
+        for obj in objects:
+            offset += 1
+            if not filters.matches(obj) or any(
+                _matches_query(obj, earlier) for earlier in combinations[:combination]
+            ):
+                continue
+            if n_skipped < from_index:
+                n_skipped += 1
+                continue
+            page.append(obj)
+            if len(page) == size:
+                filters.next_cursor = filters.cursor_at(offset, combination)
+                return page
+        if len(objects) < page_size:
+            combination, offset = combination + 1, 0
+    return page
+
+
+async def _select_matching(kg, cls, filters, kg_filters, space, sort_keys, n_wanted):
+    """
+    Go through the records that match the KG filters, and return the first `n_wanted`
+    of those which are among `sort_keys` and match the post-filters, in the order of their sort keys.
+
+    The KG cannot sort the records, so all of its results must be gone through,
+    but only `n_wanted` are kept.
+    """
+    page_size = max(n_wanted, 100)
+    selected = []
+    from_index = 0
+    while True:
+        objects = await kg.list(cls, scope="any", api="query", space=space,
+                                size=page_size, from_index=from_index, **kg_filters)
+        selected.extend(obj for obj in objects if _uuid(obj) in sort_keys and filters.matches(obj))
+        selected = heapq.nsmallest(n_wanted, selected, key=lambda obj: sort_keys[_uuid(obj)])
+        if len(objects) < page_size:
+            return selected
+        from_index += page_size
+
+
+async def _list_indexed(kg, cls, filters, space, size, from_index):
+    """
+    Retrieve the records with all of the required tags, within the time limits
+    and after the cursor, in the requested order, using the record index to select and order them.
+
+    Without other conditions, only the records on the requested page are retrieved.
+    Otherwise, the results of the KG queries for the other conditions are merged,
+    keeping only the first `from_index + size` records selected by the index,
+    so that records which do not match those conditions are never retrieved.
+
+    The cursor for the next page is based on the index rather than on the records retrieved,
+    so that records deleted outside this API since the index was loaded,
+    which leave gaps in the page, do not end the pagination early.
+    """
+    records = await record_index.select(kg, cls, space, tags=filters.required_tags, where=filters.in_time_range)
+    sort_keys = {
+        id: filters.sort_key(record, id)
+        for id, record in records.items() if filters.is_after_cursor(record, id)
+    }
+    n_wanted = from_index + size
+    # one more than needed, to find out whether there is a next page
+    if not filters.conditions:
+        ids = heapq.nsmallest(n_wanted + 1, sort_keys, key=sort_keys.get)
+        page_ids = ids[from_index:n_wanted]
+        if page_ids and len(ids) > n_wanted:
+            filters.next_cursor = filters.cursor_after(records[page_ids[-1]], page_ids[-1])
+        return await kg.from_uuids(cls, page_ids, scope="any")
+    if not sort_keys:
+        return []
+    # The queries are independent, so we make them concurrently.
+    all_results = await asyncio.gather(*(
+        _select_matching(kg, cls, filters, kg_filters, space, sort_keys, n_wanted + 1)
+        for kg_filters in expand_combinations(filters.kg_filters)
+    ))
+    merged = {}
+    for results in all_results:
+        for obj in results:
+            merged.setdefault(_uuid(obj), obj)  # use dict to remove duplicates
+    ids = heapq.nsmallest(n_wanted + 1, merged, key=sort_keys.get)
+    page_ids = ids[from_index:n_wanted]
+    if page_ids and len(ids) > n_wanted:
+        filters.next_cursor = filters.cursor_after(records[page_ids[-1]], page_ids[-1])
+    return [merged[id] for id in page_ids]
+
+
+def _invalid_cursor():
+    return HTTPException(
+        status_code=status_codes.HTTP_400_BAD_REQUEST,
+        detail="Invalid cursor"
+    )
+
+
+async def list_computations(kg, cls, filters, space=None, size=100, from_index=0):
+    """
+    Retrieve a page of the records of type `cls` that match `filters`,
+    and set `filters.next_cursor` if there may be further results.
+
+    Queries by tag or time, or with an explicit order, use the record index to select
+    and order the records (by default, most recent first). Without other conditions,
+    only the records on the requested page are retrieved, however deep the page is;
+    with other conditions, only the matching records are retrieved.
+    Other queries are answered by the KG, in the order it returns the records.
+    In the common case the filters translate into a single KG query,
+    so that only the requested page of matching records is retrieved.
+    Otherwise the KG queries are taken one after the other, from where the previous page ended.
+    """
+    filters.next_cursor = None
+    if filters.empty:
+        return []
+    if filters.is_ordered:
+        if filters.offset:
+            raise _invalid_cursor()
+        return await _list_indexed(kg, cls, filters, space, size, from_index)
+    if filters.after is not None:
+        raise _invalid_cursor()
+    combinations = expand_combinations(filters.kg_filters)
+    if filters.combination >= len(combinations):
+        raise _invalid_cursor()
+    if len(combinations) > 1 or filters.post_filters:
+        return await _list_in_turn(kg, cls, filters, combinations, space, size, from_index)
+    start = filters.offset + from_index
+    objects = await kg.list(cls, scope="any", api="query", space=space,
+                            size=size, from_index=start, **combinations[0])
+    if objects and len(objects) >= size:
+        filters.next_cursor = filters.cursor_at(start + size)
+    return objects
+
+
+def set_next_link(request, response, filters):
+    """
+    If there may be further results, add a link to the next page to the response headers,
+    in the same form as the GitHub API (RFC 8288)
+    """
+    if filters.next_cursor:
+        url = request.url.remove_query_params("from_index").include_query_params(cursor=filters.next_cursor)
+        response.headers["Link"] = f'<{url}>; rel="next"'
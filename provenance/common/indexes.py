@@ -0,0 +1,451 @@
+"""
+In-memory indexes used to resolve query filters without contacting the Knowledge Graph
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+import fairgraph.errors
+from fairgraph.base import as_list
+import fairgraph.openminds.computation as omcmp
+
+from .cache import SingleFlight
+from .kg_client import KGOverloaded
+from .metrics import register_metrics
+from .. import settings
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+
+# the types of computation which can be stages of a workflow
+STAGE_CLASSES = (
+    omcmp.DataAnalysis, omcmp.Visualization, omcmp.Simulation,
+    omcmp.Optimization, omcmp.DataCopy, omcmp.GenericComputation
+)
+
+
+def computation_spaces(accessible_spaces):
+    """Of the spaces a user can access, those which may contain computation records"""
+    spaces = ["myspace"]
+    spaces.extend(sp for sp in accessible_spaces if sp.startswith("collab"))
+    if "computation" in accessible_spaces:
+        spaces.append("computation")
+    return spaces
+
+
+def as_timestamp(value):
+    """Convert a date-time to seconds since the epoch, for comparison and sorting"""
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return value
+    return None
+
+
+class ChangeSignal:
+    """
+    Counters shared between the API worker processes, one per KG space, which are incremented
+    each time a worker saves or deletes a record in that space.
+
+    Each counter is a file in `directory`, to which a byte is appended for each change,
+    so the current value is given by the size of the file. Appending is atomic,
+    so no locking is needed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, space_key):
+        return os.path.join(self.directory, hashlib.sha1(repr(space_key).encode("utf-8")).hexdigest())
+
+    def generation(self, space_key):
+        try:
+            return os.stat(self._path(space_key)).st_size
+        except FileNotFoundError:
+            return 0
+
+    def increment(self, space_key):
+        """Record a change, and return the new value of the counter, or None if it could not be updated"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(space_key), "ab") as fp:
+                fp.write(b".")
+                fp.flush()
+                return os.fstat(fp.fileno()).st_size
+        except OSError as err:
+            logger.warning(f"Unable to signal a change to the other workers: {err}")
+            return None
+
+
+class _SpaceIndex:
+    """
+    Base class for indexes which hold an entry for each KG space (and possibly record type).
+
+    An entry is loaded in full the first time it is needed, and again once it is
+    older than `ttl` seconds. In between, records saved through this API are added
+    incrementally. Since "myspace" is a different space for each user, it is indexed per user.
+
+    Each worker process has its own index, so a worker which saves or deletes a record
+    tells the others through a ChangeSignal, and they reload their entries for that space
+    the next time they are needed. Records saved in the KG by other means are only seen
+    once the entry is reloaded after `ttl` seconds.
+
+    Entries are shared between users who see the same records, so each space has
+    separate entries for users who can read its unreleased records (scope "any")
+    and for those who can only read its released records (scope "released").
+
+    If a reload fails, the previous entry is kept. If there is no previous entry,
+    the error is raised, since the query cannot be answered from the index.
+    """
+
+    def __init__(self, ttl, page_size=1000, max_concurrent_loads=10, signal_dir=settings.INDEX_SIGNAL_DIR):
+        self.ttl = ttl
+        self.page_size = page_size
+        self.max_concurrent_loads = max_concurrent_loads
+        self._signal = ChangeSignal(signal_dir)
+        # (user, space, scope, ...) -> entry, with "loaded_at" and "generation" attributes
+        self._entries = {}
+        self._single_flight = SingleFlight()
+        self.loads = 0
+        self.load_errors = 0
+        self.additions = 0
+
+    @staticmethod
+    def _space_key(user, space):
+        return (user if space == "myspace" else None, space)
+
+    @classmethod
+    def _key(cls, user, space, scope, *rest):
+        return cls._space_key(user, space) + (scope,) + rest
+
+    def _is_current(self, key):
+        entry = self._entries.get(key)
+        return (
+            entry is not None
+            and time.time() - entry.loaded_at < self.ttl
+            and entry.generation == self._signal.generation(key[:2])  # the space key
+        )
+
+    def _new_entry(self, entry_cls, user, space):
+        entry = entry_cls()
+        # read before loading, so changes made by other workers while we load cause another reload
+        entry.generation = self._signal.generation(self._space_key(user, space))
+        return entry
+
+    def _changed(self, user, space, updated_entries):
+        """
+        Tell the other workers that records in `space` have been saved or deleted.
+        `updated_entries` are the entries of this index which are already up to date.
+        """
+        generation = self._signal.increment(self._space_key(user, space))
+        for entry in updated_entries:
+            # unless another worker has also made changes in the meantime
+            if generation is not None and entry.generation == generation - 1:
+                entry.generation = generation
+
+    async def _list_all(self, kg, fairgraph_cls, space, scope, **filters):
+        objects = []
+        while True:
+            page = await kg.list(fairgraph_cls, scope=scope, space=space,
+                                 size=self.page_size, from_index=len(objects), **filters)
+            objects.extend(page)
+            if len(page) < self.page_size:
+                return objects
+
+    async def _ensure_loaded(self, key, load, limit=None):
+        if self._is_current(key):
+            return
+        try:
+            if limit is None:
+                await self._single_flight.do(key, load)
+            else:
+                async with limit:
+                    await self._single_flight.do(key, load)
+        except (KGOverloaded, fairgraph.errors.AuthenticationError):
+            raise
+        except Exception as err:
+            self.load_errors += 1
+            if key not in self._entries:
+                # with nothing to fall back on, an empty entry would give wrong answers
+                raise
+            # keep the previously-loaded entry rather than failing the query
+            logger.warning(f"Unable to reload index entry {key[1:]}: {err}")
+
+    async def _spaces(self, kg, space):
+        """
+        Return (space, scope) for `space` or, if `space` is None, for each space the user can access
+        that may contain computation records; the scope is that of the records the user can read there.
+        A space the user cannot access is omitted.
+        """
+        accessible = await kg.spaces(permissions=None, names_only=True)
+        if space:
+            spaces = [space] if space == "myspace" or space in accessible else []
+        else:
+            spaces = computation_spaces(accessible)
+        readable = await kg.readable_spaces()
+        return [(sp, "any" if sp == "myspace" or sp in readable else "released") for sp in spaces]
+
+    def metrics(self):
+        return {
+            "entries": len(self._entries),
+            "loads": self.loads,
+            "load_errors": self.load_errors,
+            "additions": self.additions,
+        }
+
+
+class IndexedEnvironments:
+
+    def __init__(self):
+        self.loaded_at = time.time()
+        self.by_hardware = {}  # hardware id -> set of environment ids
+
+    def add(self, environment):
+        if environment.hardware is not None:
+            self.by_hardware.setdefault(environment.hardware.id, set()).add(environment.uuid)
+
+
+class EnvironmentIndex(_SpaceIndex):
+    """
+    The ids of the computational environments in each KG space, grouped by hardware system.
+
+    For a space which could not be loaded (or reloaded), the environments
+    are queried from the KG directly, as they would be without the index.
+    """
+
+    def __init__(self, ttl, page_size=1000, max_concurrent_loads=10, signal_dir=settings.INDEX_SIGNAL_DIR):
+        super().__init__(ttl, page_size=page_size, max_concurrent_loads=max_concurrent_loads, signal_dir=signal_dir)
+        self.fallbacks = 0
+
+    async def _load(self, kg, space, scope):
+        entry = self._new_entry(IndexedEnvironments, kg.user, space)
+        for environment in await self._list_all(kg, omcmp.Environment, space, scope):
+            entry.add(environment)
+        self._entries[self._key(kg.user, space, scope)] = entry
+        self.loads += 1
+
+    async def _space_environment_ids(self, kg, hardware, space, scope, limit):
+        key = self._key(kg.user, space, scope)
+        try:
+            await self._ensure_loaded(key, partial(self._load, kg, space, scope), limit)
+        except (KGOverloaded, fairgraph.errors.AuthenticationError):
+            raise
+        except Exception as err:
+            logger.warning(f"Unable to load index entry {key[1:]}: {err}")
+        if self._is_current(key):
+            return self._entries[key].by_hardware.get(hardware.id, set())
+        self.fallbacks += 1
+        async with limit:
+            environments = await self._list_all(kg, omcmp.Environment, space, scope, hardware=hardware)
+        return {environment.uuid for environment in environments}
+
+    async def environment_ids(self, kg, hardware, space=None):
+        """
+        Return the ids of the environments on the given hardware system,
+        either in `space` or, if `space` is None, in all the spaces the user can access.
+        """
+        spaces = await self._spaces(kg, space)
+        limit = asyncio.Semaphore(self.max_concurrent_loads)
+        id_sets = await asyncio.gather(*(
+            self._space_environment_ids(kg, hardware, sp, scope, limit) for sp, scope in spaces
+        ))
+        return set().union(*id_sets)
+
+    def add(self, user, space, environment):
+        """Add a newly-saved environment to the index, if its space has been loaded"""
+        if environment is None or environment.id is None:
+            return
+        # a newly-saved environment is not yet released
+        entry = self._entries.get(self._key(user, space, "any"))
+        if entry is not None:
+            entry.add(environment)
+            self.additions += 1
+        self._changed(user, space, [entry] if entry is not None else [])
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics["environments"] = sum(len(ids) for entry in self._entries.values()
+                                      for ids in entry.by_hardware.values())
+        metrics["fallbacks"] = self.fallbacks
+        return metrics
+
+
+IndexedRecord = namedtuple("IndexedRecord", ["tags", "start_time", "end_time"])
+
+
+class IndexedRecords:
+    """The tags, start times and end times of the records of one type in one space"""
+
+    def __init__(self):
+        self.loaded_at = time.time()
+        self.by_tag = {}  # tag -> set of record ids
+        self.records = {}  # record id -> IndexedRecord, with times as timestamps
+
+    def put(self, id, tags, start_time, end_time):
+        self.remove(id)
+        record = IndexedRecord(tuple(dict.fromkeys(tags)), start_time, end_time)
+        self.records[id] = record
+        for tag in record.tags:
+            self.by_tag.setdefault(tag, set()).add(id)
+
+    def remove(self, id):
+        record = self.records.pop(id, None)
+        if record is not None:
+            for tag in record.tags:
+                ids = self.by_tag[tag]
+                ids.discard(id)
+                if not ids:
+                    del self.by_tag[tag]
+
+    def matching(self, tags):
+        """Return the ids of the records with all of the given tags"""
+        # intersect starting from the rarest tag, so the intermediate sets stay small
+        id_sets = sorted((self.by_tag.get(tag, set()) for tag in tags), key=len)
+        if not id_sets:
+            return set()
+        return id_sets[0].intersection(*id_sets[1:])
+
+
+class RecordIndex(_SpaceIndex):
+    """
+    The tags, start times and end times of the records of each computation type in each KG space,
+    so that queries by tag or by time can be answered without retrieving non-matching records.
+
+    Workflows are not tagged themselves, so a workflow has the tags of its stages,
+    and runs from the start of its earliest stage to the end of its latest stage.
+    """
+
+    async def _load(self, kg, fairgraph_cls, space, scope):
+        entry = self._new_entry(IndexedRecords, kg.user, space)
+        if fairgraph_cls is omcmp.WorkflowExecution:
+            stage_entries = await asyncio.gather(*(
+                self._get_entry(kg, stage_cls, space, scope) for stage_cls in STAGE_CLASSES
+            ))
+            stages = {}
+            for stage_entry in stage_entries:
+                stages.update(stage_entry.records if stage_entry else {})
+            for workflow in await self._list_all(kg, fairgraph_cls, space, scope):
+                self._put_workflow(entry, workflow, stages)
+        else:
+            for obj in await self._list_all(kg, fairgraph_cls, space, scope):
+                self._put_computation(entry, obj)
+        self._entries[self._key(kg.user, space, scope, fairgraph_cls.__name__)] = entry
+        self.loads += 1
+
+    @staticmethod
+    def _put_computation(entry, obj):
+        entry.put(obj.uuid, as_list(obj.tags), as_timestamp(obj.start_time), as_timestamp(obj.end_time))
+
+    @staticmethod
+    def _put_workflow(entry, workflow, stages):
+        workflow_stages = [stages[stage.uuid] for stage in as_list(workflow.stages) if stage.uuid in stages]
+        start_times = [stage.start_time for stage in workflow_stages if stage.start_time is not None]
+        end_times = [stage.end_time for stage in workflow_stages if stage.end_time is not None]
+        entry.put(
+            workflow.uuid,
+            [tag for stage in workflow_stages for tag in stage.tags],
+            min(start_times) if start_times else None,
+            max(end_times) if end_times else None
+        )
+
+    async def _get_entry(self, kg, fairgraph_cls, space, scope, limit=None):
+        key = self._key(kg.user, space, scope, fairgraph_cls.__name__)
+        await self._ensure_loaded(key, partial(self._load, kg, fairgraph_cls, space, scope), limit)
+        return self._entries.get(key)
+
+    async def select(self, kg, fairgraph_cls, space=None, tags=None, where=None):
+        """
+        Return the records of type `fairgraph_cls` with all of `tags` (if given),
+        for which `where(record)` (if given) is true, either in `space` or,
+        if `space` is None, in all the spaces the user can access,
+        as a dict mapping record ids to IndexedRecords.
+        Only records the user can read are returned.
+        """
+        spaces = await self._spaces(kg, space)
+        limit = asyncio.Semaphore(self.max_concurrent_loads)
+        entries = await asyncio.gather(*(
+            self._get_entry(kg, fairgraph_cls, sp, scope, limit) for sp, scope in spaces
+        ))
+        selected = {}
+        for entry in entries:
+            if entry is not None:
+                ids = entry.matching(tags) if tags else entry.records
+                for id in ids:
+                    record = entry.records[id]
+                    if where is None or where(record):
+                        selected[id] = record
+        return selected
+
+    def put(self, user, space, kg_object):
+        """
+        Update the index with a computation or workflow record saved through this API.
+        Newly-saved records are not yet released, so only entries with scope "any" are updated.
+        """
+        self._changed(user, space, self._put(user, space, kg_object))
+
+    def _put(self, user, space, kg_object):
+        updated = []
+        if isinstance(kg_object, omcmp.WorkflowExecution):
+            stages = {}
+            for stage in as_list(kg_object.stages):
+                if isinstance(stage, STAGE_CLASSES):
+                    updated.extend(self._put(user, space, stage))
+                    stages[stage.uuid] = IndexedRecord(
+                        tuple(as_list(stage.tags)), as_timestamp(stage.start_time), as_timestamp(stage.end_time))
+            entry = self._entries.get(self._key(user, space, "any", type(kg_object).__name__))
+            if entry is not None:
+                self._put_workflow(entry, kg_object, stages)
+                self.additions += 1
+                updated.append(entry)
+        else:
+            entry = self._entries.get(self._key(user, space, "any", type(kg_object).__name__))
+            if entry is not None:
+                self._put_computation(entry, kg_object)
+                self.additions += 1
+                updated.append(entry)
+        return updated
+
+    def remove(self, user, space, kg_object):
+        """Remove a deleted record from the index"""
+        updated = []
+        for scope in ("any", "released"):
+            entry = self._entries.get(self._key(user, space, scope, type(kg_object).__name__))
+            if entry is not None:
+                entry.remove(kg_object.uuid)
+                updated.append(entry)
+        self._changed(user, space, updated)
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics["records"] = sum(len(entry.records) for entry in self._entries.values())
+        return metrics
+
+
+environment_index = EnvironmentIndex(ttl=settings.ENVIRONMENT_INDEX_TTL)
+register_metrics("environment_index", environment_index.metrics)
+
+record_index = RecordIndex(ttl=settings.RECORD_INDEX_TTL)
+register_metrics("record_index", record_index.metrics)
@@ -0,0 +1,711 @@
+"""
+Request-scoped wrapper around the fairgraph KGClient, an asynchronous interface to it,
+and a pool of clients shared between requests
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import asyncio
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import partial
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from fairgraph.base import KGProxy, KGObject, EmbeddedMetadata, as_list
+from fairgraph.client import KGClient
+from fairgraph.errors import AuthenticationError, AuthorizationError
+from kg_core.kg import kg
+from kg_core.request import Stage, ExtendedResponseConfiguration
+
+from .cache import TTLCache
+from .metrics import register_metrics
+from .. import settings
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+BULK_REQUEST_SIZE = 200  # maximum number of instances requested in a single call to the KG
+BULK_STAGES = {"released": Stage.RELEASED, "in progress": Stage.IN_PROGRESS}
+# error codes with which a KG that does not provide the "instancesByIds" endpoint responds
+BULK_UNSUPPORTED_CODES = (404, 405, 501)
+
+# Sources of instances which are the same for all users and which we already hold in memory,
+# such as the controlled terms. Each source is a mapping from URI to instance data.
+_shared_instance_sources = []
+
+
+def register_shared_instances(source):
+    """
+    Register a mapping from URI to instance data, which will be used to answer
+    requests for those instances instead of contacting the KG.
+    """
+    _shared_instance_sources.append(source)
+
+
+def get_shared_instance(uri):
+    for source in _shared_instance_sources:
+        data = source.get(uri)
+        if data is not None:
+            return data
+    return None
+
+
+def find_proxies(obj, _seen=None):
+    """Return all unresolved references (KGProxy objects) contained in a KG object"""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return []
+    _seen.add(id(obj))
+    proxies = []
+    for field in obj.fields:
+        if not getattr(field, "intrinsic", True):
+            continue
+        for value in as_list(getattr(obj, field.name, None)):
+            if isinstance(value, KGProxy):
+                proxies.append(value)
+            elif isinstance(value, (KGObject, EmbeddedMetadata)):
+                proxies.extend(find_proxies(value, _seen))
+    return proxies
+
+
+class BulkRequestsUnsupported(Exception):
+    """Raised when instances cannot be retrieved in bulk, so must be retrieved one at a time"""
+
+
+def instantiate(proxy, data, client, scope):
+    """Build the KG object referred to by a proxy, from already-retrieved instance data"""
+    for cls in proxy.classes:
+        try:
+            return cls.from_kg_instance(deepcopy(data), client, scope=scope)
+        except TypeError:  # type mismatch, when the proxy could refer to one of several classes
+            pass
+    return None
+
+
+class KGIdentityMap:
+    """
+    Wraps a KGClient for the lifetime of a single API request.
+
+    Each KG instance is retrieved at most once per request: the same person,
+    environment or software version may be referenced by every record in a page,
+    but `KGProxy.resolve()` for a URI we have already seen is answered from memory.
+    All other attributes and methods are delegated to the wrapped client,
+    so an identity map can be passed anywhere a KGClient is expected.
+
+    `user` identifies the user whose token the wrapped client uses (see `token_key()`),
+    for caches of data retrieved with that user's permissions.
+
+    The sub-pages of a large page are retrieved concurrently, in different threads,
+    so the map and the call counts are guarded by a lock (which is not held during KG calls).
+    """
+
+    def __init__(self, client, user=None):
+        self._client = client
+        self.user = user
+        self._instances = {}
+        self._kg_instances = None
+        self._lock = threading.Lock()
+        self.kg_calls = Counter()
+        self.cache_hits = 0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @property
+    def total_kg_calls(self):
+        with self._lock:
+            return sum(self.kg_calls.values())
+
+    def _count_call(self, kind):
+        with self._lock:
+            self.kg_calls[kind] += 1
+
+    def _remember(self, instances, scope):
+        with self._lock:
+            for uri, data in instances.items():
+                self._instances[(uri, scope, False)] = data
+
+    def _is_known(self, uri, scope):
+        with self._lock:
+            return (uri, scope, False) in self._instances
+
+    def new_batch(self):
+        """
+        Return an empty identity map for the same client and user,
+        so that the instances retrieved for one batch of records can be released with it.
+        """
+        return KGIdentityMap(self._client, user=self.user)
+
+    def add_counts(self, other):
+        """Add the KG calls and cache hits of another identity map, e.g. of a finished batch, to ours"""
+        with other._lock:
+            kg_calls, cache_hits = Counter(other.kg_calls), other.cache_hits
+        with self._lock:
+            self.kg_calls.update(kg_calls)
+            self.cache_hits += cache_hits
+
+    def instance_from_full_uri(self, uri, use_cache=True, scope="released", resolved=False):
+        key = (uri, scope, resolved)
+        data = None
+        if use_cache:
+            with self._lock:
+                if key not in self._instances and not resolved:
+                    shared_data = get_shared_instance(uri)
+                    if shared_data is not None:
+                        self._instances[key] = shared_data
+                data = self._instances.get(key)
+                if data is not None:
+                    self.cache_hits += 1
+        if data is None:
+            self._count_call("instance")
+            # the wrapped client may be shared between requests, so we don't use its own cache
+            data = self._client.instance_from_full_uri(uri, use_cache=False, scope=scope, resolved=resolved)
+            if data is None:
+                # don't remember misses, the instance may be created later in this request
+                return None
+            with self._lock:
+                self._instances[key] = data
+        # fairgraph modifies instance data in place during deserialization and saving,
+        # so every caller gets its own copy
+        return deepcopy(data)
+
+    def prefetch(self, objects, scope="any", depth=2):
+        """
+        Retrieve all instances referenced by the given KG objects, up to `depth` links away,
+        and add them to the identity map.
+
+        Rather than resolving each reference separately, we collect the references for
+        a whole page of records, level by level, and retrieve each level in bulk,
+        so the number of KG calls depends on the depth of the references, not on the
+        number of records.
+        """
+        level = [obj for obj in objects if isinstance(obj, (KGObject, EmbeddedMetadata))]
+        for i in range(depth):
+            proxies = {}
+            for obj in level:
+                for proxy in find_proxies(obj):
+                    if (
+                        proxy.id
+                        and not self._is_known(proxy.id, scope)
+                        and get_shared_instance(proxy.id) is None
+                    ):
+                        proxies.setdefault(proxy.id, proxy)
+            if not proxies:
+                break
+            instances = self._instances_from_full_uris(list(proxies), scope)
+            self._remember(instances, scope)
+            level = []
+            for uri, data in instances.items():
+                obj = instantiate(proxies[uri], data, self, scope)
+                if obj is not None:
+                    level.append(obj)
+
+    def from_uuids(self, fairgraph_cls, uuids, scope="any"):
+        """
+        Retrieve the records of type `fairgraph_cls` with the given UUIDs in bulk.
+
+        The records are returned in the order of `uuids`; any that cannot be found are omitted.
+        """
+        uris = [self._client.uri_from_uuid(str(uuid)) for uuid in uuids]
+        instances = self._instances_from_full_uris(uris, scope)
+        self._remember(instances, scope)
+        objects = []
+        for uri in uris:
+            data = instances.get(uri)
+            if data is not None:
+                objects.append(fairgraph_cls.from_kg_instance(deepcopy(data), self, scope=scope))
+        return objects
+
+    def _instances_from_full_uris(self, uris, scope):
+        try:
+            if scope == "any":
+                released = self._get_by_ids(uris, "released")
+                in_progress = self._get_by_ids(uris, "in progress")
+                instances = {}
+                for uri in uris:
+                    data = released.get(uri) or in_progress.get(uri)
+                    if uri in in_progress:
+                        data.update(in_progress[uri])
+                    if data is not None:
+                        instances[uri] = data
+                return instances
+            else:
+                return self._get_by_ids(uris, scope)
+        except BulkRequestsUnsupported as err:
+            # fall back to retrieving instances individually, one call per instance
+            logger.info(f"Unable to retrieve instances in bulk: {err}")
+            instances = {}
+            for uri in uris:
+                data = self.instance_from_full_uri(uri, scope=scope)
+                if data is not None:
+                    instances[uri] = data
+            return instances
+
+    def _bulk_instances(self):
+        """
+        Return the kg_core interface used for bulk requests.
+
+        fairgraph's KGClient has no bulk equivalent of `instance_from_full_uri()`, so we build
+        a kg_core client from its host and token, once per identity map.
+        """
+        with self._lock:
+            if self._kg_instances is None:
+                if not isinstance(self._client, KGClient):
+                    raise BulkRequestsUnsupported(f"not supported by {type(self._client).__name__}")
+                self._kg_instances = kg(self._client.host).with_token(self._client.token).build().instances
+            return self._kg_instances
+
+    def _get_by_ids(self, uris, scope):
+        kg_instances = self._bulk_instances()
+        uri_map = {str(self._client.uuid_from_uri(uri)): uri for uri in uris}
+        uuids = list(uri_map)
+        instances = {}
+        for start in range(0, len(uuids), BULK_REQUEST_SIZE):
+            self._count_call("bulk")
+            response = kg_instances.get_by_ids(
+                payload=uuids[start:start + BULK_REQUEST_SIZE],
+                stage=BULK_STAGES[scope],
+                extended_response_configuration=ExtendedResponseConfiguration(return_embedded=True)
+            )
+            if response.error:
+                error_context = f"_get_by_ids(scope={scope}): {response.error}"
+                if response.error.code in BULK_UNSUPPORTED_CODES:
+                    raise BulkRequestsUnsupported(error_context)
+                elif response.error.code == 401:
+                    raise AuthenticationError(error_context)
+                elif response.error.code == 403:
+                    raise AuthorizationError(error_context)
+                else:
+                    raise Exception(f"Error: {error_context}")
+            for uuid, result in (response.data or {}).items():
+                data = result.data
+                # as in KGClient.instance_from_full_uri(), "minimal" metadata means
+                # the user does not have full access, so we count this as no data
+                if data and "http://schema.org/identifier" in data:
+                    instances[uri_map.get(uuid, uuid)] = data
+        return instances
+
+    def query(self, *args, **kwargs):
+        self._count_call("query")
+        return self._client.query(*args, **kwargs)
+
+    def list(self, *args, **kwargs):
+        self._count_call("list")
+        return self._client.list(*args, **kwargs)
+
+    def update_instance(self, instance_id, data):
+        self.forget(self._client.uri_from_uuid(instance_id))
+        return self._client.update_instance(instance_id, data)
+
+    def replace_instance(self, instance_id, data):
+        self.forget(self._client.uri_from_uuid(instance_id))
+        return self._client.replace_instance(instance_id, data)
+
+    def delete_instance(self, instance_id, ignore_not_found=True):
+        self.forget(self._client.uri_from_uuid(instance_id))
+        return self._client.delete_instance(instance_id, ignore_not_found=ignore_not_found)
+
+    def forget(self, uri):
+        """Remove an instance from the identity map, e.g. after it has been modified"""
+        with self._lock:
+            for key in [key for key in self._instances if key[0] == uri]:
+                self._instances.pop(key)
+
+    def stats(self):
+        with self._lock:
+            kg_calls = dict(self.kg_calls)
+            cache_hits = self.cache_hits
+        return {
+            "kg_calls": kg_calls,
+            "total_kg_calls": sum(kg_calls.values()),
+            "cache_hits": cache_hits,
+        }
+
+
+# fairgraph makes blocking HTTP requests, so KG calls from async code are run in these threads
+kg_executor = ThreadPoolExecutor(max_workers=settings.KG_THREAD_POOL_SIZE, thread_name_prefix="kg")
+
+
+class KGOverloaded(Exception):
+    """Raised when a KG call cannot be scheduled, because too many are already waiting"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many requests waiting for the Knowledge Graph, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+
+class FairScheduler:
+    """
+    Limits the number of KG calls in progress at any one time, queuing the excess.
+
+    When a call finishes, its slot is handed to a waiting call, taking users in turn,
+    so that one user making many requests does not hold up everyone else.
+    A call is rejected with KGOverloaded, rather than queued, if too many calls
+    (or too many from the same user) are already waiting, or if it waits longer than `timeout`.
+    """
+
+    def __init__(self, max_concurrent, max_queued, max_queued_per_user, timeout, retry_after):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.queued = 0
+        self._queues = OrderedDict()  # user: queue of waiting calls; users are served in this order
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, user=None):
+        if self.active < self.max_concurrent and self.queued == 0:
+            self.active += 1
+            self.admitted += 1
+            return
+        user_queue = self._queues.get(user, ())
+        if self.queued >= self.max_queued or len(user_queue) >= self.max_queued_per_user:
+            self.rejected += 1
+            raise KGOverloaded(self.retry_after)
+        granted = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(granted)
+        self.queued += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait({granted}, timeout=self.timeout)
+        except asyncio.CancelledError:
+            if granted.done():
+                self.release()
+            else:
+                self._remove(user, granted)
+            raise
+        if not granted.done():
+            self._remove(user, granted)
+            self.timeouts += 1
+            raise KGOverloaded(self.retry_after)
+        wait = time.monotonic() - start
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def release(self):
+        while self._queues:
+            # hand over our slot to the first call of the next user in line,
+            # who then goes to the back of the line
+            user, user_queue = next(iter(self._queues.items()))
+            granted = user_queue.popleft()
+            if user_queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self.queued -= 1
+            if not granted.done():
+                granted.set_result(None)
+                return
+        self.active -= 1
+
+    def _remove(self, user, granted):
+        user_queue = self._queues[user]
+        user_queue.remove(granted)
+        if not user_queue:
+            del self._queues[user]
+        self.queued -= 1
+
+    def metrics(self):
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": self.queued,
+            "queued_users": len(self._queues),
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "mean_wait_seconds": self.total_wait / self.admitted if self.admitted else None,
+            "max_wait_seconds": self.max_wait,
+        }
+
+
+kg_scheduler = FairScheduler(
+    max_concurrent=settings.KG_MAX_CONCURRENT_REQUESTS,
+    max_queued=settings.KG_MAX_QUEUED_REQUESTS,
+    max_queued_per_user=settings.KG_MAX_QUEUED_REQUESTS_PER_USER,
+    timeout=settings.KG_QUEUE_TIMEOUT,
+    retry_after=settings.KG_RETRY_AFTER
+)
+register_metrics("kg_scheduler", kg_scheduler.metrics)
+
+
+class AsyncKGClient:
+    """
+    Asynchronous interface to the Knowledge Graph, for use in async endpoints.
+
+    Each method runs the corresponding (blocking) fairgraph call in a worker thread,
+    so the event loop remains free to handle other requests while we wait for the KG,
+    and independent calls within a request can be made concurrently with `asyncio.gather()`.
+
+    `client` is the underlying KGIdentityMap, which may be used directly
+    from code that is already running in a worker thread.
+    `user` identifies the user on whose behalf the calls are made, for fair scheduling.
+
+    Requests for more than `max_page_size` records are split into sub-pages of that size,
+    up to `page_parallelism` of which are retrieved (or converted) at the same time,
+    and the results are reassembled in order.
+    """
+
+    def __init__(self, client, user=None, scheduler=kg_scheduler,
+                 max_page_size=settings.KG_MAX_PAGE_SIZE, page_parallelism=settings.KG_PAGE_PARALLELISM):
+        self.client = client
+        self.user = user
+        self.scheduler = scheduler
+        self.max_page_size = max_page_size
+        self.page_parallelism = page_parallelism
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking function in a worker thread, and return its result"""
+        await self.scheduler.acquire(self.user)
+        loop = asyncio.get_running_loop()
+        try:
+            future = kg_executor.submit(partial(func, *args, **kwargs))
+        except BaseException:
+            self.scheduler.release()
+            raise
+
+        # If the caller is cancelled, the worker thread carries on with the KG call,
+        # so the slot is only released once the thread has finished.
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(self.scheduler.release)
+            except RuntimeError:  # the event loop has been closed
+                self.scheduler.release()
+
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    async def _in_parallel(self, calls):
+        """Make the given calls, `page_parallelism` at a time, and return the results in order"""
+        limit = asyncio.Semaphore(self.page_parallelism)
+
+        async def limited(call):
+            async with limit:
+                return await call()
+
+        return await asyncio.gather(*(limited(call) for call in calls))
+
+    def _chunks(self, items):
+        return [items[start:start + self.max_page_size] for start in range(0, len(items), self.max_page_size)]
+
+    async def from_id(self, fairgraph_cls, id, scope="released"):
+        return await self.run(fairgraph_cls.from_id, id, self.client, scope=scope)
+
+    async def from_uuid(self, fairgraph_cls, uuid, scope="released"):
+        return await self.run(fairgraph_cls.from_uuid, uuid, self.client, scope=scope)
+
+    async def from_uuids(self, fairgraph_cls, uuids, scope="any"):
+        uuids = list(uuids)
+        if len(uuids) <= self.max_page_size:
+            return await self.run(self.client.from_uuids, fairgraph_cls, uuids, scope=scope)
+        pages = await self._in_parallel(
+            partial(self.run, self.client.from_uuids, fairgraph_cls, chunk, scope=scope)
+            for chunk in self._chunks(uuids)
+        )
+        return [obj for page in pages for obj in page]
+
+    async def by_name(self, fairgraph_cls, name, **kwargs):
+        return await self.run(fairgraph_cls.by_name, name, self.client, **kwargs)
+
+    async def list(self, fairgraph_cls, **kwargs):
+        size = kwargs.get("size")
+        if size is None or size <= self.max_page_size:
+            return await self.run(fairgraph_cls.list, self.client, **kwargs)
+        # we don't know how many records there are, so we only retrieve
+        # the remaining sub-pages if the first one is full
+        from_index = kwargs.get("from_index", 0)
+        end = from_index + size
+        first_page = await self.run(fairgraph_cls.list, self.client,
+                                    **dict(kwargs, from_index=from_index, size=self.max_page_size))
+        if len(first_page) < self.max_page_size:
+            return first_page
+        pages = await self._in_parallel(
+            partial(self.run, fairgraph_cls.list, self.client,
+                    **dict(kwargs, from_index=start, size=min(self.max_page_size, end - start)))
+            for start in range(from_index + self.max_page_size, end, self.max_page_size)
+        )
+        return first_page + [obj for page in pages for obj in page]
+
+    async def count(self, fairgraph_cls, **kwargs):
+        return await self.run(fairgraph_cls.count, self.client, **kwargs)
+
+    async def spaces(self, **kwargs):
+        return await self.run(self.client.spaces, **kwargs)
+
+    async def readable_spaces(self):
+        """The names of the KG spaces in which the user can read unreleased records"""
+        return await self.run(readable_spaces, self.user, self.client)
+
+    async def save(self, kg_object, **kwargs):
+        return await self.run(kg_object.save, self.client, **kwargs)
+
+    async def delete(self, kg_object):
+        return await self.run(kg_object.delete, self.client)
+
+    async def convert(self, pydantic_cls, kg_object):
+        """Convert a single KG object into an instance of the given API data model"""
+        return await self.run(pydantic_cls.from_kg_object, kg_object, self.client)
+
+    async def convert_all(self, pydantic_cls, kg_objects, depth=2):
+        """
+        Convert a list of KG objects into instances of the given API data model,
+        first retrieving all the instances they refer to in bulk.
+
+        Long lists are converted in sub-pages, concurrently.
+        """
+
+        def convert(objects):
+            self.client.prefetch(objects, depth=depth)
+            return [pydantic_cls.from_kg_object(obj, self.client) for obj in objects]
+
+        kg_objects = list(kg_objects)
+        if len(kg_objects) <= self.max_page_size:
+            return await self.run(convert, kg_objects)
+        pages = await self._in_parallel(partial(self.run, convert, chunk) for chunk in self._chunks(kg_objects))
+        return [obj for page in pages for obj in page]
+
+    async def iter_convert(self, pydantic_cls, kg_objects, depth=2, batch_size=settings.STREAM_BATCH_SIZE):
+        """
+        Convert KG objects into instances of the given API data model, yielding them one at a time.
+
+        The references of each batch of `batch_size` objects are retrieved in bulk,
+        and the next batch is converted while the current one is being consumed.
+        Each batch uses its own identity map, released once the batch is converted,
+        so only about two batches of converted objects, and the instances they reference,
+        are held in memory at once, whatever the page size.
+        """
+
+        def convert(objects):
+            if not isinstance(self.client, KGIdentityMap):
+                self.client.prefetch(objects, depth=depth)
+                return [pydantic_cls.from_kg_object(obj, self.client) for obj in objects]
+            batch_client = self.client.new_batch()
+            try:
+                batch_client.prefetch(objects, depth=depth)
+                return [pydantic_cls.from_kg_object(obj, batch_client) for obj in objects]
+            finally:
+                self.client.add_counts(batch_client)
+
+        pending = deque(kg_objects)
+        del kg_objects  # the objects are released as they are converted
+
+        def next_batch():
+            batch = [pending.popleft() for i in range(min(batch_size, len(pending)))]
+            return asyncio.ensure_future(self.run(convert, batch))
+
+        converting = next_batch() if pending else None
+        try:
+            while converting is not None:
+                converted = await converting
+                converting = next_batch() if pending else None
+                for obj in converted:
+                    yield obj
+        finally:
+            # e.g. if the client disconnects during streaming
+            if converting is not None:
+                converting.cancel()
+
+
+def token_expiry(token):
+    """Return the expiry time (in seconds since the epoch) of a JWT access token, or None if not known"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def token_key(token):
+    """Return a hash of a token, used to identify the user's entries in caches and pools"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def token_ttl(token, ttl):
+    """Return `ttl`, reduced if necessary so a cache entry does not outlive the token"""
+    expiry = token_expiry(token)
+    if expiry is not None:
+        ttl = min(ttl, expiry - time.time())
+    return ttl
+
+
+# names of the KG spaces each user can read, keyed by a hash of their token
+_readable_spaces = TTLCache(ttl=settings.READABLE_SPACES_TTL, max_bytes=settings.AUTH_CACHE_MAX_BYTES)
+
+
+def readable_spaces(user, client):
+    """
+    Return the names of the KG spaces in which a user, identified by a hash of their token,
+    can read unreleased as well as released records.
+    """
+    spaces = _readable_spaces.get(user) if user else None
+    if spaces is None:
+        spaces = frozenset(client.spaces(permissions=["read"], names_only=True))
+        if user:
+            _readable_spaces.put(user, spaces, size=sum(len(space) for space in spaces) or 1)
+    return spaces
+
+
+class KGClientPool:
+    """
+    Bounded LRU pool of at most `max_clients` KG clients, keyed by a hash of the user's token.
+
+    Repeated requests from the same user reuse the same client, and hence its HTTP session
+    and open connections. A client is discarded when the token expires, or after `ttl` seconds,
+    whichever comes first. The clients are shared between requests, so should always be
+    wrapped in a new KGIdentityMap for each request.
+    """
+
+    def __init__(self, factory, max_clients, ttl):
+        self._factory = factory
+        self.max_clients = max_clients
+        self._clients = TTLCache(ttl=ttl, max_entries=max_clients)
+
+    def get(self, token):
+        key = token_key(token)
+        client = self._clients.get(key)
+        if client is None:
+            client = self._factory(token)
+            self._clients.put(key, client, ttl=token_ttl(token, self._clients.ttl))
+        return client
+
+    def metrics(self):
+        metrics = self._clients.metrics()
+        return {
+            "clients": metrics["entries"],
+            "max_clients": self.max_clients,
+            "hits": metrics["hits"],
+            "misses": metrics["misses"],
+            "hit_rate": metrics["hit_rate"],
+            "evictions": metrics["evictions"],
+            "expirations": metrics["expirations"],
+        }
@@ -0,0 +1,46 @@
+"""
+Simple in-process metrics, reported by the /statistics/metrics/ endpoint
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import logging
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+_sources = {}
+
+
+def register_metrics(name, source):
+    """
+    Register a source of metrics.
+
+    `source` should be a function taking no arguments and returning a dict
+    """
+    _sources[name] = source
+
+
+def collect_metrics():
+    metrics = {}
+    for name, source in _sources.items():
+        try:
+            metrics[name] = source()
+        except Exception as err:
+            logger.warning(f"Unable to collect metrics '{name}': {err}")
+            metrics[name] = None
+    return metrics
@@ -0,0 +1,184 @@
+"""
+Classification of file URLs: which organization hosts the file,
+and the IRI, name and type of the repository which contains it.
+
+All the rules are compiled once, into a trie keyed on the URL path segments,
+so classifying a URL needs only a few dict lookups and at most one or two regular expression matches.
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+import re
+
+
+RepositoryInfo = namedtuple("RepositoryInfo", ["host", "iri", "name", "type"])
+
+
+# URL prefix: name of the hosting organization (a key of FILE_HOSTS in data_models), None if unknown
+HOST_PREFIXES = {
+    "https://object.cscs.ch": "EBRAINS",
+    "swift://cscs.ch": "EBRAINS",
+    "https://ksproxy.cscs.ch": "EBRAINS",
+    "https://kg.humanbrainproject.org/proxy/export": "EBRAINS",
+    "https://github.com": "GitHub",
+    "https://senselab.med.yale.edu": "Yale",
+    "http://modeldb.yale.edu": "Yale",
+    "http://example.com": None,
+    "https://collab.humanbrainproject.eu": "EBRAINS",
+    "collab://": "EBRAINS",
+    "https://drive.ebrains.eu": "EBRAINS",
+    "https://zenodo.org": "CERN",
+    "https://www.ebi.ac.uk": "EBI",
+    #"https://CrimsonWhite@bitbucket.org": "Bitbucket",
+    "http://cns.iaf.cnrs-gif.fr": "CNRS",
+    "https://gpfs-proxy.brainsimulation.eu/cscs": "CSCS",
+    #"https://gpfs-proxy.brainsimulation.eu/jsc": "JSC",
+    "https://data-proxy.ebrains.eu": "EBRAINS",
+}
+
+# URL prefix: repository type (a key of REPOSITORY_TYPES in data_models)
+REPOSITORY_TYPE_PREFIXES = {
+    "https://object.cscs.ch": "Swift repository",
+    "https://data-proxy.ebrains.eu": "Swift repository",
+    "https://gpfs-proxy.brainsimulation.eu": "GPFS repository",
+    "https://drive.ebrains.eu": "Seafile repository",
+    "https://gitlab.ebrains.eu": "GitLab repository",
+    "https://github.com": "GitHub repository",
+}
+
+# URL prefix: (number of path segments following the prefix which identify the repository,
+#              or None if this is variable, and a list of (pattern, IRI template, name template))
+REPOSITORY_PATTERNS = {
+    "https://object.cscs.ch": (3, [
+        (r"https://object\.cscs\.ch/v1/(?P<proj>\w+)/(?P<container_name>[\w\.-]+)/",
+         "https://object.cscs.ch/v1/{proj}/{container_name}", "{container_name}")
+    ]),
+    "https://gpfs-proxy.brainsimulation.eu": (2, [
+        (r"https://gpfs-proxy\.brainsimulation\.eu/(?P<site>\w+)/(?P<project_name>[\w-]+)/",
+         "https://gpfs-proxy.brainsimulation.eu/{site}/{project_name}", "{project_name}")
+    ]),
+    "https://gitlab.ebrains.eu": (None, [
+        (r"https://gitlab\.ebrains\.eu/(?P<org>[\w-]+)/(?P<project_name>[/\w-]+)/-/",
+         "https://gitlab.ebrains.eu/{org}/{project_name}", "{project_name}"),
+        (r"https://gitlab\.ebrains\.eu/(?P<org>[\w-]+)/(?P<project_name>[/\w-]+)",
+         "https://gitlab.ebrains.eu/{org}/{project_name}", "{project_name}"),
+    ]),
+    "https://data-proxy.ebrains.eu": (4, [
+        (r"https://data-proxy\.ebrains\.eu/api/v1/buckets/(?P<bucket_name>[\w-]+)/",
+         "https://data-proxy.ebrains.eu/api/v1/buckets/{bucket_name}", "{bucket_name}")
+    ]),
+    "https://drive.ebrains.eu": (0, [
+        (r"https://drive\.ebrains\.eu", "https://drive.ebrains.eu", "EBRAINS Drive")
+    ]),
+}
+
+
+def _split_prefix(prefix):
+    # "https://github.com" -> ["https:", "", "github.com"]
+    return prefix.rstrip("/").split("/")
+
+
+class PrefixTrie:
+    """
+    Maps URL prefixes to dicts of attributes, matching on whole path segments.
+
+    Looking up a URL returns the attributes of all matching prefixes,
+    with those of longer prefixes taking precedence.
+    """
+
+    _attributes = object()  # key for the attributes of a node, distinct from any path segment
+
+    def __init__(self):
+        self._root = {}
+        self.max_depth = 0
+
+    def add(self, prefix, **attributes):
+        segments = _split_prefix(prefix)
+        node = self._root
+        for segment in segments:
+            node = node.setdefault(segment, {})
+        node.setdefault(self._attributes, {}).update(attributes)
+        self.max_depth = max(self.max_depth, len(segments))
+
+    def match(self, url):
+        attributes = {}
+        node = self._root
+        for segment in url.split("/", self.max_depth):
+            node = node.get(segment)
+            if node is None:
+                break
+            attributes.update(node.get(self._attributes, {}))
+        return attributes
+
+
+def _build_trie():
+    trie = PrefixTrie()
+    for prefix, host in HOST_PREFIXES.items():
+        trie.add(prefix, host=host)
+    for prefix, repository_type in REPOSITORY_TYPE_PREFIXES.items():
+        trie.add(prefix, type=repository_type)
+    for prefix, (depth, patterns) in REPOSITORY_PATTERNS.items():
+        trie.add(
+            prefix,
+            repository_depth=len(_split_prefix(prefix)) + depth if depth is not None else None,
+            repository_patterns=[
+                (re.compile(pattern), iri_template, name_template)
+                for pattern, iri_template, name_template in patterns
+            ]
+        )
+    return trie
+
+
+_trie = _build_trie()
+
+
+def _repository_prefix(url, depth):
+    """Return the part of the URL which identifies the repository (plus a trailing slash, if present)"""
+    if depth is None:
+        return url
+    segments = url.split("/", depth)
+    if len(segments) > depth:
+        return url[:-len(segments[-1])] if segments[-1] else url
+    return url
+
+
+@lru_cache(maxsize=1024)
+def _match_repository(repository_prefix):
+    patterns = _trie.match(repository_prefix).get("repository_patterns", ())
+    for pattern, iri_template, name_template in patterns:
+        match = pattern.match(repository_prefix)
+        if match:
+            groups = match.groupdict()
+            return iri_template.format(**groups), name_template.format(**groups)
+    return None, None
+
+
+def classify_url(url):
+    """
+    Return the hosting organization name, repository IRI, repository name
+    and repository type name for a file URL, as a RepositoryInfo tuple.
+
+    Elements which cannot be determined from the URL are None.
+    """
+    attributes = _trie.match(url)
+    if "repository_patterns" in attributes:
+        iri, name = _match_repository(_repository_prefix(url, attributes["repository_depth"]))
+    else:
+        iri, name = None, None
+    return RepositoryInfo(attributes.get("host"), iri, name, attributes.get("type"))
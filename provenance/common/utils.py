@@ -1,22 +1,154 @@
+from functools import wraps
 from uuid import uuid4
+import hashlib
 import itertools
-from fastapi import HTTPException, status
+import json
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
 
 import fairgraph.openminds.computation as omcmp
 import fairgraph.errors
 from fairgraph.base import as_list
 
-from ..auth.utils import get_kg_client_for_user_account, is_collab_admin
+from ..auth.utils import (
+    get_async_kg_client_for_user_account, get_readable_spaces, is_collab_admin, token_key, access_key
+)
+from .cache import TTLCache, SingleFlight
+from .indexes import environment_index, record_index
+from .metrics import register_metrics
+from .. import settings
 
 
+# Converted records, shared between users with the same access to the KG, since references to
+# other instances are resolved with the permissions of the user for whom the record was converted.
+# Keys are (record type, id, revision, access key), values are records.
+RESPONSE_CACHE = TTLCache(ttl=settings.RESPONSE_CACHE_TTL, max_bytes=settings.RESPONSE_CACHE_MAX_BYTES)
+register_metrics("response_cache", RESPONSE_CACHE.metrics)
 
-def create_computation(pydantic_cls, fairgraph_cls, pydantic_obj, space, token):
-    kg_client = get_kg_client_for_user_account(token.credentials)
+# identical read requests which arrive while the first is still being handled share its result
+REQUEST_COALESCER = SingleFlight()
+register_metrics("request_coalescing", REQUEST_COALESCER.metrics)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def _hashable(value):
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, Request):
+        return str(value.url)
+    return value
+
+
+def coalesce_requests(endpoint):
+    """
+    Decorator for async read-only endpoints.
+
+    Concurrent calls with the same parameters, from the same user, share a single computation.
+    The user's token is part of the key, so a result is only ever shared with
+    requests that have exactly the same permissions.
+    If the endpoint takes a `response` argument, any headers it sets are copied
+    to the responses of all the requests sharing the result.
+    Streamed responses can only be sent once, so requests for them are never coalesced.
+    """
+    @wraps(endpoint)
+    async def wrapper(**kwargs):
+        request = kwargs.get("request")
+        if request is not None and accepts_ndjson(request):
+            return await endpoint(**kwargs)
+        token = kwargs.get("token")
+        response = kwargs.get("response")
+        params = tuple(sorted(
+            (name, _hashable(value)) for name, value in kwargs.items() if name not in ("token", "response")
+        ))
+        key = (
+            endpoint.__module__,
+            endpoint.__name__,
+            token_key(token.credentials) if token else None,
+            params
+        )
+        if response is None:
+            return await REQUEST_COALESCER.do(key, lambda: endpoint(**kwargs))
+
+        async def call_endpoint():
+            shared_response = Response()
+            del shared_response.headers["content-length"]
+            result = await endpoint(**dict(kwargs, response=shared_response))
+            return result, shared_response.headers.raw
+
+        result, raw_headers = await REQUEST_COALESCER.do(key, call_endpoint)
+        response.headers.raw.extend(raw_headers)
+        return result
+    return wrapper
+
+
+def accepts_ndjson(request):
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def list_response(request, kg, pydantic_cls, kg_objects, response=None, depth=2):
+    """
+    Convert the KG objects for a list endpoint into instances of the given API data model.
+
+    If the client accepts newline-delimited JSON, the records are converted and sent
+    one at a time as a streamed response, rather than as a single JSON list,
+    so the first record is sent as soon as it has been converted.
+    Any headers already set on `response` are included in the streamed response.
+    """
+    if not accepts_ndjson(request):
+        return await kg.convert_all(pydantic_cls, kg_objects, depth=depth)
+    converted = kg.iter_convert(pydantic_cls, kg_objects, depth=depth)
+
+    async def lines():
+        async for obj in converted:
+            yield obj.json(by_alias=True) + "\n"
+
+    headers = dict(response.headers) if response is not None else None
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+def get_revision(kg_object):
+    """
+    Return an identifier for the current revision of a KG object:
+    the revision given by the KG if available, otherwise a hash of the instance data.
+    """
+    data = kg_object.data or {}
+    revision = data.get("https://core.kg.ebrains.eu/vocab/meta/revision")
+    if revision:
+        return revision
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+async def retrieve_computation(pydantic_cls, fairgraph_cls, computation_type, computation_id, token):
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    try:
+        kg_computation_object = await kg.from_uuid(fairgraph_cls, str(computation_id), scope="any")
+    except fairgraph.errors.AuthenticationError:
+        raise AuthenticationError()
+    except TypeError:
+        raise NotFoundError(computation_type, computation_id)
+    if kg_computation_object is None:
+        raise NotFoundError(computation_type, computation_id)
+    # we may already have converted this revision of the record, for this user or another with the same access
+    readable_spaces = await kg.run(get_readable_spaces, token.credentials, kg.client)
+    cache_key = (
+        pydantic_cls.__name__,
+        str(computation_id),
+        get_revision(kg_computation_object),
+        access_key(token.credentials, readable_spaces)
+    )
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        return cached.copy(deep=True)
+    pydantic_obj = await kg.convert(pydantic_cls, kg_computation_object)
+    RESPONSE_CACHE.put(cache_key, pydantic_obj.copy(deep=True), size=len(pydantic_obj.json()))
+    return pydantic_obj
+
+
+async def create_computation(pydantic_cls, fairgraph_cls, pydantic_obj, space, token):
+    kg = get_async_kg_client_for_user_account(token.credentials)
     if pydantic_obj.id is not None:
-        try:
-            kg_computation_object = fairgraph_cls.from_uuid(str(pydantic_obj.id), kg_client, scope="any")
-        except fairgraph.errors.AuthenticationError:
-            raise AuthenticationError()
+        kg_computation_object = await get_existing_computation(kg, fairgraph_cls, pydantic_obj.id)
         if kg_computation_object is not None:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -24,76 +156,92 @@ def create_computation(pydantic_cls, fairgraph_cls, pydantic_obj, space, token):
                         "The POST endpoint cannot be used to modify an existing computation record.",
             )
     pydantic_obj.id = uuid4()
-    kg_computation_object = pydantic_obj.to_kg_object(kg_client)
+
+    def create():
+        kg_computation_object = pydantic_obj.to_kg_object(kg.client)
+        kg_computation_object.save(kg.client, space=space, recursive=True)
+        return kg_computation_object, pydantic_cls.from_kg_object(kg_computation_object, kg.client)
+
     try:
-        kg_computation_object.save(kg_client, space=space, recursive=True)
+        kg_computation_object, result = await kg.run(create)
     except fairgraph.errors.AuthenticationError:
-            raise AuthenticationError()
-    return pydantic_cls.from_kg_object(kg_computation_object, kg_client)
+        raise AuthenticationError()
+    update_indexes(kg, kg_computation_object, space)
+    return result
+
 
+def update_indexes(kg, kg_computation_object, space):
+    """Keep the in-memory indexes up to date with a computation record saved through this API"""
+    environment = getattr(kg_computation_object, "environment", None)
+    if isinstance(environment, omcmp.Environment):
+        environment_index.add(kg.user, getattr(environment, "space", None) or space, environment)
+    record_index.put(kg.user, space, kg_computation_object)
 
 
-def replace_computation(pydantic_cls, fairgraph_cls, computation_id, pydantic_obj, token):
-    kg_client = get_kg_client_for_user_account(token.credentials)
+async def get_existing_computation(kg, fairgraph_cls, computation_id):
     try:
-        kg_computation_object = fairgraph_cls.from_uuid(str(computation_id), kg_client, scope="any")
+        return await kg.from_uuid(fairgraph_cls, str(computation_id), scope="any")
     except fairgraph.errors.AuthenticationError:
         raise AuthenticationError()
 
-    if not (kg_computation_object.space == "myspace" or is_collab_admin(kg_computation_object.space, token.credentials)):
+
+async def check_can_modify(kg_computation_object, token, action):
+    if not (kg_computation_object.space == "myspace"
+            or await is_collab_admin(kg_computation_object.space, token.credentials)):
         raise HTTPException(
             status_code=403,
-            detail="You can only replace provenance records in your private space "
-                   "or in collab spaces for which you are an administrator."
+            detail=f"You can only {action} provenance records in your private space "
+                    "or in collab spaces for which you are an administrator."
         )
+
+
+async def replace_computation(pydantic_cls, fairgraph_cls, computation_id, pydantic_obj, token):
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    kg_computation_object = await get_existing_computation(kg, fairgraph_cls, computation_id)
+    await check_can_modify(kg_computation_object, token, "replace")
     if pydantic_obj.id is not None and pydantic_obj.id != computation_id:
         raise HTTPException(
             status_code=400,
             detail="The ID of the payload does not match the URL"
         )
-    kg_computation_obj_new = pydantic_obj.to_kg_object(kg_client)
-    kg_computation_obj_new.id = kg_computation_object.id
-    kg_computation_obj_new.save(kg_client, space=kg_computation_object.space, recursive=True, replace=True)
-    return pydantic_cls.from_kg_object(kg_computation_obj_new, kg_client)
 
+    def replace():
+        kg_computation_obj_new = pydantic_obj.to_kg_object(kg.client)
+        kg_computation_obj_new.id = kg_computation_object.id
+        kg_computation_obj_new.save(kg.client, space=kg_computation_object.space, recursive=True, replace=True)
+        return kg_computation_obj_new, pydantic_cls.from_kg_object(kg_computation_obj_new, kg.client)
 
-def patch_computation(pydantic_cls, fairgraph_cls, computation_id, patch, token):
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        kg_computation_object = fairgraph_cls.from_uuid(str(computation_id), kg_client, scope="any")
-    except fairgraph.errors.AuthenticationError:
-        raise AuthenticationError()
+    kg_computation_obj_new, result = await kg.run(replace)
+    update_indexes(kg, kg_computation_obj_new, kg_computation_object.space)
+    return result
 
-    if not (kg_computation_object.space == "myspace" or is_collab_admin(kg_computation_object.space, token.credentials)):
-        raise HTTPException(
-            status_code=403,
-            detail="You can only modify provenance records in your private space "
-                   "or in collab spaces for which you are an administrator."
-        )
+
+async def patch_computation(pydantic_cls, fairgraph_cls, computation_id, patch, token):
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    kg_computation_object = await get_existing_computation(kg, fairgraph_cls, computation_id)
+    await check_can_modify(kg_computation_object, token, "modify")
     if patch.id is not None and patch.id != computation_id:
         raise HTTPException(
             status_code=400,
             detail="Modifying the record ID is not permitted."
         )
-    kg_computation_obj_updated = patch.apply_to_kg_object(kg_computation_object, kg_client)
-    kg_computation_obj_updated.save(kg_client, space=kg_computation_object.space, recursive=True)
-    return pydantic_cls.from_kg_object(kg_computation_obj_updated, kg_client)
 
+    def update():
+        kg_computation_obj_updated = patch.apply_to_kg_object(kg_computation_object, kg.client)
+        kg_computation_obj_updated.save(kg.client, space=kg_computation_object.space, recursive=True)
+        return kg_computation_obj_updated, pydantic_cls.from_kg_object(kg_computation_obj_updated, kg.client)
 
-def delete_computation(fairgraph_cls, computation_id, token):
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        kg_computation_object = fairgraph_cls.from_uuid(str(computation_id), kg_client, scope="any")
-    except fairgraph.errors.AuthenticationError:
-        raise AuthenticationError()
+    kg_computation_obj_updated, result = await kg.run(update)
+    update_indexes(kg, kg_computation_obj_updated, kg_computation_object.space)
+    return result
 
-    if not (kg_computation_object.space == "myspace" or is_collab_admin(kg_computation_object.space, token.credentials)):
-        raise HTTPException(
-            status_code=403,
-            detail="You can only delete provenance records in your private space "
-                   "or in collab spaces for which you are an administrator."
-        )
-    kg_computation_object.delete(kg_client)
+
+async def delete_computation(fairgraph_cls, computation_id, token):
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    kg_computation_object = await get_existing_computation(kg, fairgraph_cls, computation_id)
+    await check_can_modify(kg_computation_object, token, "delete")
+    await kg.delete(kg_computation_object)
+    record_index.remove(kg.user, kg_computation_object.space, kg_computation_object)
 
 
 def invert_dict(D):
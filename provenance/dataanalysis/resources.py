@@ -20,23 +20,25 @@ docstring goes here
 
 from typing import List
 from uuid import UUID
+from datetime import datetime
 import logging
 
 
-from fastapi import APIRouter, Depends, Header, Query, HTTPException, status as status_codes
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request, Response, status as status_codes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from fairgraph.base import as_list
 import fairgraph.openminds.core as omcore
 import fairgraph.openminds.computation as omcmp
 
-from ..auth.utils import get_kg_client_for_user_account
+from ..auth.utils import get_async_kg_client_for_user_account
 
 from .data_models import DataAnalysis, DataAnalysisPatch
-from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES
+from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES, SortOrder
+from ..common.filters import build_filters, list_computations, set_next_link
 from ..common.utils import (
-    create_computation, replace_computation, patch_computation,
-    delete_computation, NotFoundError, expand_combinations
+    create_computation, retrieve_computation, replace_computation, patch_computation,
+    delete_computation, NotFoundError, coalesce_requests, list_response
 )
 
 
@@ -47,7 +49,10 @@ router = APIRouter()
 
 
 @router.get("/analyses/", response_model=List[DataAnalysis])
-def query_analyses(
+@coalesce_requests
+async def query_analyses(
+    request: Request,
+    response: Response,
     dataset: UUID = Query(None, description="Return analyses of this dataset"),
     simulation: UUID = Query(None, description="Return analyses of results from this simulation"),
     input_data: UUID = Query(None, description="Return analyses of a given data file or directory containing data files"),
@@ -56,8 +61,15 @@ def query_analyses(
     space: str = Query(None, description="Knowledge Graph space to search in"),
     status: Status = Query(None, description="Return analyses with this status"),
     tags: List[str] = Query(None, description="Return analyses with _all_ of these tags"),
+    started_after: datetime = Query(None, description="Return analyses that started at or after this time"),
+    started_before: datetime = Query(None, description="Return analyses that started before this time"),
+    ended_after: datetime = Query(None, description="Return analyses that ended at or after this time"),
+    order_by: SortOrder = Query(None, description="Sort by start or end time; '-' for most recent first "
+                                                  "(default '-start_time' when filtering by tag or time)"),
     size: int = Query(100, description="Number of records to return"),
-    from_index: int = Query(0, description="Index of the first record to return"),
+    cursor: str = Query(None, description="Position in the results, from the 'next' link of the previous page"),
+    from_index: int = Query(0, description="Index of the first record to return (use 'cursor' instead)",
+                            deprecated=True),
     # from header
     token: HTTPAuthorizationCredentials = Depends(auth),
 
@@ -69,91 +81,27 @@ def query_analyses(
     e.g. software=<UUID for Elephant v0.9.0>&platform=pizdaint returns
     data analyses that used Elephant v0.9.0 and that ran on Piz Daint.
 
+    When filtering by tag or time, the most recently started data analyses are returned first,
+    unless another order is requested.
+    If there are further results, the response has a `Link` header with the URL of the next page.
+
     The list may contain records of data analyses that are public, were performed by the logged-in user,
     or that are associated with a collab of which the user is a member.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    # todo: add cross-link queries to fairgraph
-    filters = {
-        "inputs": [],
-        "environment": []
-    }
-    if dataset:
-        dataset_obj = omcore.DatasetVersion.from_id(str(dataset), kg_client)
-        if dataset_obj is None:
-            raise HTTPException(
-                status_code=status_codes.HTTP_404_NOT_FOUND,
-                detail="No such dataset"
-            )
-        files = omcore.File.list(kg_client, file_repository=dataset_obj.repository)
-        if len(files) > 100:  # todo: figure out what a reasonable limit is
-            raise HTTPException(
-                status_code=status_codes.HTTP_400_BAD_REQUEST,
-                detail="This dataset has too many files for this query"
-            )
-        if len(files) > 0:
-            filters["inputs"].extend(as_list(files))
-        # todo: support FileBundle
-    # filter by simulation
-    if simulation:
-        # todo: add a query for released simulations
-        simulation_obj = omcmp.Simulation.from_id(str(simulation), kg_client, scope="any")
-        if simulation_obj is None:
-            raise HTTPException(
-                status_code=status_codes.HTTP_404_NOT_FOUND,
-                detail="No such simulation, or you don't have access."
-            )
-        filters["inputs"].extend(as_list(simulation_obj.outputs))
-    # filter by input_data
-    if input_data:
-        filters["inputs"].extend(as_list(input_data))
-    # filter by software
-    if software:
-        filters["inputs"].extend(as_list(software))
-        environments = omcmp.Environment.list(kg_client, software=software, scope="any", space=space)
-        filters["environment"].extend(as_list(environments))
-    # filter by hardware platform
-    if platform:
-        hardware_obj = omcmp.HardwareSystem.by_name(platform.value, kg_client, scope="any", space="common")
-        # todo: handle different versions of hardware platforms
-        environments = omcmp.Environment.list(kg_client, hardware=hardware_obj, scope="any", space=space)
-        filters["environment"].extend(as_list(environments))
-    # filter by status
-    if status:
-        filters["status"] = ACTION_STATUS_TYPES[status.value]
-    # filter by tag
-    if tags:
-        filters["tags"] = tags
-
-    for key in ("inputs", "environment"):
-        if key in filters and len(filters[key]) == 0:
-            del filters[key]
-
-    filters = expand_combinations(filters)
-
-    if len(filters) == 1:
-        # common, simple case
-        data_analysis_objects = omcmp.DataAnalysis.list(kg_client, scope="any", api="query",
-                                                        size=size, from_index=from_index,
-                                                        space=space, **filters[0])
-    else:
-        # more complex case for pagination
-        # inefficient if from_index is not 0
-        data_analysis_objects = {}
-        for filter in filters:
-            results = omcmp.DataAnalysis.list(kg_client, scope="any", api="query",
-                                              size=size, from_index=from_index,
-                                              space=space, **filter)
-            for result in results:
-                data_analysis_objects[result.uuid] = result  # use dict to remove duplicates
-
-        data_analysis_objects = data_analysis_objects.values()
-
-    return [DataAnalysis.from_kg_object(obj, kg_client) for obj in data_analysis_objects]
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    filters = await build_filters(kg, space=space, dataset=dataset, simulation=simulation,
+                                  input_data=input_data, software=software, platform=platform,
+                                  status=status, tags=tags, started_after=started_after,
+                                  started_before=started_before, ended_after=ended_after,
+                                  order_by=order_by, cursor=cursor)
+    data_analysis_objects = await list_computations(kg, omcmp.DataAnalysis, filters, space=space,
+                                                    size=size, from_index=from_index)
+    set_next_link(request, response, filters)
+    return await list_response(request, kg, DataAnalysis, data_analysis_objects, response=response)
 
 
 @router.post("/analyses/", response_model=DataAnalysis, status_code=status_codes.HTTP_201_CREATED)
-def create_data_analysis(
+async def create_data_analysis(
     data_analysis: DataAnalysis,
     space: str = "myspace",
     token: HTTPAuthorizationCredentials = Depends(auth)
@@ -161,29 +109,23 @@ def create_data_analysis(
     """
     Store a new record of a data analysis stage in the Knowledge Graph.
     """
-    return create_computation(DataAnalysis, omcmp.DataAnalysis, data_analysis, space, token)
+    return await create_computation(DataAnalysis, omcmp.DataAnalysis, data_analysis, space, token)
 
 
 @router.get("/analyses/{analysis_id}", response_model=DataAnalysis)
-def get_data_analysis(analysis_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+@coalesce_requests
+async def get_data_analysis(analysis_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Retrieve a specific data analysis record, identified by its ID.
 
     You may only retrieve public records, records in your private space,
     or records associated with a collab which you can view.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        data_analysis_object = omcmp.DataAnalysis.from_uuid(str(analysis_id), kg_client, scope="any")
-    except TypeError as err:
-        raise NotFoundError("data analysis", analysis_id)
-    if data_analysis_object is None:
-        raise NotFoundError("data analysis", analysis_id)
-    return DataAnalysis.from_kg_object(data_analysis_object, kg_client)
+    return await retrieve_computation(DataAnalysis, omcmp.DataAnalysis, "data analysis", analysis_id, token)
 
 
 @router.put("/analyses/{analysis_id}", response_model=DataAnalysis)
-def replace_data_analysis(
+async def replace_data_analysis(
     analysis_id: UUID,
     data_analysis: DataAnalysis,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -194,11 +136,11 @@ def replace_data_analysis(
     You may only replace records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return replace_computation(DataAnalysis, omcmp.DataAnalysis, analysis_id, data_analysis, token)
+    return await replace_computation(DataAnalysis, omcmp.DataAnalysis, analysis_id, data_analysis, token)
 
 
 @router.patch("/analyses/{analysis_id}", response_model=DataAnalysis)
-def update_data_analysis(
+async def update_data_analysis(
     analysis_id: UUID,
     patch: DataAnalysisPatch,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -209,15 +151,15 @@ def update_data_analysis(
     You may only update records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return patch_computation(DataAnalysis, omcmp.DataAnalysis, analysis_id, patch, token)
+    return await patch_computation(DataAnalysis, omcmp.DataAnalysis, analysis_id, patch, token)
 
 
 @router.delete("/analyses/{analysis_id}")
-def delete_data_analysis(analysis_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+async def delete_data_analysis(analysis_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Delete a data analysis record.
 
     You may only delete records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return delete_computation(omcmp.DataAnalysis, analysis_id, token)
+    return await delete_computation(omcmp.DataAnalysis, analysis_id, token)
@@ -26,7 +26,7 @@ import logging
 from itertools import chain
 
 
-from fastapi import APIRouter, Depends, Header, Query, HTTPException, status as status_codes
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request, Response, status as status_codes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import ValidationError
 
@@ -34,11 +34,15 @@ from fairgraph.base import as_list
 import fairgraph.openminds.core as omcore
 import fairgraph.openminds.computation as omcmp
 
-from ..auth.utils import get_kg_client_for_user_account
+from ..auth.utils import get_async_kg_client_for_user_account
 
 from .data_models import GenericComputation, GenericComputationPatch
-from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES
-from ..common.utils import create_computation, replace_computation, patch_computation, delete_computation, NotFoundError
+from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES, SortOrder
+from ..common.filters import build_filters, list_computations, set_next_link
+from ..common.utils import (
+    create_computation, retrieve_computation, replace_computation, patch_computation, delete_computation,
+    NotFoundError, coalesce_requests, list_response
+)
 from .. import settings
 
 
@@ -49,15 +53,25 @@ router = APIRouter()
 
 
 @router.get("/miscellaneous/", response_model=List[GenericComputation])
-def query_miscellaneous(
+@coalesce_requests
+async def query_miscellaneous(
+    request: Request,
+    response: Response,
     input_data: UUID = Query(None, description="Return computations using a given data file or directory containing data files"),
     software: UUID = Query(None, description="Return computations that used a specific software version"),
     platform: HardwareSystem = Query(None, description="Return computations that ran on this hardware platform"),
     space: str = Query(None, description="Knowledge Graph space to search in"),
     status: Status = Query(None, description="Return computations with this status"),
     tags: List[str] = Query(None, description="Return computations with _all_ of these tags"),
+    started_after: datetime = Query(None, description="Return computations that started at or after this time"),
+    started_before: datetime = Query(None, description="Return computations that started before this time"),
+    ended_after: datetime = Query(None, description="Return computations that ended at or after this time"),
+    order_by: SortOrder = Query(None, description="Sort by start or end time; '-' for most recent first "
+                                                  "(default '-start_time' when filtering by tag or time)"),
     size: int = Query(100, description="Number of records to return"),
-    from_index: int = Query(0, description="Index of the first record to return"),
+    cursor: str = Query(None, description="Position in the results, from the 'next' link of the previous page"),
+    from_index: int = Query(0, description="Index of the first record to return (use 'cursor' instead)",
+                            deprecated=True),
     # from header
     token: HTTPAuthorizationCredentials = Depends(auth),
 
@@ -71,73 +85,27 @@ def query_miscellaneous(
     e.g. software=<UUID for Elephant v0.9.0>&platform=pizdaint returns
     computations that used Elephant v0.9.0 and that ran on Piz Daint.
 
+    When filtering by tag or time, the most recently started computations are returned first,
+    unless another order is requested.
+    If there are further results, the response has a `Link` header with the URL of the next page.
+
     The list may contain records of computations that are public, were performed by the logged-in user,
     or that are associated with a collab of which the user is a member.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    # filters = {
-    #     "inputs": [],
-    #     "environment": []
-    # }
-    # if dataset:
-    #     dataset_obj = omcore.DatasetVersion.from_id(str(dataset), kg_client)
-    #     if dataset_obj is None:
-    #         raise HTTPException(
-    #             status_code=status_codes.HTTP_404_NOT_FOUND,
-    #             detail="No such dataset"
-    #         )
-    #     files = omcore.File.list(kg_client, file_repository=dataset_obj.repository)
-    #     if len(files) > 100:  # todo: figure out what a reasonable limit is
-    #         raise HTTPException(
-    #             status_code=status_codes.HTTP_400_BAD_REQUEST,
-    #             detail="This dataset has too many files for this query"
-    #         )
-    #     if len(files) > 0:
-    #         filters["inputs"].extend(as_list(files))
-    #     # todo: support FileBundle
-    # # filter by simulation
-    # if simulation:
-    #     # todo: add a query for released simulations
-    #     simulation_obj = omcmp.Simulation.from_id(str(simulation), kg_client, scope="any")
-    #     if simulation_obj is None:
-    #         raise HTTPException(
-    #             status_code=status_codes.HTTP_404_NOT_FOUND,
-    #             detail="No such simulation, or you don't have access."
-    #         )
-    #     filters["inputs"].extend(as_list(simulation_obj.outputs))
-    # # filter by input_data
-    # if input_data:
-    #     filters["inputs"].extend(as_list(input_data))
-    # # filter by software
-    # if software:
-    #     filters["inputs"].extend(as_list(software))
-    #     environments = omcmp.Environment.list(kg_client, software=software, scope="any", space=space)
-    #     filters["environment"].extend(as_list(environments))
-    # # filter by hardware platform
-    # if platform:
-    #     hardware_obj = omcmp.HardwareSystem.by_name(platform.value, kg_client, scope="any", space="common")
-    #     # todo: handle different versions of hardware platforms
-    #     environments = omcmp.Environment.list(kg_client, hardware=hardware_obj, scope="any", space=space)
-    #     filters["environment"].extend(as_list(environments))
-    # # filter by status
-    # if status:
-    #     filters["status"] = ACTION_STATUS_TYPES[status.value]
-    # # filter by tag
-    # if tags:
-    #     filters["tags"] = tags
-
-    # for key in ("inputs", "environment"):
-    #     if key in filters and len(filters[key]) == 0:
-    #         del filters[key]
-
-    # computation_objects = omcmp.GenericComputation.list(kg_client, scope="any", api="query",
-    #                                                 size=size, from_index=from_index,
-    #                                                 space=space)
-    # return [obj.from_kg_object(kg_client) for obj in computation_objects]
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    filters = await build_filters(kg, space=space, input_data=input_data, software=software,
+                                  platform=platform, status=status, tags=tags,
+                                  started_after=started_after, started_before=started_before,
+                                  ended_after=ended_after, order_by=order_by,
+                                  cursor=cursor)
+    computation_objects = await list_computations(kg, omcmp.GenericComputation, filters, space=space,
+                                                  size=size, from_index=from_index)
+    set_next_link(request, response, filters)
+    return await list_response(request, kg, GenericComputation, computation_objects, response=response)
 
 
 @router.post("/miscellaneous/", response_model=GenericComputation, status_code=status_codes.HTTP_201_CREATED)
-def create_computation(
+async def create_generic_computation(
     computation: GenericComputation,
     space: str = "myspace",
     token: HTTPAuthorizationCredentials = Depends(auth)
@@ -145,29 +113,23 @@ def create_computation(
     """
     Store a new record of a miscellaneous computation stage in the Knowledge Graph.
     """
-    return create_computation(GenericComputation, omcmp.GenericComputation, computation, space, token)
+    return await create_computation(GenericComputation, omcmp.GenericComputation, computation, space, token)
 
 
 @router.get("/miscellaneous/{computation_id}", response_model=GenericComputation)
-def get_computation(computation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+@coalesce_requests
+async def get_generic_computation(computation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Retrieve a specific miscellaneous computation record, identified by its ID.
 
     You may only retrieve public records, records in your private space,
     or records associated with a collab which you can view.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        computation_object = omcmp.GenericComputation.from_uuid(str(computation_id), kg_client, scope="any")
-    except TypeError as err:
-        raise NotFoundError("computation", computation_id)
-    if computation_object is None:
-        raise NotFoundError("computation", computation_id)
-    return GenericComputation.from_kg_object(computation_object, kg_client)
+    return await retrieve_computation(GenericComputation, omcmp.GenericComputation, "computation", computation_id, token)
 
 
 @router.put("/miscellaneous/{computation_id}", response_model=GenericComputation)
-def replace_computation(
+async def replace_generic_computation(
     computation_id: UUID,
     computation: GenericComputation,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -178,11 +140,11 @@ def replace_computation(
     You may only replace records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return replace_computation(GenericComputation, omcmp.GenericComputation, computation_id, computation, token)
+    return await replace_computation(GenericComputation, omcmp.GenericComputation, computation_id, computation, token)
 
 
 @router.patch("/miscellaneous/{computation_id}", response_model=GenericComputation)
-def update_computation(
+async def update_generic_computation(
     computation_id: UUID,
     patch: GenericComputationPatch,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -193,15 +155,15 @@ def update_computation(
     You may only update records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return patch_computation(GenericComputation, omcmp.GenericComputation, computation_id, patch, token)
+    return await patch_computation(GenericComputation, omcmp.GenericComputation, computation_id, patch, token)
 
 
 @router.delete("/analyses/{computation_id}", response_model=GenericComputation)
-def delete_computation(computation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+async def delete_generic_computation(computation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Delete a miscellaneous computation record.
 
     You may only delete records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return delete_computation(omcmp.GenericComputation, computation_id, token)
+    return await delete_computation(omcmp.GenericComputation, computation_id, token)
@@ -1,6 +1,11 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.cors import CORSMiddleware
+import fairgraph.errors
 
 from . import (
     settings,
@@ -14,7 +19,14 @@ from . import (
     recipes,
     auth,
     statistics,
+    vocab,
 )
+from .common.data_models import VOCABULARIES
+from .vocab.snapshot import refresh_snapshot
+from .auth import http_client
+from .common.kg_client import KGOverloaded
+
+logger = logging.getLogger("ebrains-prov-api")
 
 description = """
 This is a first release candidate, more testing is needed before the first release.
@@ -33,6 +45,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Link"],  # links to the next page of results
 )
 
 app.include_router(recipes.router, tags=["Workflow Recipes"])
@@ -45,4 +58,50 @@ app.include_router(optimisation.router, tags=["Optimisation"])
 app.include_router(datacopy.router, tags=["Data transfer"])
 app.include_router(generic.router, tags=["Unclassified"])
 app.include_router(auth.router, tags=["Authentication and authorization"])
-#app.include_router(vocab.router, tags=["Controlled vocabularies"])
+app.include_router(vocab.router, tags=["Controlled vocabularies"])
+
+
+@app.exception_handler(KGOverloaded)
+async def kg_overloaded_handler(request: Request, exc: KGOverloaded):
+    # fail fast, rather than letting requests pile up while the KG is busy
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+@app.exception_handler(fairgraph.errors.AuthenticationError)
+async def kg_authentication_error_handler(request: Request, exc: fairgraph.errors.AuthenticationError):
+    # e.g. an expired token, when the KG is queried outside an endpoint's own error handling
+    return JSONResponse(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        content={"detail": "Unauthorized request. Have you supplied a valid token?"}
+    )
+
+
+@app.on_event("startup")
+async def schedule_vocabulary_snapshot_refresh():
+    # vocabularies are loaded from the on-disk snapshot, if we want them to stay fresh
+    # we update the snapshot in the background, ready for the next time the workers start
+    if settings.VOCAB_SNAPSHOT_REFRESH:
+        asyncio.get_running_loop().run_in_executor(None, _refresh_vocabulary_snapshot)
+
+
+def _refresh_vocabulary_snapshot():
+    try:
+        refresh_snapshot()
+    except Exception as err:
+        logger.warning(f"Unable to refresh vocabulary snapshot: {err}")
+
+
+@app.on_event("startup")
+async def schedule_vocabulary_refresh():
+    # keep the in-memory vocabularies up-to-date, without needing to restart the workers
+    if settings.VOCAB_REFRESH_INTERVAL > 0:
+        asyncio.create_task(VOCABULARIES.refresh_periodically(settings.VOCAB_REFRESH_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.close_client()
@@ -7,10 +7,8 @@ from pydantic import AnyHttpUrl, AnyUrl, BaseModel, Field
 
 from fairgraph.base import as_list, IRI
 import fairgraph.openminds.core as omcore
-import fairgraph.openminds.controlledterms as omterms
 import fairgraph.openminds.computation as omcmp
-from ..common.data_models import (Person, get_repository_host, get_repository_iri,
-                                  get_repository_name, get_repository_type)
+from ..common.data_models import Person, get_file_repository, get_content_type, resolve_controlled_term
 from ..common.utils import invert_dict, collab_id_from_space
 
 
@@ -68,7 +66,7 @@ class WorkflowRecipe(BaseModel):
                           for p in as_list(recipe.developers)]
         if recipe_version.format:
             type_ = content_type_lookup.get(
-                recipe_version.format.resolve(client, scope="any").name,
+                resolve_controlled_term(recipe_version.format, client).name,
                 None)
         else:
             type_ = None
@@ -103,7 +101,7 @@ class WorkflowRecipe(BaseModel):
     def to_kg_object(self, client):
         content_type_name = invert_dict(content_type_lookup).get(self.type, None)
         if content_type_name:
-            format = omterms.ContentType.by_name(content_type_name, client)
+            format = get_content_type(content_type_name, client)
         else:
             format = None
         return omcmp.WorkflowRecipeVersion(
@@ -128,12 +126,7 @@ class WorkflowRecipe(BaseModel):
             #other_contributions',
             #related_publications',
             #release_date',
-            repository=omcore.FileRepository(
-                name=get_repository_name(self.location),
-                iri=get_repository_iri(self.location),
-                hosted_by=get_repository_host(self.location),
-                type=get_repository_type(self.location),
-            ),
+            repository=get_file_repository(self.location),
             #support_channels',
             version_identifier=self.version_identifier,
             version_innovation=self.version_innovation
@@ -26,11 +26,13 @@ from fairgraph.base import as_list
 import fairgraph.openminds.computation as omcmp
 import fairgraph.errors
 
-from fastapi import APIRouter, Depends, Query, HTTPException, status as status_codes
+from fastapi import APIRouter, Depends, Query, HTTPException, Request, status as status_codes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
-from ..auth.utils import get_kg_client_for_user_account
-from ..common.utils import patch_computation, delete_computation, NotFoundError, AuthenticationError
+from ..auth.utils import get_async_kg_client_for_user_account
+from ..common.utils import (
+    patch_computation, delete_computation, NotFoundError, AuthenticationError, coalesce_requests, list_response
+)
 from .data_models import WorkflowRecipe, WorkflowRecipePatch
 
 
@@ -41,7 +43,9 @@ router = APIRouter()
 
 
 @router.get("/recipes/", response_model=List[WorkflowRecipe])
-def query_workflow_recipes(
+@coalesce_requests
+async def query_workflow_recipes(
+    request: Request,
     space: str = Query(None, description="Knowledge Graph space to search in"),
     size: int = Query(100, description="Number of records to return"),
     from_index: int = Query(0, description="Index of the first record to return"),
@@ -54,37 +58,38 @@ def query_workflow_recipes(
     The list may contain records of recipes that are public
     or that are associated with a collab of which the user is a member.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
+    kg = get_async_kg_client_for_user_account(token.credentials)
     try:
-        recipes = omcmp.WorkflowRecipeVersion.list(
-            kg_client, scope="any", space=space, api="core",
+        recipes = await kg.list(
+            omcmp.WorkflowRecipeVersion, scope="any", space=space, api="core",
             from_index=from_index, size=size)
     except fairgraph.errors.AuthenticationError:
         raise AuthenticationError()
-    return [WorkflowRecipe.from_kg_object(rcp, kg_client) for rcp in recipes]
+    return await list_response(request, kg, WorkflowRecipe, recipes)
 
 
 @router.get("/recipes/{recipe_id}", response_model=WorkflowRecipe)
-def get_workflow_recipe(recipe_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+@coalesce_requests
+async def get_workflow_recipe(recipe_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Retrieve a workflow recipe (aka workflow description) from the Knowledge Graph, identified by its ID.
 
     You may only retrieve public recipes, recipes that you created, or recipes associated with a collab which you can view.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
+    kg = get_async_kg_client_for_user_account(token.credentials)
     try:
-        recipe_object = omcmp.WorkflowRecipeVersion.from_uuid(str(recipe_id), kg_client, scope="any")
+        recipe_object = await kg.from_uuid(omcmp.WorkflowRecipeVersion, str(recipe_id), scope="any")
     except TypeError as err:
         raise NotFoundError("workflow recipe", recipe_id)
     except fairgraph.errors.AuthenticationError:
         raise AuthenticationError()
     if recipe_object is None:
         raise NotFoundError("workflow recipe", recipe_id)
-    return WorkflowRecipe.from_kg_object(recipe_object, kg_client)
+    return await kg.convert(WorkflowRecipe, recipe_object)
 
 
 @router.post("/recipes/", response_model=WorkflowRecipe, status_code=status_codes.HTTP_201_CREATED)
-def create_workflow_recipe(
+async def create_workflow_recipe(
     recipe: WorkflowRecipe,
     space: str = "myspace",
     token: HTTPAuthorizationCredentials = Depends(auth)
@@ -92,7 +97,12 @@ def create_workflow_recipe(
     """
     Store a new recipe, or a new version of an existing recipe, in the Knowledge Graph.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    # this involves a sequence of dependent KG requests, so we run it all in a single worker thread
+    return await kg.run(_create_workflow_recipe, recipe, space, kg.client)
+
+
+def _create_workflow_recipe(recipe, space, kg_client):
     requested_recipe_uuid = None
     if recipe.id is not None:
         kg_recipe_version = omcmp.WorkflowRecipeVersion.from_uuid(str(recipe.id), kg_client, scope="any")
@@ -158,7 +168,7 @@ def create_workflow_recipe(
 
 
 @router.patch("/recipes/{recipe_id}", response_model=WorkflowRecipe)
-def update_workflow_recipe(
+async def update_workflow_recipe(
     recipe_id: UUID,
     patch: WorkflowRecipePatch,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -169,15 +179,15 @@ def update_workflow_recipe(
     You may only update records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return patch_computation(WorkflowRecipe, omcmp.WorkflowRecipeVersion, recipe_id, patch, token)
+    return await patch_computation(WorkflowRecipe, omcmp.WorkflowRecipeVersion, recipe_id, patch, token)
 
 
 @router.delete("/recipes/{recipe_id}")
-def delete_workflow_recipe(recipe_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+async def delete_workflow_recipe(recipe_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Delete a workflow recipe.
 
     You may only delete recipes in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return delete_computation(omcmp.WorkflowRecipeVersion, recipe_id, token)
+    return await delete_computation(omcmp.WorkflowRecipeVersion, recipe_id, token)
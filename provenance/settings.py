@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 HBP_IDENTITY_SERVICE_URL_V2 = "https://iam.ebrains.eu/auth/realms/hbp/protocol/openid-connect"
 HBP_COLLAB_SERVICE_URL_V2 = "https://wiki.ebrains.eu/rest/v1/"
@@ -11,3 +12,74 @@ SESSIONS_SECRET_KEY = os.environ.get("SESSIONS_SECRET_KEY")
 BASE_URL = os.environ.get("PROV_API_BASE_URL")
 KG_CORE_API_HOST = os.environ.get("KG_CORE_API_HOST")
 ADMIN_GROUP_ID = "computation-curators"
+VOCAB_SNAPSHOT_PATH = os.environ.get(
+    "PROV_API_VOCAB_SNAPSHOT",
+    os.path.join(os.path.dirname(__file__), "vocab", "snapshot.json")
+)
+VOCAB_SNAPSHOT_REFRESH = os.environ.get("PROV_API_VOCAB_SNAPSHOT_REFRESH", "false").lower() in ("true", "1", "yes")
+# where the background refresh writes the updated snapshot, which must be writable by the API workers;
+# when refreshing is enabled, this snapshot is loaded in preference to PROV_API_VOCAB_SNAPSHOT
+VOCAB_SNAPSHOT_REFRESH_PATH = os.environ.get(
+    "PROV_API_VOCAB_SNAPSHOT_REFRESH_PATH",
+    os.path.join(tempfile.gettempdir(), "prov-api-vocab-snapshot.json")
+)
+# interval in seconds between refreshes of the controlled vocabularies from the KG; 0 disables
+VOCAB_REFRESH_INTERVAL = float(os.environ.get("PROV_API_VOCAB_REFRESH_INTERVAL", 3600))
+# timeout in seconds, and number of retries, for each request when retrieving the vocabularies from the KG
+VOCAB_FETCH_TIMEOUT = float(os.environ.get("PROV_API_VOCAB_FETCH_TIMEOUT", 30))
+VOCAB_FETCH_RETRIES = int(os.environ.get("PROV_API_VOCAB_FETCH_RETRIES", 2))
+# process-wide cache of converted people, software versions and computing environments
+SUBMODEL_CACHE_TTL = float(os.environ.get("PROV_API_SUBMODEL_CACHE_TTL", 300))
+SUBMODEL_CACHE_MAX_BYTES = int(os.environ.get("PROV_API_SUBMODEL_CACHE_MAX_BYTES", 10_000_000))
+# cache of converted records, keyed by revision and shared only between users with the same access to the KG
+RESPONSE_CACHE_TTL = float(os.environ.get("PROV_API_RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("PROV_API_RESPONSE_CACHE_MAX_BYTES", 50_000_000))
+# KG clients for user accounts are reused between requests with the same token; the pool size is a number of clients
+KG_CLIENT_POOL_SIZE = int(os.environ.get("PROV_API_KG_CLIENT_POOL_SIZE", 256))
+KG_CLIENT_POOL_TTL = float(os.environ.get("PROV_API_KG_CLIENT_POOL_TTL", 3600))
+# validate bearer tokens locally, using the signing keys published by EBRAINS IAM,
+# rather than calling the userinfo endpoint for each request
+LOCAL_TOKEN_VALIDATION = os.environ.get("PROV_API_LOCAL_TOKEN_VALIDATION", "true").lower() in ("true", "1", "yes")
+JWKS_CACHE_TTL = float(os.environ.get("PROV_API_JWKS_CACHE_TTL", 3600))
+# cache of user info and collab permissions, keyed by token
+USER_INFO_CACHE_TTL = float(os.environ.get("PROV_API_USER_INFO_CACHE_TTL", 300))
+COLLAB_PERMISSIONS_CACHE_TTL = float(os.environ.get("PROV_API_COLLAB_PERMISSIONS_CACHE_TTL", 300))
+COLLAB_PERMISSIONS_NEGATIVE_CACHE_TTL = float(os.environ.get("PROV_API_COLLAB_PERMISSIONS_NEGATIVE_CACHE_TTL", 60))
+AUTH_CACHE_MAX_BYTES = int(os.environ.get("PROV_API_AUTH_CACHE_MAX_BYTES", 5_000_000))
+# how long the list of KG spaces a user can read is cached, in seconds
+READABLE_SPACES_TTL = float(os.environ.get("PROV_API_READABLE_SPACES_TTL", 60))
+# timeout in seconds, number of retries, and initial delay between retries, for requests to EBRAINS IAM and the Collaboratory
+AUTH_HTTP_TIMEOUT = float(os.environ.get("PROV_API_AUTH_HTTP_TIMEOUT", 10))
+AUTH_HTTP_RETRIES = int(os.environ.get("PROV_API_AUTH_HTTP_RETRIES", 2))
+AUTH_HTTP_BACKOFF = float(os.environ.get("PROV_API_AUTH_HTTP_BACKOFF", 0.2))
+# number of threads used to make (blocking) requests to the KG from async endpoints
+KG_THREAD_POOL_SIZE = int(os.environ.get("PROV_API_KG_THREAD_POOL_SIZE", 100))
+# limits on KG calls in progress per worker; excess calls are queued, taking users in turn,
+# and rejected with "503 Service Unavailable" if the queue is full or they wait too long (seconds)
+KG_MAX_CONCURRENT_REQUESTS = int(os.environ.get("PROV_API_KG_MAX_CONCURRENT_REQUESTS", KG_THREAD_POOL_SIZE))
+KG_MAX_QUEUED_REQUESTS = int(os.environ.get("PROV_API_KG_MAX_QUEUED_REQUESTS", 1000))
+KG_MAX_QUEUED_REQUESTS_PER_USER = int(os.environ.get("PROV_API_KG_MAX_QUEUED_REQUESTS_PER_USER", 100))
+KG_QUEUE_TIMEOUT = float(os.environ.get("PROV_API_KG_QUEUE_TIMEOUT", 10))
+KG_RETRY_AFTER = int(os.environ.get("PROV_API_KG_RETRY_AFTER", 5))
+# larger requests for lists of records are split into sub-pages of at most this many records,
+# of which up to KG_PAGE_PARALLELISM are retrieved and converted at the same time
+KG_MAX_PAGE_SIZE = int(os.environ.get("PROV_API_KG_MAX_PAGE_SIZE", 100))
+KG_PAGE_PARALLELISM = int(os.environ.get("PROV_API_KG_PAGE_PARALLELISM", 4))
+# when list endpoints stream their results as NDJSON, records are converted in batches of this size,
+# the next batch being converted while the previous one is sent
+STREAM_BATCH_SIZE = int(os.environ.get("PROV_API_STREAM_BATCH_SIZE", 10))
+# cache lifetime in seconds, and maximum number of simultaneous KG requests, for the per-space counts in /statistics/spaces/
+STATISTICS_CACHE_TTL = float(os.environ.get("PROV_API_STATISTICS_CACHE_TTL", 60))
+STATISTICS_MAX_CONCURRENT_COUNTS = int(os.environ.get("PROV_API_STATISTICS_MAX_CONCURRENT_COUNTS", 20))
+# the index of computational environments by hardware system is reloaded from the KG for each space
+# after this time (seconds); in between, only environments saved through this API are added
+ENVIRONMENT_INDEX_TTL = float(os.environ.get("PROV_API_ENVIRONMENT_INDEX_TTL", 300))
+# the index of the tags and start/end times of computation records is reloaded from the KG for each
+# space and type after this time (seconds); in between, only records saved or deleted through this API are updated
+RECORD_INDEX_TTL = float(os.environ.get("PROV_API_RECORD_INDEX_TTL", 300))
+# directory through which the API worker processes tell each other about records saved or deleted through
+# this API, so their indexes stay up to date; all the workers must share this directory
+INDEX_SIGNAL_DIR = os.environ.get(
+    "PROV_API_INDEX_SIGNAL_DIR",
+    os.path.join(tempfile.gettempdir(), "prov-api-index")
+)
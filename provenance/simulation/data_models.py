@@ -43,7 +43,8 @@ from ..common.data_models import (
     ComputationalEnvironment,
     ACTION_STATUS_TYPES,
     status_name_map,
-    ComputationType
+    ComputationType,
+    resolve_controlled_term
 )
 from ..common.utils import collab_id_from_space
 
@@ -104,7 +105,7 @@ class Simulation(Computation):
             start_time=simulation_object.start_time,
             end_time=simulation_object.end_time,
             started_by=Person.from_kg_object(simulation_object.started_by, client),
-            status=getattr(Status, status_name_map[simulation_object.status.resolve(client).name]),
+            status=getattr(Status, status_name_map[resolve_controlled_term(simulation_object.status, client).name]),
             resource_usage=[ResourceUsage.from_kg_object(obj, client) for obj in as_list(simulation_object.resource_usages)],
             tags=as_list(simulation_object.tags),
             recipe_id=simulation_object.recipe.uuid if simulation_object.recipe else None,
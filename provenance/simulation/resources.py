@@ -23,7 +23,7 @@ from uuid import UUID
 from datetime import datetime
 import logging
 
-from fastapi import APIRouter, Depends, Header, Query, HTTPException, status as status_codes
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request, Response, status as status_codes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import ValidationError
 
@@ -31,10 +31,14 @@ from fairgraph.base import as_list
 import fairgraph.openminds.core as omcore
 import fairgraph.openminds.computation as omcmp
 
-from ..auth.utils import get_kg_client_for_user_account
+from ..auth.utils import get_async_kg_client_for_user_account
 from .data_models import Simulation, SimulationPatch, Simulator
-from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES
-from ..common.utils import create_computation, replace_computation, patch_computation, delete_computation, NotFoundError
+from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES, SortOrder
+from ..common.filters import build_filters, list_computations, set_next_link
+from ..common.utils import (
+    create_computation, retrieve_computation, replace_computation, patch_computation, delete_computation,
+    NotFoundError, coalesce_requests, list_response
+)
 from .. import settings
 
 
@@ -45,15 +49,25 @@ router = APIRouter()
 
 
 @router.get("/simulations/", response_model=List[Simulation])
-def query_simulations(
+@coalesce_requests
+async def query_simulations(
+    request: Request,
+    response: Response,
     model_version: UUID = Query(None, description="Return only simulations of this model version"),
     simulator: Simulator = Query(None, description="Return simulations using this simulator"),
     platform: HardwareSystem = Query(None, description="Return simulations that ran on this hardware platform"),
     space: str = Query(None, description="Knowledge Graph space to search in"),
     status: Status = Query(None, description="Return simulations with this status"),
     tags: List[str] = Query(None, description="Return simulations with _all_ of these tags"),
+    started_after: datetime = Query(None, description="Return simulations that started at or after this time"),
+    started_before: datetime = Query(None, description="Return simulations that started before this time"),
+    ended_after: datetime = Query(None, description="Return simulations that ended at or after this time"),
+    order_by: SortOrder = Query(None, description="Sort by start or end time; '-' for most recent first "
+                                                  "(default '-start_time' when filtering by tag or time)"),
     size: int = Query(100, description="Number of records to return"),
-    from_index: int = Query(0, description="Index of the first record to return"),
+    cursor: str = Query(None, description="Position in the results, from the 'next' link of the previous page"),
+    from_index: int = Query(0, description="Index of the first record to return (use 'cursor' instead)",
+                            deprecated=True),
     # from header
     token: HTTPAuthorizationCredentials = Depends(auth),
 ):
@@ -63,52 +77,27 @@ def query_simulations(
     Where multiple filters are applied, they are combined with AND,
     e.g. simulator=nest&platform=pizdaint returns NEST simulations that ran on Piz Daint.
 
+    When filtering by tag or time, the most recently started simulations are returned first,
+    unless another order is requested.
+    If there are further results, the response has a `Link` header with the URL of the next page.
+
     The list may contain records of simulations that are public, were performed by the logged-in user,
     or that are associated with a collab of which the user is a member.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    filters = {
-        "inputs": [],
-        "environment": []
-    }
-    # filter by model version
-    if model_version:
-        # todo: add a query for un-released model versions
-        model_version_obj = omcore.ModelVersion.from_id(str(model_version), kg_client, scope="released")
-        if model_version_obj is None:
-            raise HTTPException(
-                status_code=status_codes.HTTP_404_NOT_FOUND,
-                detail="No such model version, or you don't have access."
-            )
-        filters["inputs"].append(model_version_obj)
-    # filter by simulator
-    if simulator:
-        filters["inputs"].append(simulator)
-    # filter by hardware platform
-    if platform:
-        hardware_obj = omcmp.HardwareSystem.by_name(platform.value, kg_client, scope="any", space="common")
-        # todo: handle different versions of hardware platforms
-        environments = omcmp.Environment.list(kg_client, hardware=hardware_obj, scope="any", space=space)
-        filters["environment"].extend(as_list(environments))
-    # filter by status
-    if status:
-        filters["status"] = ACTION_STATUS_TYPES[status.value]
-    # filter by tag
-    if tags:
-        filters["tags"] = tags
-
-    for key in ("inputs", "environment"):
-        if key in filters and len(filters[key]) == 0:
-            del filters[key]
-
-    simulation_objects = omcmp.Simulation.list(kg_client, scope="any", api="query",
-                                               size=size, from_index=from_index,
-                                               space=space)
-    return [Simulation.from_kg_object(obj, kg_client) for obj in simulation_objects]
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    filters = await build_filters(kg, space=space, model_version=model_version, simulator=simulator,
+                                  platform=platform, status=status, tags=tags,
+                                  started_after=started_after, started_before=started_before,
+                                  ended_after=ended_after, order_by=order_by,
+                                  cursor=cursor)
+    simulation_objects = await list_computations(kg, omcmp.Simulation, filters, space=space,
+                                                 size=size, from_index=from_index)
+    set_next_link(request, response, filters)
+    return await list_response(request, kg, Simulation, simulation_objects, response=response)
 
 
 @router.post("/simulations/", response_model=Simulation, status_code=status_codes.HTTP_201_CREATED)
-def create_simulation(
+async def create_simulation(
     simulation: Simulation,
     space: str = Query(None, description="Knowledge Graph space to save to"),
     token: HTTPAuthorizationCredentials = Depends(auth)
@@ -116,29 +105,23 @@ def create_simulation(
     """
     Store a new record of a numerical simulation in the Knowledge Graph.
     """
-    return create_computation(Simulation, omcmp.Simulation, simulation, space, token)
+    return await create_computation(Simulation, omcmp.Simulation, simulation, space, token)
 
 
 @router.get("/simulations/{simulation_id}", response_model=Simulation)
-def get_simulation(simulation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+@coalesce_requests
+async def get_simulation(simulation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Retrieve a specific simulation record, identified by its ID.
 
     You may only retrieve public records, records in your private space,
     or records associated with a collab which you can view.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        simulation_object = omcmp.Visualization.from_uuid(str(simulation_id), kg_client, scope="any")
-    except TypeError as err:
-        raise NotFoundError("simulation", simulation_id)
-    if simulation_object is None:
-        raise NotFoundError("simulation", simulation_id)
-    return Simulation.from_kg_object(simulation_object, kg_client)
+    return await retrieve_computation(Simulation, omcmp.Simulation, "simulation", simulation_id, token)
 
 
 @router.put("/simulations/{simulation_id}", response_model=Simulation)
-def replace_simulation(
+async def replace_simulation(
     simulation_id: UUID,
     simulation: Simulation,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -149,11 +132,11 @@ def replace_simulation(
     You may only replace records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return replace_computation(Simulation, omcmp.Simulation, simulation_id, simulation, token)
+    return await replace_computation(Simulation, omcmp.Simulation, simulation_id, simulation, token)
 
 
 @router.patch("/simulations/{simulation_id}", response_model=Simulation)
-def update_simulation(
+async def update_simulation(
     simulation_id: UUID,
     patch: SimulationPatch,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -164,15 +147,15 @@ def update_simulation(
     You may only modify records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return patch_computation(Simulation, omcmp.Simulation, simulation_id, patch, token)
+    return await patch_computation(Simulation, omcmp.Simulation, simulation_id, patch, token)
 
 
 @router.delete("/simulations/{simulation_id}")
-def delete_simulation(simulation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+async def delete_simulation(simulation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Delete a simulation record.
 
     You may only delete records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return delete_computation(omcmp.Simulation, simulation_id, token)
+    return await delete_computation(omcmp.Simulation, simulation_id, token)
@@ -19,8 +19,9 @@ docstring goes here
 """
 
 
+from typing import Dict
 import logging
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from fairgraph.utility import as_list
 
 
@@ -31,4 +32,7 @@ logger = logging.getLogger("ebrains-prov-api")
 class WorkflowCount(BaseModel):
     space: str
     count: int
+    counts: Dict[str, int] = Field(
+        None, description="Number of computations of each of the requested types"
+    )
 
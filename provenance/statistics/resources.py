@@ -19,15 +19,24 @@ docstring goes here
 """
 
 from typing import List
+import asyncio
 import logging
 
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, status as status_codes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
+import fairgraph.errors
 import fairgraph.openminds.computation as omcmp
 
-from ..auth.utils import get_kg_client_for_user_account
+from ..auth.utils import get_async_kg_client_for_user_account, is_global_admin
+from ..common.cache import TTLCache
+from ..common.data_models import ComputationType
+from ..common.indexes import computation_spaces
+from ..common.kg_client import KGOverloaded
+from ..common.metrics import collect_metrics, register_metrics
+from ..common.utils import coalesce_requests, AuthenticationError
+from .. import settings
 from .data_models import WorkflowCount
 
 
@@ -37,27 +46,85 @@ auth = HTTPBearer()
 router = APIRouter()
 
 
+COMPUTATION_CLASSES = {
+    ComputationType.visualization: omcmp.Visualization,
+    ComputationType.analysis: omcmp.DataAnalysis,
+    ComputationType.simulation: omcmp.Simulation,
+    ComputationType.optimization: omcmp.Optimization,
+    ComputationType.datatransfer: omcmp.DataCopy,
+    ComputationType.miscellaneous: omcmp.GenericComputation,
+}
+
+# Number of records of each type in each space, for each user. Counts include unreleased
+# records, and which of those a user can see depends on their permissions, so are not shared.
+_counts = TTLCache(ttl=settings.STATISTICS_CACHE_TTL, max_bytes=100_000)  # each entry has size 1
+register_metrics("space_counts_cache", _counts.metrics)
+
+
+async def count_records(kg, fairgraph_cls, space, limit):
+    key = (kg.user, space, fairgraph_cls.__name__)
+    count = _counts.get(key)
+    if count is None:
+        async with limit:
+            try:
+                count = await kg.count(fairgraph_cls, scope="any", space=space)
+            except (KGOverloaded, HTTPException):
+                raise
+            except fairgraph.errors.AuthenticationError:
+                raise AuthenticationError()
+            except Exception as err:
+                # one space we can't count shouldn't prevent returning the others;
+                # the zero is not cached, so the next request tries again
+                logger.warning(f"Unable to count {fairgraph_cls.__name__} records in space {space}: {err}")
+                return 0
+        _counts.put(key, count)
+    return count
+
+
 @router.get("/statistics/spaces/", response_model=List[WorkflowCount])
-def query_spaces(
+@coalesce_requests
+async def query_spaces(
+    types: List[ComputationType] = Query(
+        None, description="Also return the number of computations of these types in each space"
+    ),
     token: HTTPAuthorizationCredentials = Depends(auth)
 ):
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    accessible_spaces = kg_client.spaces(permissions=None, names_only=True)
-    spaces_with_workflows = ["myspace"]
-    spaces_with_workflows.extend(sp for sp in accessible_spaces if sp.startswith("collab"))
-    if "computation" in accessible_spaces:
-        spaces_with_workflows.append("computation")
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    spaces_with_workflows = computation_spaces(await kg.spaces(permissions=None, names_only=True))
+    types = list(dict.fromkeys(types or []))  # remove duplicates, keeping the order
+    classes = [omcmp.WorkflowExecution] + [COMPUTATION_CLASSES[type_] for type_ in types]
+    # count everything in a single concurrent sweep, with a limit on the number of
+    # simultaneous KG requests, so as not to use all the available capacity
+    limit = asyncio.Semaphore(settings.STATISTICS_MAX_CONCURRENT_COUNTS)
+    results = await asyncio.gather(*(
+        count_records(kg, cls, space, limit)
+        for space in spaces_with_workflows
+        for cls in classes
+    ))
     counts = []
-    for space in spaces_with_workflows:
-        try:
-            count = omcmp.WorkflowExecution.count(kg_client, scope="any", space=space)
-        except Exception as err:
-            logger.warning(err)
-            count = 0
+    for i, space in enumerate(spaces_with_workflows):
+        space_counts = results[i * len(classes):(i + 1) * len(classes)]
         counts.append(
             WorkflowCount(
                 space=space,
-                count=count
+                count=space_counts[0],
+                counts={type_.value: count for type_, count in zip(types, space_counts[1:])} if types else None
             )
         )
     return counts
+
+
+@router.get("/statistics/metrics/")
+async def query_metrics(
+    token: HTTPAuthorizationCredentials = Depends(auth)
+):
+    """
+    Internal metrics of this service, e.g. cache sizes and hit rates.
+    Only available to administrators.
+    """
+    if not await is_global_admin(token.credentials):
+        raise HTTPException(
+            status_code=status_codes.HTTP_403_FORBIDDEN,
+            detail="Only administrators can view the service metrics"
+        )
+    return collect_metrics()
@@ -30,7 +30,8 @@ import fairgraph.openminds.core as omcore
 
 from ..common.data_models import (
     Computation, ComputationPatch, Status, Person, ResourceUsage, LaunchConfiguration,
-    ComputationalEnvironment, File, SoftwareVersion, ACTION_STATUS_TYPES, status_name_map
+    ComputationalEnvironment, File, SoftwareVersion, ACTION_STATUS_TYPES, status_name_map,
+    resolve_controlled_term
 )
 from ..common.utils import collab_id_from_space
 
@@ -69,7 +70,7 @@ class Visualisation(Computation):
             start_time=obj.start_time,
             end_time=obj.end_time,
             started_by=Person.from_kg_object(obj.started_by, client),
-            status=getattr(Status, status_name_map[obj.status.resolve(client).name]),
+            status=getattr(Status, status_name_map[resolve_controlled_term(obj.status, client).name]),
             resource_usage=[ResourceUsage.from_kg_object(ru, client) for ru in as_list(obj.resource_usages)],
             tags=as_list(obj.tags),
             recipe_id=visualization_object.recipe.uuid if visualization_object.recipe else None,
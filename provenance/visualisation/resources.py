@@ -26,7 +26,7 @@ import logging
 from itertools import chain
 
 
-from fastapi import APIRouter, Depends, Header, Query, HTTPException, status as status_codes
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request, Response, status as status_codes
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import ValidationError
 
@@ -34,11 +34,15 @@ from fairgraph.base import as_list
 import fairgraph.openminds.core as omcore
 import fairgraph.openminds.computation as omcmp
 
-from ..auth.utils import get_kg_client_for_user_account
+from ..auth.utils import get_async_kg_client_for_user_account
 
 from .data_models import Visualisation, VisualisationPatch
-from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES
-from ..common.utils import create_computation, replace_computation, patch_computation, delete_computation, NotFoundError
+from ..common.data_models import HardwareSystem, Status, ACTION_STATUS_TYPES, SortOrder
+from ..common.filters import build_filters, list_computations, set_next_link
+from ..common.utils import (
+    create_computation, retrieve_computation, replace_computation, patch_computation, delete_computation,
+    NotFoundError, coalesce_requests, list_response
+)
 from .. import settings
 
 
@@ -49,7 +53,10 @@ router = APIRouter()
 
 
 @router.get("/visualisations/", response_model=List[Visualisation])
-def query_visualisations(
+@coalesce_requests
+async def query_visualisations(
+    request: Request,
+    response: Response,
     dataset: UUID = Query(None, description="Return visualisations of this dataset"),
     simulation: UUID = Query(None, description="Return visualisations of results from this simulation"),
     input_data: UUID = Query(None, description="Return visualisations of a given data file or directory containing data files"),
@@ -58,8 +65,15 @@ def query_visualisations(
     space: str = Query(None, description="Knowledge Graph space to search in"),
     status: Status = Query(None, description="Return visualisations with this status"),
     tags: List[str] = Query(None, description="Return visualisations with _all_ of these tags"),
+    started_after: datetime = Query(None, description="Return visualisations that started at or after this time"),
+    started_before: datetime = Query(None, description="Return visualisations that started before this time"),
+    ended_after: datetime = Query(None, description="Return visualisations that ended at or after this time"),
+    order_by: SortOrder = Query(None, description="Sort by start or end time; '-' for most recent first "
+                                                  "(default '-start_time' when filtering by tag or time)"),
     size: int = Query(100, description="Number of records to return"),
-    from_index: int = Query(0, description="Index of the first record to return"),
+    cursor: str = Query(None, description="Position in the results, from the 'next' link of the previous page"),
+    from_index: int = Query(0, description="Index of the first record to return (use 'cursor' instead)",
+                            deprecated=True),
     # from header
     token: HTTPAuthorizationCredentials = Depends(auth),
 
@@ -71,73 +85,27 @@ def query_visualisations(
     e.g. software=<UUID for Elephant v0.9.0>&platform=pizdaint returns
     data visualisations that used Elephant v0.9.0 and that ran on Piz Daint.
 
+    When filtering by tag or time, the most recently started visualisations are returned first,
+    unless another order is requested.
+    If there are further results, the response has a `Link` header with the URL of the next page.
+
     The list may contain records of data visualisations that are public, were performed by the logged-in user,
     or that are associated with a collab of which the user is a member.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    filters = {
-        "inputs": [],
-        "environment": []
-    }
-    if dataset:
-        dataset_obj = omcore.DatasetVersion.from_id(str(dataset), kg_client)
-        if dataset_obj is None:
-            raise HTTPException(
-                status_code=status_codes.HTTP_404_NOT_FOUND,
-                detail="No such dataset"
-            )
-        files = omcore.File.list(kg_client, file_repository=dataset_obj.repository)
-        if len(files) > 100:  # todo: figure out what a reasonable limit is
-            raise HTTPException(
-                status_code=status_codes.HTTP_400_BAD_REQUEST,
-                detail="This dataset has too many files for this query"
-            )
-        if len(files) > 0:
-            filters["inputs"].extend(as_list(files))
-        # todo: support FileBundle
-    # filter by simulation
-    if simulation:
-        # todo: add a query for released simulations
-        simulation_obj = omcmp.Simulation.from_id(str(simulation), kg_client, scope="any")
-        if simulation_obj is None:
-            raise HTTPException(
-                status_code=status_codes.HTTP_404_NOT_FOUND,
-                detail="No such simulation, or you don't have access."
-            )
-        filters["inputs"].extend(as_list(simulation_obj.outputs))
-    # filter by input_data
-    if input_data:
-        filters["inputs"].extend(as_list(input_data))
-    # filter by software
-    if software:
-        filters["inputs"].extend(as_list(software))
-        environments = omcmp.Environment.list(kg_client, software=software, scope="any", space=space)
-        filters["environment"].extend(as_list(environments))
-    # filter by hardware platform
-    if platform:
-        hardware_obj = omcmp.HardwareSystem.by_name(platform.value, kg_client, scope="any", space="common")
-        # todo: handle different versions of hardware platforms
-        environments = omcmp.Environment.list(kg_client, hardware=hardware_obj, scope="any", space=space)
-        filters["environment"].extend(as_list(environments))
-    # filter by status
-    if status:
-        filters["status"] = ACTION_STATUS_TYPES[status.value]
-    # filter by tag
-    if tags:
-        filters["tags"] = tags
-
-    for key in ("inputs", "environment"):
-        if key in filters and len(filters[key]) == 0:
-            del filters[key]
-
-    visualisation_objects = omcmp.Visualization.list(kg_client, scope="any", api="query",
-                                                    size=size, from_index=from_index,
-                                                    space=space)
-    return [Visualisation.from_kg_object(obj, kg_client) for obj in visualisation_objects]
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    filters = await build_filters(kg, space=space, dataset=dataset, simulation=simulation,
+                                  input_data=input_data, software=software, platform=platform,
+                                  status=status, tags=tags, started_after=started_after,
+                                  started_before=started_before, ended_after=ended_after,
+                                  order_by=order_by, cursor=cursor)
+    visualisation_objects = await list_computations(kg, omcmp.Visualization, filters, space=space,
+                                                    size=size, from_index=from_index)
+    set_next_link(request, response, filters)
+    return await list_response(request, kg, Visualisation, visualisation_objects, response=response)
 
 
 @router.post("/visualisations/", response_model=Visualisation, status_code=status_codes.HTTP_201_CREATED)
-def create_visualisation(
+async def create_visualisation(
     visualisation: Visualisation,
     space: str = "myspace",
     token: HTTPAuthorizationCredentials = Depends(auth)
@@ -145,29 +113,23 @@ def create_visualisation(
     """
     Store a new record of a visualisation stage in the Knowledge Graph.
     """
-    return create_computation(Visualisation, omcmp.Visualization, visualisation, space, token)
+    return await create_computation(Visualisation, omcmp.Visualization, visualisation, space, token)
 
 
 @router.get("/visualisations/{visualisation_id}", response_model=Visualisation)
-def get_visualisation(visualisation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+@coalesce_requests
+async def get_visualisation(visualisation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Retrieve a specific visualisation record, identified by its ID.
 
     You may only retrieve public records, records in your private space,
     or records associated with a collab which you can view.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        visualisation_object = omcmp.Visualization.from_uuid(str(visualisation_id), kg_client, scope="any")
-    except TypeError as err:
-        raise NotFoundError("visualisation", visualisation_id)
-    if visualisation_object is None:
-        raise NotFoundError("visualisation", visualisation_id)
-    return Visualisation.from_kg_object(visualisation_object, kg_client)
+    return await retrieve_computation(Visualisation, omcmp.Visualization, "visualisation", visualisation_id, token)
 
 
 @router.put("/visualisations/{visualisation_id}", response_model=Visualisation)
-def replace_visualisation(
+async def replace_visualisation(
     visualisation_id: UUID,
     visualisation: Visualisation,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -178,11 +140,11 @@ def replace_visualisation(
     You may only replace records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return replace_computation(Visualisation, omcmp.Visualization, visualisation_id, visualisation, token)
+    return await replace_computation(Visualisation, omcmp.Visualization, visualisation_id, visualisation, token)
 
 
 @router.patch("/visualisations/{visualisation_id}", response_model=Visualisation)
-def update_visualisation(
+async def update_visualisation(
     visualisation_id: UUID,
     patch: VisualisationPatch,
     token: HTTPAuthorizationCredentials = Depends(auth),
@@ -193,15 +155,15 @@ def update_visualisation(
     You may only update records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return patch_computation(Visualisation, omcmp.Visualization, visualisation_id, patch, token)
+    return await patch_computation(Visualisation, omcmp.Visualization, visualisation_id, patch, token)
 
 
 @router.delete("/visualisations/{visualisation_id}", response_model=Visualisation)
-def delete_visualisation(visualisation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+async def delete_visualisation(visualisation_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Delete a visualisation record.
 
     You may only delete records in your private space,
     or that are associated with a collab of which you are an administrator.
     """
-    return delete_computation(omcmp.Visualization, visualisation_id, token)
+    return await delete_computation(omcmp.Visualization, visualisation_id, token)
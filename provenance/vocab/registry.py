@@ -0,0 +1,151 @@
+"""
+Registry of lookup tables for the controlled vocabularies,
+which can be refreshed from the Knowledge Graph while the API is running.
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from collections.abc import Mapping
+import asyncio
+import logging
+import threading
+import time
+
+from .snapshot import fetch_vocabularies
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+
+class VocabularyRegistry:
+    """
+    Holds the lookup tables built from the controlled vocabularies.
+
+    `build_tables` is a function which takes the vocabularies (as returned by
+    `fetch_vocabularies()`) and returns a dict of lookup tables.
+    When the vocabularies are refreshed, the new tables are built in full
+    and then swapped in with a single assignment, so lookups never block
+    and never see a partially-updated table.
+    """
+
+    def __init__(self, build_tables):
+        self._build_tables = build_tables
+        self._tables = {}
+        self._refresh_lock = threading.Lock()
+        self.loaded_at = None
+        self.last_refresh_duration = None
+        self.refresh_count = 0
+        self.refresh_errors = 0
+
+    def load(self, vocabularies):
+        tables = self._build_tables(vocabularies)
+        self._tables = tables
+        self.loaded_at = time.time()
+
+    def table(self, name):
+        return self._tables[name]
+
+    def view(self, name):
+        return VocabularyView(self, name)
+
+    def refresh(self):
+        """Retrieve the vocabularies from the KG and replace the lookup tables. This blocks."""
+        with self._refresh_lock:
+            start = time.perf_counter()
+            try:
+                vocabularies = fetch_vocabularies()
+                self.load(vocabularies)
+            except Exception:
+                self.refresh_errors += 1
+                raise
+            self.last_refresh_duration = time.perf_counter() - start
+            self.refresh_count += 1
+            logger.info(f"Refreshed controlled vocabularies in {self.last_refresh_duration:.2f} s")
+
+    async def refresh_async(self):
+        """Refresh the vocabularies in a worker thread, so as not to block the event loop"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.refresh)
+
+    async def refresh_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_async()
+            except Exception as err:
+                logger.warning(f"Unable to refresh controlled vocabularies: {err}")
+
+    def metrics(self):
+        return {
+            "age_seconds": None if self.loaded_at is None else time.time() - self.loaded_at,
+            "last_refresh_duration_seconds": self.last_refresh_duration,
+            "refresh_count": self.refresh_count,
+            "refresh_errors": self.refresh_errors,
+            "sizes": {name: len(table) for name, table in self._tables.items()},
+        }
+
+
+class VocabularyView(Mapping):
+    """
+    Read-only view of one of the lookup tables in a registry,
+    which always reflects the most recently loaded vocabularies.
+    """
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __getitem__(self, key):
+        return self._registry._tables[self._name][key]
+
+    def __contains__(self, key):
+        return key in self._registry._tables[self._name]
+
+    def __iter__(self):
+        return iter(self._registry._tables[self._name])
+
+    def __len__(self):
+        return len(self._registry._tables[self._name])
+
+
+class ControlledTerm(str):
+    """
+    Base class for string fields whose value must be a term from a controlled vocabulary.
+
+    Values are validated against the current contents of the vocabulary, so terms added
+    to the vocabulary since the API started are accepted once the registry has been refreshed.
+    The vocabulary is given by the `_vocabulary` attribute, a tuple (registry, table name).
+    """
+    _vocabulary = (None, None)
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if not isinstance(value, str):
+            raise TypeError("string required")
+        registry, table_name = cls._vocabulary
+        if value not in registry.table(table_name):
+            raise ValueError(f"'{value}' is not a valid {cls.__name__}")
+        return cls(value)
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        registry, table_name = cls._vocabulary
+        field_schema.update(type="string", enum=list(registry.table(table_name)))
@@ -1,5 +1,5 @@
 """
-docstring goes here
+Endpoints for managing the controlled vocabularies
 """
 
 """
@@ -22,11 +22,35 @@ from typing import List
 import logging
 
 
-from fastapi import APIRouter
-from fastapi.security import HTTPBearer
+from fastapi import APIRouter, Depends, HTTPException, status as status_codes
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
+from ..auth.utils import is_global_admin
+from ..common import data_models
 
 logger = logging.getLogger("ebrains-prov-api")
 
 auth = HTTPBearer()
 router = APIRouter()
+
+
+@router.post("/vocab/refresh")
+async def refresh_vocabularies(token: HTTPAuthorizationCredentials = Depends(auth)):
+    """
+    Reload the controlled vocabularies from the Knowledge Graph,
+    without restarting the service. Only available to administrators.
+    """
+    if not await is_global_admin(token.credentials):
+        raise HTTPException(
+            status_code=status_codes.HTTP_403_FORBIDDEN,
+            detail="Only administrators can refresh the controlled vocabularies"
+        )
+    try:
+        await data_models.VOCABULARIES.refresh_async()
+    except Exception as err:
+        logger.error(f"Unable to refresh controlled vocabularies: {err}")
+        raise HTTPException(
+            status_code=status_codes.HTTP_502_BAD_GATEWAY,
+            detail="Unable to retrieve the controlled vocabularies from the Knowledge Graph"
+        )
+    return data_models.VOCABULARIES.metrics()
@@ -0,0 +1,341 @@
+"""
+On-disk snapshot of the controlled vocabularies used by the API.
+
+Loading the vocabularies from the snapshot means that API workers can start without
+making any requests to the Knowledge Graph. The snapshot is generated when the Docker image
+is built (see deployment/Dockerfile); to regenerate it by hand:
+
+    $ python -m provenance.vocab.snapshot
+
+(the KG service account credentials must be set in the environment).
+"""
+
+"""
+   Copyright 2022 CNRS
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from functools import partial
+import argparse
+import json
+import logging
+import os
+import time
+
+import fairgraph.openminds.core as omcore
+import fairgraph.openminds.computation as omcmp
+from fairgraph.openminds.controlledterms import FileRepositoryType, UnitOfMeasurement, ActionStatusType
+
+from .. import settings
+from ..auth.utils import get_kg_client_for_service_account
+from ..common.metrics import register_metrics
+
+
+logger = logging.getLogger("ebrains-prov-api")
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+HOSTING_ORGANIZATIONS = ("EBRAINS", "GitHub", "Yale", "EBI", "CERN", "CSCS", "CNRS")
+
+
+def _fetch_action_status_types(client):
+    return ActionStatusType.list(client, scope="released", api="core", space="controlled", size=10)
+
+
+def _fetch_units_of_measurement(client):
+    return UnitOfMeasurement.list(client, api="core", scope="released", space="controlled")
+
+
+def _fetch_content_types(client):
+    return omcore.ContentType.list(client, api="core", scope="released", space="controlled", size=10000)
+
+
+def _fetch_hosting_organization(client, alias):
+    return omcore.Organization.list(client, scope="any", space="common", alias=alias)[0]
+
+
+def _fetch_repository_types(client):
+    return FileRepositoryType.list(client, scope="released")
+
+
+def _fetch_hardware_systems(client):
+    return omcmp.HardwareSystem.list(client, scope="any", space="common")
+
+
+# name: (KG class, scope, function to retrieve the vocabulary from the KG)
+# for vocabularies which are dicts, the last element is a dict of functions, one per key
+VOCABULARIES = {
+    "action_status_types": (ActionStatusType, "released", _fetch_action_status_types),
+    "units_of_measurement": (UnitOfMeasurement, "released", _fetch_units_of_measurement),
+    "content_types": (omcore.ContentType, "released", _fetch_content_types),
+    "hosting_organizations": (
+        omcore.Organization,
+        "any",
+        {alias: partial(_fetch_hosting_organization, alias=alias) for alias in HOSTING_ORGANIZATIONS}
+    ),
+    "repository_types": (FileRepositoryType, "released", _fetch_repository_types),
+    "hardware_systems": (omcmp.HardwareSystem, "any", _fetch_hardware_systems),
+}
+
+
+# how long it took to retrieve each vocabulary the last time it was fetched from the KG
+last_fetch_timings = {}
+
+register_metrics("vocabulary_fetch", lambda: dict(last_fetch_timings))
+
+
+class VocabularyFetchError(Exception):
+    pass
+
+
+def _fetch_tasks(names):
+    """Split the retrieval of the given vocabularies into independent requests"""
+    tasks = []
+    for name in names:
+        fetch = VOCABULARIES[name][2]
+        if isinstance(fetch, dict):
+            tasks.extend((name, key, func) for key, func in fetch.items())
+        else:
+            tasks.append((name, None, fetch))
+    return tasks
+
+
+def fetch_vocabulary(name, client=None):
+    """Retrieve a single vocabulary from the Knowledge Graph"""
+    return fetch_vocabularies(client, names=[name])[name]
+
+
+def fetch_vocabularies(client=None, names=None, timeout=None, retries=None):
+    """
+    Retrieve vocabularies (by default all of them) from the Knowledge Graph.
+
+    All requests are made concurrently, so the time taken is that of the slowest request
+    rather than the sum of all of them. A request which fails or takes longer than
+    `timeout` seconds is retried up to `retries` times before giving up.
+    """
+    client = client or get_kg_client_for_service_account()
+    names = list(names or VOCABULARIES)
+    timeout = settings.VOCAB_FETCH_TIMEOUT if timeout is None else timeout
+    retries = settings.VOCAB_FETCH_RETRIES if retries is None else retries
+
+    tasks = _fetch_tasks(names)
+    remaining = {name: 0 for name in names}
+    for name, key, fetch in tasks:
+        remaining[name] += 1
+    vocabularies = {
+        name: {} if isinstance(VOCABULARIES[name][2], dict) else None
+        for name in names
+    }
+    requests = {name: 0 for name in names}
+    timings = {}
+
+    # requests which time out cannot be interrupted, so allow for one thread per attempt
+    executor = ThreadPoolExecutor(max_workers=len(tasks) * (retries + 1))
+    pending = {}  # future: (task, attempt, start time)
+    start = time.perf_counter()
+
+    def submit(task, attempt):
+        requests[task[0]] += 1
+        future = executor.submit(task[2], client)
+        pending[future] = (task, attempt, time.perf_counter())
+
+    def retry(task, attempt, err):
+        name, key, _ = task
+        label = f"{name}[{key}]" if key else name
+        if attempt > retries:
+            raise VocabularyFetchError(
+                f"Unable to retrieve vocabulary '{label}' after {attempt} attempts: {err}"
+            ) from err
+        logger.warning(f"Retrying retrieval of vocabulary '{label}' (attempt {attempt}): {err}")
+        submit(task, attempt + 1)
+
+    try:
+        for task in tasks:
+            submit(task, 1)
+        while pending:
+            next_deadline = min(started + timeout for (_, _, started) in pending.values())
+            done, _ = wait(
+                list(pending),
+                timeout=max(0, next_deadline - time.perf_counter()),
+                return_when=FIRST_COMPLETED
+            )
+            now = time.perf_counter()
+            for future in list(pending):
+                task, attempt, started = pending[future]
+                if future in done:
+                    del pending[future]
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        retry(task, attempt, err)
+                        continue
+                    name, key, _ = task
+                    if key is None:
+                        vocabularies[name] = result
+                    else:
+                        vocabularies[name][key] = result
+                    remaining[name] -= 1
+                    if remaining[name] == 0:
+                        timings[name] = {"seconds": now - start, "requests": requests[name]}
+                elif now - started >= timeout:
+                    del pending[future]
+                    future.cancel()
+                    retry(task, attempt, TimeoutError(f"no response after {timeout} s"))
+    finally:
+        # don't wait for requests which have timed out
+        executor.shutdown(wait=False)
+
+    last_fetch_timings.update(timings)
+    logger.info(
+        f"Retrieved {len(names)} vocabularies in {time.perf_counter() - start:.2f} s ("
+        + ", ".join(f"{name}: {t['seconds']:.2f} s" for name, t in timings.items())
+        + ")"
+    )
+    return vocabularies
+
+
+def _serialize(objects):
+    if isinstance(objects, dict):
+        return {key: obj.data for key, obj in objects.items()}
+    else:
+        return [obj.data for obj in objects]
+
+
+def _deserialize(items, cls, scope):
+    if isinstance(items, dict):
+        return {key: cls.from_kg_instance(data, None, scope=scope) for key, data in items.items()}
+    else:
+        return [cls.from_kg_instance(data, None, scope=scope) for data in items]
+
+
+def serialize_vocabularies(vocabularies):
+    return {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "generated": datetime.now(timezone.utc).isoformat(),
+        "kg_host": settings.KG_CORE_API_HOST,
+        "vocabularies": {
+            name: _serialize(objects) for name, objects in vocabularies.items()
+        }
+    }
+
+
+def save_snapshot(vocabularies, path=None):
+    path = path or settings.VOCAB_SNAPSHOT_PATH
+    snapshot = serialize_vocabularies(vocabularies)
+    # write to a temporary file first, so running workers never see a partial snapshot
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(snapshot, fp, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    return snapshot
+
+
+def load_snapshot(path=None):
+    """
+    Load vocabularies from a snapshot file.
+
+    Returns None if the file does not exist, or if it was generated by an incompatible
+    version of this code or from a different KG instance.
+    """
+    path = path or settings.VOCAB_SNAPSHOT_PATH
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except FileNotFoundError:
+        logger.info(f"No vocabulary snapshot found at {path}")
+        return None
+    except json.decoder.JSONDecodeError as err:
+        logger.warning(f"Unable to read vocabulary snapshot at {path}: {err}")
+        return None
+    if snapshot.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        logger.warning(f"Ignoring vocabulary snapshot with format version {snapshot.get('format_version')}")
+        return None
+    if snapshot.get("kg_host") != settings.KG_CORE_API_HOST:
+        logger.warning(f"Ignoring vocabulary snapshot generated from {snapshot.get('kg_host')}")
+        return None
+    return {
+        name: _deserialize(items, VOCABULARIES[name][0], VOCABULARIES[name][1])
+        for name, items in snapshot["vocabularies"].items()
+        if name in VOCABULARIES
+    }
+
+
+def snapshot_paths():
+    """The snapshot files from which the vocabularies may be loaded, in order of preference"""
+    if settings.VOCAB_SNAPSHOT_REFRESH:
+        return [settings.VOCAB_SNAPSHOT_REFRESH_PATH, settings.VOCAB_SNAPSHOT_PATH]
+    return [settings.VOCAB_SNAPSHOT_PATH]
+
+
+def load_vocabularies(path=None):
+    """
+    Load all vocabularies, from the snapshot if possible,
+    otherwise (or for any vocabulary missing from the snapshot) from the Knowledge Graph.
+    """
+    vocabularies = None
+    for snapshot_path in ([path] if path else snapshot_paths()):
+        vocabularies = load_snapshot(snapshot_path)
+        if vocabularies:
+            break
+    vocabularies = vocabularies or {}
+    missing = [name for name in VOCABULARIES if name not in vocabularies]
+    if missing:
+        logger.info(f"Retrieving vocabularies {', '.join(missing)} from the Knowledge Graph")
+        vocabularies.update(fetch_vocabularies(names=missing))
+    return vocabularies
+
+
+def refresh_snapshot(path=None):
+    """
+    Retrieve the vocabularies from the Knowledge Graph and update the snapshot if they have changed.
+
+    The updated snapshot is written to `path` (by default PROV_API_VOCAB_SNAPSHOT_REFRESH_PATH),
+    never to the snapshot generated with the Docker image, which may not be writable.
+    Returns True if the snapshot was updated.
+    """
+    path = path or settings.VOCAB_SNAPSHOT_REFRESH_PATH
+    vocabularies = fetch_vocabularies()
+    new_contents = serialize_vocabularies(vocabularies)["vocabularies"]
+    old_contents = None
+    # compare with the snapshot the workers would load next time they start
+    for old_path in (path, settings.VOCAB_SNAPSHOT_PATH):
+        try:
+            with open(old_path) as fp:
+                old_contents = json.load(fp).get("vocabularies")
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            continue
+        break
+    if json.loads(json.dumps(new_contents)) == old_contents:
+        return False
+    save_snapshot(vocabularies, path)
+    logger.info(f"Updated vocabulary snapshot at {path}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Regenerate the snapshot of controlled vocabularies used by the Provenance API")
+    parser.add_argument("--output", default=settings.VOCAB_SNAPSHOT_PATH,
+                        help="path of the snapshot file (default: %(default)s)")
+    args = parser.parse_args()
+    snapshot = save_snapshot(fetch_vocabularies(), args.output)
+    for name, items in snapshot["vocabularies"].items():
+        print(f"{name}: {len(items)} terms")
+    print(f"Snapshot written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
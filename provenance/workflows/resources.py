@@ -26,12 +26,17 @@ import logging
 import fairgraph.openminds.computation as omcmp
 import fairgraph.errors
 
-from fastapi import APIRouter, Depends, Header, Query, HTTPException, status
+from fastapi import APIRouter, Depends, Header, Query, HTTPException, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import ValidationError
 
-from ..auth.utils import get_kg_client_for_user_account
-from ..common.utils import create_computation, delete_computation, NotFoundError, AuthenticationError
+from ..auth.utils import get_async_kg_client_for_user_account
+from ..common.data_models import SortOrder
+from ..common.filters import QueryFilters, list_computations, set_next_link
+from ..common.utils import (
+    create_computation, retrieve_computation, delete_computation, NotFoundError, AuthenticationError, coalesce_requests,
+    list_response
+)
 from .data_models import WorkflowExecution
 from .. import settings
 
@@ -43,38 +48,63 @@ router = APIRouter()
 
 
 @router.get("/workflows/", response_model=List[WorkflowExecution])
-def query_workflows(
+@coalesce_requests
+async def query_workflows(
+    request: Request,
+    response: Response,
     space: str = Query(None, description="Knowledge Graph space to search in"),
     recipe_id: UUID = Query(None, description="Return runs of the workflow recipe with the given ID"),
     tags: List[str] = Query(None, description="Return workflows with _all_ of these tags"),
+    started_after: datetime = Query(None, description="Return workflows that started at or after this time"),
+    started_before: datetime = Query(None, description="Return workflows that started before this time"),
+    ended_after: datetime = Query(None, description="Return workflows that ended at or after this time"),
+    order_by: SortOrder = Query(None, description="Sort by start or end time; '-' for most recent first "
+                                                  "(default '-start_time' when filtering by tag or time)"),
     size: int = Query(100, description="Number of records to return"),
-    from_index: int = Query(0, description="Index of the first record to return"),
+    cursor: str = Query(None, description="Position in the results, from the 'next' link of the previous page"),
+    from_index: int = Query(0, description="Index of the first record to return (use 'cursor' instead)",
+                            deprecated=True),
     # from header
     token: HTTPAuthorizationCredentials = Depends(auth),
 ):
     """
     Query recorded workflows, filtered according to various criteria.
 
+    A workflow has the tags of all of its stages, and runs from the start of its first stage
+    to the end of its last stage. When filtering by tag or time, the most recently started workflows
+    are returned first, unless another order is requested. If there are further results,
+    the response has a `Link` header with the URL of the next page.
+
     The list may contain records of workflows that are public, were launched by the logged-in user,
     or that are associated with a collab of which the user is a member.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    filters = {}
+    kg = get_async_kg_client_for_user_account(token.credentials)
+    filters = QueryFilters(parameters=dict(
+        space=space, recipe_id=recipe_id, tags=tags, started_after=started_after,
+        started_before=started_before, ended_after=ended_after, order_by=order_by
+    ))
+    if cursor:
+        filters.resume_from(cursor)
     if recipe_id:
-        filters["recipe"] = recipe_id
-    # todo: handle tags
+        filters.require("recipe", recipe_id)
+    # workflows have the tags of their stages
+    if tags:
+        filters.require_tags(tags)
+    filters.require_time_range(started_after, started_before, ended_after)
+    filters.order_by = order_by
     try:
-        workflows = omcmp.WorkflowExecution.list(
-            kg_client, scope="any", space=space,
-            from_index=from_index, size=size, **filters)
+        workflows = await list_computations(kg, omcmp.WorkflowExecution, filters.compile(), space=space,
+                                            size=size, from_index=from_index)
     except fairgraph.errors.AuthenticationError:
         raise AuthenticationError()
+    set_next_link(request, response, filters)
 
-    return [WorkflowExecution.from_kg_object(wf, kg_client) for wf in workflows]
+    # workflow stages are themselves references, so we need to go one level deeper
+    return await list_response(request, kg, WorkflowExecution, workflows, response=response, depth=3)
 
 
 @router.post("/workflows/", response_model=WorkflowExecution, status_code=status.HTTP_201_CREATED)
-def store_recorded_workflow(
+async def store_recorded_workflow(
     workflow: WorkflowExecution,
     space: str = "myspace",
     token: HTTPAuthorizationCredentials = Depends(auth)
@@ -82,33 +112,27 @@ def store_recorded_workflow(
     """
     Store a new record of a workflow execution in the Knowledge Graph.
     """
-    return create_computation(WorkflowExecution, omcmp.WorkflowExecution, workflow, space, token)
+    return await create_computation(WorkflowExecution, omcmp.WorkflowExecution, workflow, space, token)
 
 
 @router.get("/workflows/{workflow_id}", response_model=WorkflowExecution)
-def get_recorded_workflow(workflow_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+@coalesce_requests
+async def get_recorded_workflow(workflow_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Retrieve a specific record of a workflow execution from the Knowledge Graph, identified by its ID.
 
     You may only retrieve public records, records that you created, or records associated with a collab which you can view.
     """
-    kg_client = get_kg_client_for_user_account(token.credentials)
-    try:
-        workflow_object = omcmp.WorkflowExecution.from_uuid(str(workflow_id), kg_client, scope="any")
-    except fairgraph.errors.AuthenticationError:
-        raise AuthenticationError()
-    except TypeError as err:
-        raise NotFoundError("workflow execution", workflow_id)
-    if workflow_object is None:
-        raise NotFoundError("workflow execution", workflow_id)
-    return WorkflowExecution.from_kg_object(workflow_object, kg_client)
+    return await retrieve_computation(
+        WorkflowExecution, omcmp.WorkflowExecution, "workflow execution", workflow_id, token
+    )
 
 
 @router.delete("/workflows/{workflow_id}")
-def delete_workflow(workflow_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
+async def delete_workflow(workflow_id: UUID, token: HTTPAuthorizationCredentials = Depends(auth)):
     """
     Delete a record of a computational workflow execution.
 
     You may only delete records that you created, or that are associated with a collab of which you are an administrator.
     """
-    return delete_computation(omcmp.WorkflowExecution, workflow_id, token)
+    return await delete_computation(omcmp.WorkflowExecution, workflow_id, token)
@@ -0,0 +1,93 @@
+"""
+Fixtures and stand-ins for the Knowledge Graph shared by the unit tests
+"""
+
+import sys
+from types import SimpleNamespace
+from datetime import datetime
+import base64
+import json
+
+import pytest
+from fairgraph.base import as_list
+
+sys.path.append(".")
+from provenance.common import filters as filters_module
+from provenance.common.indexes import RecordIndex
+
+from test_data_models import MockKGClient
+
+
+class FakeRecordsKG:
+    """Stands in for an AsyncKGClient, applying KG query filters to records held in memory"""
+
+    def __init__(self, records, user="alice", accessible=("collab-a", "collab-b", "computation"),
+                 readable=("collab-a", "collab-b")):
+        self.records = records
+        self.user = user
+        self.accessible = list(accessible)
+        self.readable = frozenset(readable)
+        self.queries = []
+        self.retrieved = 0
+
+    async def spaces(self, permissions, names_only):
+        return self.accessible
+
+    async def readable_spaces(self):
+        return self.readable
+
+    async def list(self, cls, scope, space, size, from_index, api="auto", **filters):
+        self.queries.append(filters)
+        matches = [
+            record for record in self.records
+            if all(getattr(value, "uuid", value) in [getattr(item, "uuid", item) for item in as_list(getattr(record, name))]
+                   for name, value in filters.items())
+        ]
+        self.retrieved += len(matches[from_index:from_index + size])
+        return matches[from_index:from_index + size]
+
+    async def from_uuids(self, cls, uuids, scope):
+        records = {record.uuid: record for record in self.records}
+        self.retrieved += len(uuids)
+        return [records[uuid] for uuid in uuids if uuid in records]
+
+
+def make_fake_record(i, inputs=(), environment=None, tags=()):
+    return SimpleNamespace(uuid=f"record-{i}", inputs=[SimpleNamespace(uuid=x) for x in inputs],
+                           environment=environment and SimpleNamespace(uuid=environment),
+                           tags=list(tags), start_time=datetime.fromtimestamp(1640995200 + 3600 * i),
+                           end_time=datetime.fromtimestamp(1640995200 + 3600 * (i + 100 * (i % 2))))
+
+
+def make_fake_token(expiry):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": expiry}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+@pytest.fixture
+def mock_kg_client():
+    return MockKGClient()
+
+
+@pytest.fixture
+def records_kg():
+    """Factory for in-memory stand-ins for an AsyncKGClient"""
+    return FakeRecordsKG
+
+
+@pytest.fixture
+def fake_record():
+    return make_fake_record
+
+
+@pytest.fixture
+def fake_token():
+    return make_fake_token
+
+
+@pytest.fixture
+def record_index(monkeypatch, tmp_path):
+    """An empty record index, used in place of the shared one"""
+    index = RecordIndex(ttl=60, signal_dir=str(tmp_path))
+    monkeypatch.setattr(filters_module, "record_index", index)
+    return index
@@ -0,0 +1,133 @@
+
+import sys
+import asyncio
+import base64
+import time
+from authlib.jose import JsonWebKey
+
+import pytest
+import httpx
+
+sys.path.append(".")
+from provenance.auth.tokens import JWKSCache, decode_token, user_info_from_claims, InvalidToken, jwt
+from provenance.auth import utils as auth_utils
+from provenance.auth import http_client
+
+
+class TestPermissionCache:
+
+    def test_bulk_edit_needs_one_lookup(self, fake_token, monkeypatch):
+        lookups = []
+
+        async def get_user_info(user_token):
+            lookups.append("userinfo")
+            return {"sub": "0000-1111", "roles": {"team": ["collab-myproject-administrator"]}, "groups": []}
+
+        async def get_collab_info(collab_id, user_token):
+            lookups.append(collab_id)
+            return {"isPublic": False}
+
+        monkeypatch.setattr(auth_utils, "_get_user_info", get_user_info)
+        monkeypatch.setattr(auth_utils, "get_collab_info", get_collab_info)
+        token = fake_token(time.time() + 300)
+
+        async def main():
+            return await asyncio.gather(
+                *[auth_utils.is_collab_admin("collab-myproject", token) for i in range(500)],
+                *[auth_utils.is_collab_admin("collab-private", token) for i in range(500)])
+
+        results = asyncio.run(main())
+        assert all(results[:500]) and not any(results[500:])
+        # the negative result for the non-public collab is also cached
+        assert lookups == ["userinfo", "private"]
+
+
+class TestAuthHTTPClient:
+
+    def test_retry_when_unavailable(self, monkeypatch):
+        responses = [httpx.Response(503), httpx.Response(200, json={"isPublic": True})]
+
+        def handler(request):
+            return responses.pop(0)
+
+        monkeypatch.setattr(http_client, "_create_client",
+                            lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+        async def main():
+            data = await http_client.get_json("https://wiki.example.org/collabs/myproject", backoff=0)
+            # the same client, with its connection pool, is used for all requests
+            assert http_client.get_client() is http_client.get_client()
+            await http_client.close_client()
+            return data
+
+        assert asyncio.run(main()) == {"isPublic": True}
+        assert responses == []
+
+
+class FakeIAM:
+    """Identity provider which signs tokens with a locally generated key"""
+    issuer = "https://iam.example.org/auth/realms/test"
+
+    def __init__(self):
+        self.requests = 0
+        self.rotate()
+
+    def rotate(self):
+        self.key = JsonWebKey.generate_key("RSA", 2048, is_private=True, options={"kid": f"key{time.time()}"})
+
+    async def fetch_json(self, url):
+        self.requests += 1
+        if url.endswith("openid-configuration"):
+            return {"issuer": self.issuer, "jwks_uri": f"{self.issuer}/certs"}
+        return {"keys": [self.key.as_dict(is_private=False)]}
+
+    def issue_token(self, lifetime=300, **claims):
+        claims.setdefault("iss", self.issuer)
+        claims.setdefault("sub", "0000-1111")
+        claims["exp"] = int(time.time()) + lifetime
+        return jwt.encode({"alg": "RS256", "kid": self.key.kid}, claims, self.key).decode("ascii")
+
+
+class TestTokenValidation:
+
+    def setup_method(self):
+        self.iam = FakeIAM()
+        self.keys = JWKSCache(f"{self.iam.issuer}/.well-known/openid-configuration",
+                              min_refresh_interval=0, fetch_json=self.iam.fetch_json)
+
+    def test_valid_token(self):
+        token = self.iam.issue_token(preferred_username="adavison",
+                                     roles={"team": ["collab-myproject-editor"]}, groups=[])
+        claims = asyncio.run(decode_token(token, self.keys))
+        user_info = user_info_from_claims(claims)
+        assert user_info["id"] == "0000-1111"
+        assert user_info["username"] == "adavison"
+        assert user_info["roles"]["team"] == ["collab-myproject-editor"]
+        # the keys are cached
+        asyncio.run(decode_token(token, self.keys))
+        assert self.iam.requests == 2
+
+    def test_token_without_roles(self):
+        claims = asyncio.run(decode_token(self.iam.issue_token(), self.keys))
+        assert user_info_from_claims(claims) is None
+
+    def test_invalid_tokens(self):
+        with pytest.raises(InvalidToken):
+            asyncio.run(decode_token(self.iam.issue_token(lifetime=-60), self.keys))
+        with pytest.raises(InvalidToken):
+            asyncio.run(decode_token(self.iam.issue_token(iss="https://elsewhere.example.org"), self.keys))
+        other_iam = FakeIAM()
+        with pytest.raises(InvalidToken):
+            asyncio.run(decode_token(other_iam.issue_token(), self.keys))
+        with pytest.raises(InvalidToken):
+            asyncio.run(decode_token("not-a-token", self.keys))
+        # a header which is valid JSON, but not an object
+        header = base64.urlsafe_b64encode(b"[]").decode().rstrip("=")
+        with pytest.raises(InvalidToken):
+            asyncio.run(decode_token(f"{header}.e30.signature", self.keys))
+
+    def test_key_rotation(self):
+        asyncio.run(decode_token(self.iam.issue_token(), self.keys))
+        self.iam.rotate()
+        asyncio.run(decode_token(self.iam.issue_token(), self.keys))
+        assert self.keys.refresh_count == 2
@@ -0,0 +1,269 @@
+
+import sys
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Response
+from pydantic import BaseModel
+
+sys.path.append(".")
+from provenance.common import cache as cache_module
+from provenance.common.cache import TTLCache, AsyncTTLCache, SingleFlight
+from provenance.common.kg_client import AsyncKGClient
+from provenance.common import utils as common_utils
+from provenance.common import data_models
+import fairgraph.errors
+import fairgraph.openminds.core as omcore
+from fairgraph.base import KGProxy
+
+
+class TestTTLCache:
+
+    def test_lru_eviction(self):
+        cache = TTLCache(ttl=60, max_bytes=100)
+        cache.put("a", 1, size=40)
+        cache.put("b", 2, size=40)
+        assert cache.get("a") == 1  # "b" is now the least recently used
+        cache.put("c", 3, size=40)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.total_bytes == 80
+        metrics = cache.metrics()
+        assert (metrics["hits"], metrics["misses"], metrics["evictions"]) == (3, 1, 1)
+
+    def test_max_entries(self):
+        cache = TTLCache(ttl=60, max_entries=2)
+        for key in "abc":
+            cache.put(key, key.upper())
+        assert cache.get("a") is None
+        assert (cache.get("b"), cache.get("c")) == ("B", "C")
+        assert cache.metrics()["evictions"] == 1
+
+    def test_expiry(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+        cache = TTLCache(ttl=60, max_bytes=100)
+        cache.put("a", 1)
+        now[0] += 59
+        assert cache.get("a") == 1
+        now[0] += 2
+        assert cache.get("a") is None
+        assert cache.metrics()["expirations"] == 1
+        assert len(cache) == 0
+
+
+class TestAsyncTTLCache:
+
+    def test_concurrent_requests_share_computation(self):
+        cache = AsyncTTLCache(ttl=60, max_bytes=100)
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "value"
+
+        async def main():
+            return await asyncio.gather(*[cache.get_or_compute("key", compute) for i in range(10)])
+
+        assert asyncio.run(main()) == ["value"] * 10
+        assert len(calls) == 1
+        assert cache.metrics()["coalesced"] == 9
+        assert asyncio.run(cache.get_or_compute("key", compute)) == "value"
+        assert len(calls) == 1
+
+    def test_exceptions_not_cached(self):
+        cache = AsyncTTLCache(ttl=60, max_bytes=100)
+
+        async def fail():
+            raise ValueError()
+
+        for i in range(2):
+            with pytest.raises(ValueError):
+                asyncio.run(cache.get_or_compute("key", fail))
+        assert len(cache) == 0
+
+
+class TestSingleFlight:
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "value"
+
+        async def main():
+            first = asyncio.ensure_future(single_flight.do("key", compute))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(single_flight.do("key", compute))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            return await second
+
+        assert asyncio.run(main()) == "value"
+        assert calls == [1]
+        assert single_flight.metrics()["in_flight"] == 0
+
+    def test_computation_cancelled_with_last_caller(self):
+        single_flight = SingleFlight()
+        cancelled = []
+
+        async def compute():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        async def main():
+            callers = [asyncio.ensure_future(single_flight.do("key", compute)) for i in range(2)]
+            await asyncio.sleep(0.01)
+            for caller in callers:
+                caller.cancel()
+            await asyncio.gather(*callers, return_exceptions=True)
+            await asyncio.sleep(0)
+
+        asyncio.run(main())
+        assert cancelled == [1]
+        assert single_flight.metrics()["in_flight"] == 0
+
+
+class TestRequestCoalescing:
+
+    def test_identical_requests_share_result(self):
+        calls = []
+
+        @common_utils.coalesce_requests
+        async def get_record(record_id, token):
+            calls.append((record_id, token.credentials))
+            await asyncio.sleep(0.01)
+            return {"id": record_id}
+
+        alice, bob = SimpleNamespace(credentials="alice"), SimpleNamespace(credentials="bob")
+
+        async def main():
+            return await asyncio.gather(
+                *[get_record(record_id="123", token=alice) for i in range(5)],
+                get_record(record_id="123", token=bob),
+                get_record(record_id="456", token=alice),
+            )
+
+        results = asyncio.run(main())
+        assert results == [{"id": "123"}] * 6 + [{"id": "456"}]
+        # requests from different users, or with different parameters, are not coalesced
+        assert calls == [("123", "alice"), ("123", "bob"), ("456", "alice")]
+
+    def test_headers_are_shared(self):
+        calls = []
+
+        @common_utils.coalesce_requests
+        async def list_records(response, size, token):
+            calls.append(size)
+            await asyncio.sleep(0.01)
+            response.headers["Link"] = '<https://example.org/?cursor=abc>; rel="next"'
+            return [1, 2]
+
+        token = SimpleNamespace(credentials="alice")
+        responses = [Response() for i in range(3)]
+
+        async def main():
+            return await asyncio.gather(*(list_records(response=r, size=2, token=token) for r in responses))
+
+        assert asyncio.run(main()) == [[1, 2]] * 3
+        assert calls == [2]
+        assert all(r.headers["link"] == '<https://example.org/?cursor=abc>; rel="next"' for r in responses)
+
+
+class TestResponseCache:
+
+    def test_records_shared_between_users_with_same_access(self, mock_kg_client, monkeypatch):
+        conversions = []
+        readable_spaces = {
+            "alice": {"computation"},
+            "bob": set(),
+            "carol": {"computation"},
+            "dave": {"computation", "myspace"},
+            "erin": {"computation", "myspace"},
+        }
+
+        class FakeKGRecord:
+            @classmethod
+            def from_uuid(cls, uuid, client, scope):
+                return SimpleNamespace(
+                    data={"https://core.kg.ebrains.eu/vocab/meta/revision": "_rev1"},
+                    space="computation"
+                )
+
+        class Record(BaseModel):
+            name: str
+
+            @classmethod
+            def from_kg_object(cls, kg_object, client):
+                conversions.append(kg_object)
+                return cls(name="record")
+
+        monkeypatch.setattr(common_utils, "get_async_kg_client_for_user_account",
+                            lambda token: AsyncKGClient(mock_kg_client))
+        monkeypatch.setattr(common_utils, "get_readable_spaces", lambda token, client: readable_spaces[token])
+        common_utils.RESPONSE_CACHE.clear()
+        record_id = "3fa85f64-5717-4562-b3fc-2c963f66afa6"
+        for user in ("alice", "alice", "bob", "carol"):
+            record = asyncio.run(common_utils.retrieve_computation(
+                Record, FakeKGRecord, "record", record_id, SimpleNamespace(credentials=user)))
+            assert record.name == "record"
+        # converted once for alice and carol, who have the same access, and once for bob
+        assert len(conversions) == 2
+        # users who can read their private space never share entries
+        for user in ("dave", "erin", "dave"):
+            asyncio.run(common_utils.retrieve_computation(
+                Record, FakeKGRecord, "record", record_id, SimpleNamespace(credentials=user)))
+        assert len(conversions) == 4
+
+    def test_authentication_error(self, monkeypatch):
+        class ExpiredTokenClient:
+            def __init__(self):
+                self.client = None
+                self.user = "alice"
+
+            async def from_uuid(self, cls, uuid, scope):
+                raise fairgraph.errors.AuthenticationError("token expired")
+
+        monkeypatch.setattr(common_utils, "get_async_kg_client_for_user_account", lambda token: ExpiredTokenClient())
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(common_utils.retrieve_computation(
+                None, None, "record", "3fa85f64-5717-4562-b3fc-2c963f66afa6", SimpleNamespace(credentials="alice")))
+        assert exc_info.value.status_code == 401
+
+
+class TestSubmodelCache:
+
+    def test_entries_not_shared_between_users(self, monkeypatch):
+        monkeypatch.setattr(data_models, "SUBMODEL_CACHE", TTLCache(ttl=60, max_bytes=10_000))
+        resolved = []
+
+        class Name(BaseModel):
+            name: str
+
+            @classmethod
+            @data_models.cached_conversion
+            def from_kg_object(cls, kg_object, client):
+                resolved.append(client.user)
+                return cls(name=f"as seen by {client.user}")
+
+        proxy = KGProxy(omcore.Person, "https://kg.ebrains.eu/api/instances/1e7a6a6e-0bd6-4b9f-a1f1-6d9f1a4b0f77")
+        alice, bob = SimpleNamespace(user="alice"), SimpleNamespace(user="bob")
+        assert Name.from_kg_object(proxy, alice).name == "as seen by alice"
+        assert Name.from_kg_object(proxy, alice).name == "as seen by alice"
+        assert Name.from_kg_object(proxy, bob).name == "as seen by bob"
+        assert resolved == ["alice", "bob"]
+        # clients not associated with a user are not cached
+        Name.from_kg_object(proxy, SimpleNamespace(user=None))
+        Name.from_kg_object(proxy, SimpleNamespace(user=None))
+        assert resolved == ["alice", "bob", None, None]
@@ -12,7 +12,8 @@ import jsondiff
 from pydantic import parse_obj_as
 
 sys.path.append(".")
-from provenance.common.data_models import ResourceUsage, get_repository_iri
+from provenance.common.data_models import ResourceUsage, get_repository_iri, UNITS, Units
+from provenance.common.repositories import classify_url
 from provenance.dataanalysis.data_models import DataAnalysis
 from provenance.visualisation.data_models import Visualisation
 from provenance.optimisation.data_models import Optimisation
@@ -27,7 +28,7 @@ import provenance.workflows.examples
 import fairgraph.openminds.core as omcore
 import fairgraph.openminds.controlledterms as omterms
 import fairgraph.openminds.computation as omcmp
-from fairgraph.base import IRI
+from fairgraph.base import IRI, KGProxy
 
 
 EXAMPLES = provenance.common.examples.EXAMPLES
@@ -96,12 +97,37 @@ class TestCommon:
         repo_iri = str(get_repository_iri(file_iri))
         assert repo_iri == "https://gpfs-proxy.brainsimulation.eu/cscs/myproject"
 
+    def test_classify_url(self):
+        info = classify_url("https://data-proxy.ebrains.eu/api/v1/buckets/my-collab/run1/output1.nwb")
+        assert info.host == "EBRAINS"
+        assert info.iri == "https://data-proxy.ebrains.eu/api/v1/buckets/my-collab"
+        assert info.name == "my-collab"
+        assert info.type == "Swift repository"
+
+        info = classify_url("https://gitlab.ebrains.eu/myorg/myproject/-/blob/main/workflow.cwl")
+        assert info.iri == "https://gitlab.ebrains.eu/myorg/myproject"
+        assert info.type == "GitLab repository"
+
+        info = classify_url("https://zenodo.org/record/1234/files/data.zip")
+        assert info.host == "CERN"
+        assert info.iri is None
+
     def test_resource_usage(self):
         pydantic_obj = parse_obj_as(ResourceUsage, EXAMPLES["ResourceUsage"])
         kg_client = MockKGClient()
         kg_object = pydantic_obj.to_kg_object(kg_client)
         assert isinstance(kg_object, QuantitativeValue)
 
+    def test_resource_usage_units_resolved_locally(self):
+        class NoKGClient(MockKGClient):
+            def instance_from_full_uri(self, uri, use_cache=True, scope="released", resolved=False):
+                raise AssertionError("controlled terms should not be retrieved from the KG")
+
+        unit = UNITS[Units("core-hour")]
+        kg_object = QuantitativeValue(value=1.5, unit=KGProxy(omterms.UnitOfMeasurement, unit.id))
+        pydantic_obj = ResourceUsage.from_kg_object(kg_object, NoKGClient())
+        assert pydantic_obj.units == Units("core-hour")
+
     def test_numerical_parameter(self):
         pass
 
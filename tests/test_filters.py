@@ -0,0 +1,216 @@
+
+import sys
+from types import SimpleNamespace
+from datetime import datetime
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.append(".")
+from provenance.common.filters import QueryFilters, list_computations
+from provenance.common.data_models import SortOrder
+import fairgraph.openminds.computation as omcmp
+
+
+class TestQueryFilters:
+
+    def test_single_query(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i, environment=f"env-{i % 3}") for i in range(30)])
+        filters = QueryFilters()
+        filters.require("environment", [SimpleNamespace(uuid="env-1")])
+        filters.compile()
+        assert filters.kg_filters == {"environment": filters.conditions[0][1][0]}
+        results = asyncio.run(list_computations(kg, None, filters, space="myspace", size=5, from_index=5))
+        # a single KG query, for just the requested page, in the order given by the KG
+        assert [r.uuid for r in results] == [f"record-{i}" for i in range(16, 30, 3)]
+        assert len(kg.queries) == 1
+
+    def test_no_possible_match(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i) for i in range(10)])
+        filters = QueryFilters()
+        filters.require("environment", [])  # e.g. no environments on the requested platform
+        assert asyncio.run(list_computations(kg, None, filters.compile())) == []
+        assert kg.queries == []
+
+    def test_all_inputs(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i, inputs=["model", f"data-{i % 2}"]) for i in range(20)])
+        filters = QueryFilters()
+        filters.require("inputs", ["model"])
+        filters.require("inputs", ["data-0"])
+        filters.compile()
+        assert filters.kg_filters == {"inputs": "model"}
+        results = asyncio.run(list_computations(kg, None, filters, size=3, from_index=1))
+        assert [r.uuid for r in results] == ["record-2", "record-4", "record-6"]
+
+    def test_multiple_values(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i, inputs=[f"file-{i % 4}"]) for i in range(12)])
+        filters = QueryFilters()
+        filters.require("inputs", ["file-1", "file-2"])
+        results = asyncio.run(list_computations(kg, None, filters.compile(), size=10))
+        assert len(kg.queries) == 2
+        assert sorted(r.uuid for r in results) == sorted(
+            f"record-{i}" for i in (1, 2, 5, 6, 9, 10))
+
+
+    def test_workflows_by_recipe(self, record_index, records_kg):
+        workflows = [SimpleNamespace(uuid=f"wf-{i}", recipe=SimpleNamespace(uuid=f"recipe-{i % 2}"))
+                     for i in range(10)]
+        kg = records_kg(workflows)
+        filters = QueryFilters()
+        filters.require("recipe", "recipe-1")
+        results = asyncio.run(list_computations(kg, omcmp.WorkflowExecution, filters.compile(),
+                                                space="collab-a", size=3))
+        # the recipe is sent to the KG, and the stages of the workflows are not indexed
+        assert [r.uuid for r in results] == ["wf-1", "wf-3", "wf-5"]
+        assert kg.queries == [{"recipe": "recipe-1"}]
+        assert record_index.metrics()["loads"] == 0
+
+
+class TestTimeFilters:
+
+    def test_time_range_from_index(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i) for i in range(500)])
+        filters = QueryFilters()
+        filters.require_time_range(started_after=datetime.fromtimestamp(1640995200 + 3600 * 100),
+                                   started_before=datetime.fromtimestamp(1640995200 + 3600 * 200))
+        filters.order_by = SortOrder.start_time
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(),
+                                                space="collab-a", size=3, from_index=2))
+        assert [r.uuid for r in results] == ["record-102", "record-103", "record-104"]
+        filters.order_by = SortOrder.end_time_descending
+        retrieved = kg.retrieved
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters, space="collab-a", size=2))
+        assert [r.uuid for r in results] == ["record-199", "record-197"]
+        assert kg.retrieved - retrieved == 2
+
+    def test_time_range_with_kg_filters(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i, environment=f"env-{i % 2}") for i in range(500)])
+        filters = QueryFilters()
+        filters.require("environment", [SimpleNamespace(uuid="env-1")])
+        filters.require_time_range(ended_after=datetime.fromtimestamp(1640995200 + 3600 * 450))
+        asyncio.run(record_index.select(kg, omcmp.Simulation, "collab-a"))  # load the index
+        kg.queries, kg.retrieved = [], 0
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(), space="collab-a", size=3))
+        # most recent first, by default
+        assert [r.uuid for r in results] == ["record-499", "record-497", "record-495"]
+        # the environment is sent to the KG, and only the matching records are retrieved
+        assert kg.queries == [{"environment": filters.conditions[0][1][0]}] * 3
+        assert kg.retrieved == 250
+
+
+class TestCursorPagination:
+
+    @staticmethod
+    def all_pages(kg, cls, make_filters, size):
+        pages = []
+        cursor = None
+        while True:
+            filters = make_filters()
+            if cursor:
+                filters.resume_from(cursor)
+            retrieved = kg.retrieved
+            page = asyncio.run(list_computations(kg, cls, filters.compile(), space="collab-a", size=size))
+            pages.append(([r.uuid for r in page], kg.retrieved - retrieved))
+            if filters.next_cursor is None:
+                return pages
+            cursor = filters.next_cursor
+
+    @staticmethod
+    def most_recent_first():
+        filters = QueryFilters(parameters={"space": "collab-a", "order_by": "-start_time"})
+        filters.order_by = SortOrder.start_time_descending
+        return filters
+
+    def test_pagination_from_kg(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i) for i in range(100)])
+        pages = self.all_pages(kg, omcmp.Simulation, lambda: QueryFilters(parameters={"space": "collab-a"}), 30)
+        # in the order given by the KG, with one KG query per page
+        assert [uuid for page, _ in pages for uuid in page] == [f"record-{i}" for i in range(100)]
+        assert [n_retrieved for _, n_retrieved in pages] == [30, 30, 30, 10]
+        assert [query for query in kg.queries] == [{}] * 4
+        assert record_index.metrics()["entries"] == 0
+
+    def test_pagination_of_several_kg_queries(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i, inputs=[f"file-{i % 3}", f"file-{i % 4}"]) for i in range(1200)])
+
+        def make_filters():
+            filters = QueryFilters(parameters={"input_data": ["file-1", "file-2"]})
+            filters.require("inputs", ["file-1", "file-2"])
+            return filters
+
+        pages = self.all_pages(kg, omcmp.Simulation, make_filters, 100)
+        # the results of each query in turn, without the records also found by an earlier query
+        assert [uuid for page, _ in pages for uuid in page] == (
+            [f"record-{i}" for i in range(1200) if 1 in (i % 3, i % 4)]
+            + [f"record-{i}" for i in range(1200) if 2 in (i % 3, i % 4) and 1 not in (i % 3, i % 4)])
+        # each page carries on from where the previous one ended, rather than from the start
+        assert max(n_retrieved for _, n_retrieved in pages) <= 300
+        assert sum(n_retrieved for _, n_retrieved in pages) < 2 * (600 + 600)
+
+    def test_deep_pagination_from_index(self, record_index, records_kg, fake_record):
+        records = [fake_record(i) for i in range(1000)]
+        records[500].start_time = None
+        kg = records_kg(records)
+        asyncio.run(record_index.select(kg, omcmp.Simulation, "collab-a"))  # load the index
+        pages = self.all_pages(kg, omcmp.Simulation, self.most_recent_first, 25)
+        assert [uuid for page, _ in pages for uuid in page] == (
+            [f"record-{i}" for i in range(999, -1, -1) if i != 500] + ["record-500"])
+        # every page costs the same, however deep it is
+        assert set(n_retrieved for _, n_retrieved in pages[:-1]) == {25}
+
+    def test_pages_are_stable(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i) for i in range(10)])
+        filters = self.most_recent_first()
+        page = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(), space="collab-a", size=4))
+        cursor = filters.next_cursor
+        # a record added after the first page was retrieved does not shift the following pages
+        new_record = fake_record(20)
+        kg.records.append(new_record)
+        record_index.put("alice", "collab-a", new_record)
+        filters = self.most_recent_first()
+        filters.resume_from(cursor)
+        page = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(), space="collab-a", size=4))
+        assert [r.uuid for r in page] == ["record-5", "record-4", "record-3", "record-2"]
+
+    def test_pagination_with_kg_filters(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i, environment=f"env-{i % 3}") for i in range(300)])
+
+        def make_filters():
+            filters = QueryFilters(parameters={"platform": "spinnaker"})
+            filters.require("environment", [SimpleNamespace(uuid="env-1"), SimpleNamespace(uuid="env-2")])
+            filters.order_by = SortOrder.start_time
+            return filters
+
+        pages = self.all_pages(kg, omcmp.Simulation, make_filters, 30)
+        assert [uuid for page, _ in pages for uuid in page] == [f"record-{i}" for i in range(300) if i % 3]
+
+    def test_records_deleted_elsewhere(self, record_index, records_kg, fake_record):
+        kg = records_kg([fake_record(i) for i in range(10)])
+        asyncio.run(record_index.select(kg, omcmp.Simulation, "collab-a"))  # load the index
+        # records deleted outside this API remain in the index until it is reloaded
+        del kg.records[5:9]
+        pages = self.all_pages(kg, omcmp.Simulation, self.most_recent_first, 3)
+        # the gaps make some pages short, but don't end the pagination early
+        assert [page for page, _ in pages] == [["record-9"], ["record-4"], ["record-3", "record-2", "record-1"],
+                                               ["record-0"]]
+
+    def test_invalid_cursor(self, fake_record):
+        filters = QueryFilters(parameters={"tags": ["a"]})
+        cursor = filters.cursor_after(fake_record(1))
+        with pytest.raises(HTTPException) as exc_info:
+            QueryFilters(parameters={"tags": ["b"]}).resume_from(cursor)
+        assert exc_info.value.status_code == 400
+        with pytest.raises(HTTPException) as exc_info:
+            QueryFilters(parameters={"tags": ["a"]}).resume_from("not-a-cursor")
+        assert exc_info.value.status_code == 400
+        QueryFilters(parameters={"tags": ["a"]}).resume_from(cursor)
+
+    def test_cursor_for_other_kind_of_query(self, record_index, records_kg, fake_record):
+        # e.g. from before the server was upgraded
+        filters = QueryFilters(parameters={"tags": ["a"]})
+        filters.resume_from(filters.cursor_at(100))
+        filters.require_tags(["a"])
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(list_computations(records_kg([]), omcmp.Simulation, filters.compile()))
+        assert exc_info.value.status_code == 400
@@ -0,0 +1,262 @@
+
+import sys
+from types import SimpleNamespace
+from datetime import datetime
+import asyncio
+
+import pytest
+
+sys.path.append(".")
+from provenance.common.filters import QueryFilters, list_computations
+from provenance.common.indexes import EnvironmentIndex, RecordIndex, IndexedRecords
+import fairgraph.errors
+import fairgraph.openminds.computation as omcmp
+
+
+ID_PREFIX = "https://kg.ebrains.eu/api/instances"
+
+
+class TestRecordIndex:
+
+    def test_intersection(self):
+        records = IndexedRecords()
+        records.put("a", ["x", "y"], 1.0, None)
+        records.put("b", ["x"], 2.0, None)
+        records.put("c", ["x", "y", "z"], 3.0, None)
+        assert records.matching(["x", "y"]) == {"a", "c"}
+        assert records.matching(["y", "missing"]) == set()
+        records.put("c", ["z"], 3.0, None)  # tags changed
+        records.remove("a")
+        assert records.matching(["x"]) == {"b"}
+        assert records.matching(["z"]) == {"c"}
+        assert "y" not in records.by_tag
+
+    def test_workflow_tags(self, records_kg, fake_record):
+        stages = [fake_record(1, tags=["a"]), fake_record(2, tags=["b"]), fake_record(3, tags=["a"])]
+        workflows = [
+            SimpleNamespace(uuid="wf-1", stages=[SimpleNamespace(uuid="record-1"), SimpleNamespace(uuid="record-2")]),
+            SimpleNamespace(uuid="wf-2", stages=[SimpleNamespace(uuid="record-3")]),
+        ]
+
+        class FakeKG(records_kg):
+            async def list(self, cls, scope, space, size, from_index):
+                records = {omcmp.WorkflowExecution: workflows, omcmp.Simulation: stages}.get(cls, [])
+                return records[from_index:from_index + size]
+
+        index = RecordIndex(ttl=60)
+        # a workflow has the tags of its stages, and runs from the start of the first to the end of the last
+        selected = asyncio.run(index.select(FakeKG([]), omcmp.WorkflowExecution, "collab-a", tags=["a", "b"]))
+        assert list(selected) == ["wf-1"]
+        assert selected["wf-1"].start_time == stages[0].start_time.timestamp()
+        assert selected["wf-1"].end_time == max(stages[0].end_time, stages[1].end_time).timestamp()
+
+    def test_query_by_tags(self, record_index, records_kg, fake_record):
+        index = record_index
+        records = [
+            fake_record(i, inputs=[f"data-{i % 2}"], tags=["campaign"] + (["b"] if i % 3 else []))
+            for i in range(200)
+        ] + [fake_record(i) for i in range(200, 1000)]
+        kg = records_kg(records)
+        filters = QueryFilters()
+        filters.require_tags(["campaign", "b"])
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(),
+                                                space="collab-a", size=3, from_index=1))
+        # most recent first
+        assert [r.uuid for r in results] == ["record-197", "record-196", "record-194"]
+        loaded = kg.retrieved
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters,
+                                                space="collab-a", size=3, from_index=1))
+        # the index is reused, and only the records in the page are retrieved
+        assert kg.retrieved - loaded == 3
+
+        # records saved through the API update the index
+        class Simulation(SimpleNamespace):
+            pass
+
+        new_record = Simulation(uuid="new", inputs=[], tags=["b", "campaign"],
+                                start_time=datetime(2023, 1, 1), end_time=None)
+        kg.records.append(new_record)
+        index.put("alice", "collab-a", new_record)
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters, space="collab-a", size=1))
+        assert [r.uuid for r in results] == ["new"]
+
+        # other conditions are checked on the records
+        filters.require("inputs", ["data-0"])
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(),
+                                                space="collab-a", size=2))
+        assert [r.uuid for r in results] == ["record-196", "record-194"]
+
+        # and deleted ones are removed
+        index.remove("alice", "collab-a", new_record)
+        filters = QueryFilters()
+        filters.require_tags(["campaign"])
+        results = asyncio.run(list_computations(kg, omcmp.Simulation, filters.compile(), space="collab-a", size=1))
+        assert [r.uuid for r in results] == ["record-199"]
+
+    def test_entries_shared_only_between_users_with_same_access(self, records_kg, fake_record):
+        class FakeKG(records_kg):
+            async def list(self, cls, scope, space, size, from_index):
+                records = [record for record in self.records if scope == "any" or record.released]
+                return records[from_index:from_index + size]
+
+        records = [fake_record(i) for i in range(4)]
+        for i, record in enumerate(records):
+            record.released = (i % 2 == 0)
+        member = FakeKG(records, user="alice")
+        visitor = FakeKG(records, user="bob", readable=())
+        index = RecordIndex(ttl=60)
+        # loaded first for a user who can only read the released records
+        assert sorted(asyncio.run(index.select(visitor, omcmp.Simulation, "collab-a"))) == ["record-0", "record-2"]
+        assert len(asyncio.run(index.select(member, omcmp.Simulation, "collab-a"))) == 4
+        assert sorted(asyncio.run(index.select(visitor, omcmp.Simulation, "collab-a"))) == ["record-0", "record-2"]
+        assert index.loads == 2
+        # a space the user cannot access is not searched
+        outsider = FakeKG(records, user="carol", accessible=["collab-b"], readable=["collab-b"])
+        assert asyncio.run(index.select(outsider, omcmp.Simulation, "collab-a")) == {}
+        assert index.loads == 2
+
+    def test_stale_entries_reloaded(self, records_kg, fake_record):
+        kg = records_kg([fake_record(i, tags=["a"]) for i in range(3)])
+        index = RecordIndex(ttl=60)
+        assert len(asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))) == 3
+        # records saved by another process are not seen until the entry expires
+        kg.records.append(fake_record(3, tags=["a"]))
+        assert len(asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))) == 3
+        index._entries[(None, "collab-a", "any", "Simulation")].loaded_at -= 61
+        assert len(asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))) == 4
+        assert index.loads == 2
+
+    def test_changes_made_by_other_workers(self, records_kg, fake_record, tmp_path):
+        class Simulation(SimpleNamespace):
+            pass
+
+        kg = records_kg([fake_record(i, tags=["a"]) for i in range(3)])
+        workers = [RecordIndex(ttl=60, signal_dir=str(tmp_path)) for i in range(2)]
+        for index in workers:
+            assert len(asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))) == 3
+        new_record = Simulation(uuid="new", tags=["a"], start_time=datetime(2023, 1, 1), end_time=None)
+        kg.records.append(new_record)
+        workers[1].put("alice", "collab-a", new_record)
+        # the worker which saved the record updates its entry, the other reloads its own
+        for index in workers:
+            assert len(asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))) == 4
+        assert [index.loads for index in workers] == [2, 1]
+
+    def test_stale_entry_kept_if_reload_fails(self, records_kg, fake_record):
+        kg = records_kg([fake_record(i, tags=["a"]) for i in range(3)])
+        index = RecordIndex(ttl=60)
+        asyncio.run(index.select(kg, omcmp.Simulation, "collab-a"))
+        index._entries[(None, "collab-a", "any", "Simulation")].loaded_at -= 61
+
+        async def fail(*args, **kwargs):
+            raise ConnectionError("KG unavailable")
+
+        kg.list = fail
+        assert len(asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))) == 3
+        assert index.load_errors == 1
+
+    def test_load_errors_without_entry_are_raised(self, records_kg):
+        async def fail(*args, **kwargs):
+            raise ConnectionError("KG unavailable")
+
+        kg = records_kg([])
+        kg.list = fail
+        index = RecordIndex(ttl=60)
+        # rather than answering the query as if the space were empty
+        with pytest.raises(ConnectionError):
+            asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))
+        assert index.load_errors == 1
+
+    def test_authentication_errors_are_raised(self, records_kg, fake_record):
+        kg = records_kg([fake_record(i, tags=["a"]) for i in range(3)])
+        index = RecordIndex(ttl=60)
+        asyncio.run(index.select(kg, omcmp.Simulation, "collab-a"))
+        index._entries[(None, "collab-a", "any", "Simulation")].loaded_at -= 61
+
+        async def expired(*args, **kwargs):
+            raise fairgraph.errors.AuthenticationError("token expired")
+
+        # even with a previous entry, since the user should not be served from it
+        kg.list = expired
+        with pytest.raises(fairgraph.errors.AuthenticationError):
+            asyncio.run(index.select(kg, omcmp.Simulation, "collab-a", tags=["a"]))
+
+
+class TestEnvironmentIndex:
+
+    class FakeKG:
+
+        def __init__(self, user, environments):
+            self.user = user
+            self.environments = environments  # space -> list of environments
+            self.calls = []
+            self.unavailable = False  # when True, only filtered queries succeed
+
+        async def spaces(self, permissions, names_only):
+            return ["collab-a", "dataset", "computation"]
+
+        async def readable_spaces(self):
+            return {"collab-a", "dataset"}
+
+        async def list(self, cls, scope, space, size, from_index, hardware=None):
+            self.calls.append(space)
+            if hardware is None and self.unavailable:
+                raise ConnectionError("KG query timed out")
+            environments = [env for env in self.environments.get(space, [])
+                            if hardware is None or env.hardware.id == hardware.id]
+            return environments[from_index:from_index + size]
+
+    @staticmethod
+    def environment(uuid, hardware_id):
+        return SimpleNamespace(id=f"{ID_PREFIX}/{uuid}", uuid=uuid, hardware=SimpleNamespace(id=hardware_id))
+
+    jureca = SimpleNamespace(id="jureca")
+    pizdaint = SimpleNamespace(id="pizdaint")
+
+    def test_lookup_and_incremental_update(self, tmp_path):
+        env = self.environment
+        index = EnvironmentIndex(ttl=60, page_size=2, signal_dir=str(tmp_path))
+        environments = {
+            "myspace": [env("e1", "jureca")],
+            "collab-a": [env("e2", "jureca"), env("e3", "pizdaint"), env("e4", "jureca")],
+            "computation": [env("e5", "pizdaint")],
+        }
+        alice = self.FakeKG("alice", environments)
+        ids = asyncio.run(index.environment_ids(alice, self.jureca))
+        assert ids == {"e1", "e2", "e4"}
+        # "dataset" cannot contain computation records, so is not loaded; "collab-a" needs two pages
+        assert sorted(alice.calls) == ["collab-a", "collab-a", "computation", "myspace"]
+        assert asyncio.run(index.environment_ids(alice, self.pizdaint, "collab-a")) == {"e3"}
+        assert len(alice.calls) == 4
+
+        # environments saved through the API are added without reloading
+        index.add("alice", "collab-a", env("e6", "pizdaint"))
+        assert asyncio.run(index.environment_ids(alice, self.pizdaint, "collab-a")) == {"e3", "e6"}
+        assert len(alice.calls) == 4
+
+        # but "myspace" is different for each user
+        bob = self.FakeKG("bob", {"myspace": [env("e7", "jureca")]})
+        assert asyncio.run(index.environment_ids(bob, self.jureca, "myspace")) == {"e7"}
+        assert index.metrics()["environments"] == 7
+
+    def test_kg_queried_if_load_fails(self):
+        env = self.environment
+        index = EnvironmentIndex(ttl=60)
+        alice = self.FakeKG("alice", {"collab-a": [env("e1", "jureca"), env("e2", "pizdaint")]})
+        alice.unavailable = True
+        # a space which could not be loaded is not treated as having no environments
+        assert asyncio.run(index.environment_ids(alice, self.jureca, "collab-a")) == {"e1"}
+        assert index.metrics()["load_errors"] == 1
+        assert index.metrics()["fallbacks"] == 1
+
+    def test_kg_queried_if_reload_fails(self):
+        env = self.environment
+        index = EnvironmentIndex(ttl=60)
+        alice = self.FakeKG("alice", {"collab-a": [env("e1", "jureca")]})
+        assert asyncio.run(index.environment_ids(alice, self.jureca, "collab-a")) == {"e1"}
+        # an environment created by another process, after the index entry has expired
+        alice.environments["collab-a"].append(env("e2", "jureca"))
+        index._entries[(None, "collab-a", "any")].loaded_at -= 61
+        alice.unavailable = True
+        assert asyncio.run(index.environment_ids(alice, self.jureca, "collab-a")) == {"e1", "e2"}
+        assert index.metrics()["fallbacks"] == 1
@@ -0,0 +1,381 @@
+
+import sys
+from types import SimpleNamespace
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from fastapi import Response
+from pydantic import BaseModel
+
+sys.path.append(".")
+from provenance.common import kg_client as kg_client_module
+from provenance.common.kg_client import KGIdentityMap, AsyncKGClient, KGClientPool, FairScheduler, KGOverloaded
+from provenance.common import utils as common_utils
+from provenance import settings
+import fairgraph.openminds.core as omcore
+import fairgraph.openminds.computation as omcmp
+from fairgraph.base import KGProxy
+
+
+ID_PREFIX = "https://kg.ebrains.eu/api/instances"
+
+
+class TestKGIdentityMap:
+
+    def test_instance_retrieved_once(self, mock_kg_client):
+        mock_client = mock_kg_client
+        calls = []
+        original = mock_client.instance_from_full_uri
+        def counting_instance_from_full_uri(uri, **kwargs):
+            calls.append(uri)
+            return original(uri, **kwargs)
+        mock_client.instance_from_full_uri = counting_instance_from_full_uri
+        kg_client = KGIdentityMap(mock_client)
+        uri = f"{ID_PREFIX}/3fa85f64-5717-4562-b3fc-2c963f66afa6"
+        for i in range(3):
+            data = kg_client.instance_from_full_uri(uri, scope="any")
+            data["vocab:fullName"] = "modified by caller"
+        assert calls == [uri]
+        assert kg_client.cache_hits == 2
+        assert kg_client.instance_from_full_uri(uri, scope="any")["vocab:fullName"] == "fake model for testing"
+        # misses are not remembered
+        missing_uri = f"{ID_PREFIX}/00000000-0000-0000-0000-000000000000"
+        assert kg_client.instance_from_full_uri(missing_uri, scope="any") is None
+        assert kg_client.instance_from_full_uri(missing_uri, scope="any") is None
+        assert calls.count(missing_uri) == 2
+        # other methods are delegated to the wrapped client
+        assert kg_client.uuid_from_uri(uri) == "3fa85f64-5717-4562-b3fc-2c963f66afa6"
+
+    def test_prefetch(self, mock_kg_client):
+        class BulkInstances:
+            def __init__(self):
+                self.payloads = []
+
+            def get_by_ids(self, payload, stage, extended_response_configuration):
+                self.payloads.append(sorted(payload))
+                data = {}
+                for uuid in payload:
+                    instance = mock_kg_client.instance_from_full_uri(mock_kg_client.uri_from_uuid(uuid))
+                    if instance:
+                        instance["http://schema.org/identifier"] = [uuid]
+                        data[uuid] = SimpleNamespace(data=instance)
+                return SimpleNamespace(error=None, data=data)
+
+        kg_client = KGIdentityMap(mock_kg_client)
+        kg_client._kg_instances = bulk_instances = BulkInstances()
+        uri = f"{ID_PREFIX}/3fa85f64-5717-4562-b3fc-2c963f66afa6"
+        simulations = [
+            omcmp.Simulation(inputs=[KGProxy(omcore.ModelVersion, uri)])
+            for i in range(3)
+        ]
+        kg_client.prefetch(simulations)
+        # one call per level and per stage, the second level being the format, license
+        # and accessibility of the model version
+        assert kg_client.kg_calls == {"bulk": 4}
+        assert [len(payload) for payload in bulk_instances.payloads] == [1, 1, 3, 3]
+        model_version = simulations[0].inputs[0].resolve(kg_client, scope="any", use_cache=False)
+        assert model_version.version_identifier == "1.0"
+        assert kg_client.kg_calls == {"bulk": 4}
+
+    def test_prefetch_without_bulk_requests(self, mock_kg_client):
+        # MockKGClient doesn't support bulk requests, so instances are retrieved one at a time
+        kg_client = KGIdentityMap(mock_kg_client)
+        uri = f"{ID_PREFIX}/3fa85f64-5717-4562-b3fc-2c963f66afa6"
+        simulations = [
+            omcmp.Simulation(inputs=[KGProxy(omcore.ModelVersion, uri)])
+            for i in range(3)
+        ]
+        kg_client.prefetch(simulations)
+        assert kg_client.kg_calls["instance"] == 4
+        model_version = simulations[0].inputs[0].resolve(kg_client, scope="any", use_cache=False)
+        assert model_version.version_identifier == "1.0"
+        assert kg_client.kg_calls["instance"] == 4
+
+    def test_bulk_request_errors_not_hidden(self, mock_kg_client):
+        class FailingInstances:
+            def get_by_ids(self, payload, stage, extended_response_configuration):
+                return SimpleNamespace(error=SimpleNamespace(code=500), data=None)
+
+        kg_client = KGIdentityMap(mock_kg_client)
+        kg_client._kg_instances = FailingInstances()
+        uri = f"{ID_PREFIX}/3fa85f64-5717-4562-b3fc-2c963f66afa6"
+        with pytest.raises(Exception, match="_get_by_ids"):
+            kg_client.prefetch([omcmp.Simulation(inputs=[KGProxy(omcore.ModelVersion, uri)])])
+        assert kg_client.kg_calls == {"bulk": 1}
+
+    def test_shared_instances(self, mock_kg_client, monkeypatch):
+        uri = f"{ID_PREFIX}/098cd755-65bc-4e77-b3eb-7a940fff829a"
+        data = {
+            "@id": uri,
+            "@type": omcore.ContentType.type,
+            "https://openminds.ebrains.eu/vocab/name": "application/json"
+        }
+        monkeypatch.setattr(kg_client_module, "_shared_instance_sources", [{uri: data}])
+        kg_client = KGIdentityMap(mock_kg_client)
+        content_type = omcore.ContentType(name="application/json", id=uri)
+        assert content_type.exists(kg_client)
+        assert kg_client.total_kg_calls == 0
+
+
+    def test_shared_between_threads(self):
+        client = SimpleNamespace(
+            instance_from_full_uri=lambda uri, use_cache, scope, resolved: {"@id": uri},
+            uri_from_uuid=lambda uuid: f"{ID_PREFIX}/{uuid}"
+        )
+        kg_client = KGIdentityMap(client)
+        errors = []
+
+        def retrieve(thread_index):
+            try:
+                for i in range(500):
+                    uri = f"{ID_PREFIX}/{thread_index}-{i}"
+                    kg_client.instance_from_full_uri(uri)
+                    kg_client.instance_from_full_uri(uri)
+                    if i % 10 == 0:
+                        kg_client.forget(uri)
+                        kg_client.stats()
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=retrieve, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert kg_client.kg_calls["instance"] == 8 * 500
+        assert kg_client.cache_hits == 8 * 500
+
+
+class TestAsyncKGClient:
+
+    def test_concurrent_calls(self, mock_kg_client):
+        # each call waits until four calls are in progress, so this only completes
+        # if the calls are made in parallel, in worker threads
+        in_progress = threading.Barrier(4, timeout=5)
+
+        class SlowRecord:
+            @classmethod
+            def from_uuid(cls, uuid, client, scope):
+                in_progress.wait()
+                return uuid
+
+        kg = AsyncKGClient(KGIdentityMap(mock_kg_client))
+
+        async def main():
+            return await asyncio.gather(*[kg.from_uuid(SlowRecord, str(i)) for i in range(20)])
+
+        assert asyncio.run(main()) == [str(i) for i in range(20)]
+
+    def test_large_pages_are_split(self, mock_kg_client):
+        calls = []
+        # the sub-pages after the first wait for each other, so must be retrieved at the same time
+        in_progress = threading.Barrier(2, timeout=5)
+
+        class Record:
+            records = list(range(250))
+
+            @classmethod
+            def list(cls, client, from_index, size, space=None):
+                calls.append((from_index, size))
+                if from_index in (110, 210):
+                    in_progress.wait()
+                return cls.records[from_index:from_index + size]
+
+            @classmethod
+            def from_kg_object(cls, obj, client):
+                return -obj
+
+        kg = AsyncKGClient(KGIdentityMap(mock_kg_client), max_page_size=100, page_parallelism=2)
+        assert asyncio.run(kg.list(Record, size=230, from_index=10, space="collab-a")) == list(range(10, 240))
+        assert sorted(calls) == [(10, 100), (110, 100), (210, 30)]
+        # if the first sub-page is not full, there is nothing more to retrieve
+        calls.clear()
+        assert asyncio.run(kg.list(Record, size=1000, from_index=200)) == list(range(200, 250))
+        assert len(calls) == 1
+        # long lists are converted in sub-pages, and reassembled in order
+        assert asyncio.run(kg.convert_all(Record, Record.records)) == [-i for i in range(250)]
+
+
+    def test_slot_held_until_cancelled_call_finishes(self, mock_kg_client):
+        scheduler = FairScheduler(max_concurrent=1, max_queued=10, max_queued_per_user=10,
+                                  timeout=5, retry_after=5)
+        kg = AsyncKGClient(KGIdentityMap(mock_kg_client), scheduler=scheduler)
+        started = threading.Event()
+        finish = threading.Event()
+
+        def blocking_call():
+            started.set()
+            finish.wait(timeout=5)
+
+        async def main():
+            task = asyncio.ensure_future(kg.run(blocking_call))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # the KG call is still in progress in the worker thread
+            assert scheduler.active == 1
+            finish.set()
+            await kg.run(lambda: None)
+            assert scheduler.active == 0
+
+        asyncio.run(main())
+
+
+class TestFairScheduler:
+
+    def test_users_served_in_turn(self):
+        scheduler = FairScheduler(max_concurrent=1, max_queued=10, max_queued_per_user=3,
+                                  timeout=5, retry_after=5)
+        order = []
+
+        async def call(user, i):
+            await scheduler.acquire(user)
+            order.append((user, i))
+            await asyncio.sleep(0.01)
+            scheduler.release()
+
+        async def main():
+            # alice makes a burst of requests before bob makes one
+            tasks = [asyncio.ensure_future(call("alice", i)) for i in range(4)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.ensure_future(call("bob", 0)))
+            await asyncio.sleep(0)
+            # alice already has 3 requests waiting
+            with pytest.raises(KGOverloaded):
+                await scheduler.acquire("alice")
+            await asyncio.gather(*tasks)
+
+        asyncio.run(main())
+        assert order == [("alice", 0), ("alice", 1), ("bob", 0), ("alice", 2), ("alice", 3)]
+        metrics = scheduler.metrics()
+        assert (metrics["active"], metrics["queued"], metrics["rejected"]) == (0, 0, 1)
+
+    def test_timeout(self):
+        scheduler = FairScheduler(max_concurrent=1, max_queued=10, max_queued_per_user=10,
+                                  timeout=0.05, retry_after=5)
+
+        async def main():
+            await scheduler.acquire("alice")
+            with pytest.raises(KGOverloaded):
+                await scheduler.acquire("bob")
+            scheduler.release()
+
+        asyncio.run(main())
+        assert scheduler.metrics()["timeouts"] == 1
+        assert scheduler.active == 0
+
+
+class TestKGClientPool:
+
+    def test_clients_reused(self, fake_token):
+        created = []
+
+        def factory(token):
+            created.append(token)
+            return SimpleNamespace(token=token)
+
+        pool = KGClientPool(factory, max_clients=2, ttl=600)
+        alice, bob, carol = (fake_token(time.time() + 300 + i) for i in range(3))
+        assert pool.get(alice) is pool.get(alice)
+        pool.get(bob)
+        pool.get(carol)  # alice's client is evicted
+        pool.get(alice)
+        assert created == [alice, bob, carol, alice]
+        assert pool.metrics()["hits"] == 1
+        assert pool.metrics()["evictions"] == 2
+
+    def test_expired_token_not_pooled(self, fake_token):
+        pool = KGClientPool(lambda token: SimpleNamespace(token=token), max_clients=2, ttl=600)
+        token = fake_token(time.time() - 10)
+        assert pool.get(token) is not pool.get(token)
+        assert pool.metrics()["clients"] == 0
+
+
+class TestStreaming:
+
+    class Record(BaseModel):
+        id: int
+
+        @classmethod
+        def from_kg_object(cls, obj, client):
+            cls.converted.append(obj)
+            return cls(id=obj)
+
+    def test_records_converted_as_they_are_sent(self, mock_kg_client):
+        self.Record.converted = []
+        kg = AsyncKGClient(KGIdentityMap(mock_kg_client))
+        request = SimpleNamespace(headers={"accept": "application/x-ndjson"})
+        response = Response()
+        response.headers["Link"] = '<https://example.org/?cursor=abc>; rel="next"'
+
+        async def main():
+            streamed = await common_utils.list_response(request, kg, self.Record, list(range(95)), response=response)
+            lines = []
+            async for line in streamed.body_iterator:
+                if not lines:
+                    # no more than two batches have been converted when the first record is sent
+                    assert len(self.Record.converted) <= 2 * settings.STREAM_BATCH_SIZE
+                lines.append(line)
+            return streamed, lines
+
+        streamed, lines = asyncio.run(main())
+        assert streamed.media_type == "application/x-ndjson"
+        assert streamed.headers["link"] == response.headers["link"]
+        assert [json.loads(line) for line in lines] == [{"id": i} for i in range(95)]
+        assert all(line.endswith("\n") for line in lines)
+
+    def test_instances_released_after_each_batch(self, mock_kg_client):
+        uri = "kg:3fa85f64-5717-4562-b3fc-2c963f66afa6"
+        identity_map = KGIdentityMap(mock_kg_client)
+        kg = AsyncKGClient(identity_map)
+        batch_clients = []
+
+        class Record(BaseModel):
+            id: int
+
+            @classmethod
+            def from_kg_object(cls, obj, client):
+                client.instance_from_full_uri(uri)
+                batch_clients.append(client)
+                return cls(id=obj)
+
+        async def main():
+            return [record async for record in kg.iter_convert(Record, list(range(25)), batch_size=10)]
+
+        assert [record.id for record in asyncio.run(main())] == list(range(25))
+        # each batch has its own identity map, so the request's map doesn't grow with the page size
+        assert len(set(map(id, batch_clients))) == 3
+        assert identity_map not in batch_clients
+        assert identity_map._instances == {}
+        assert identity_map.kg_calls["instance"] == 3
+        assert identity_map.cache_hits == 22
+
+    def test_json_by_default(self, mock_kg_client):
+        self.Record.converted = []
+        kg = AsyncKGClient(KGIdentityMap(mock_kg_client))
+        request = SimpleNamespace(headers={"accept": "application/json"})
+        results = asyncio.run(common_utils.list_response(request, kg, self.Record, [1, 2]))
+        assert results == [self.Record(id=1), self.Record(id=2)]
+
+    def test_streamed_requests_not_coalesced(self):
+        calls = []
+
+        @common_utils.coalesce_requests
+        async def list_records(request, token):
+            calls.append(request.headers["accept"])
+            await asyncio.sleep(0.01)
+            return []
+
+        token = SimpleNamespace(credentials="alice")
+        request = SimpleNamespace(headers={"accept": "application/x-ndjson"})
+
+        async def main():
+            await asyncio.gather(*(list_records(request=request, token=token) for i in range(3)))
+
+        asyncio.run(main())
+        assert len(calls) == 3
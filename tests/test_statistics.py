@@ -0,0 +1,87 @@
+
+import sys
+from types import SimpleNamespace
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.append(".")
+from provenance.common.kg_client import AsyncKGClient
+from provenance.common.data_models import ComputationType
+from provenance.statistics import resources as statistics_resources
+import fairgraph.openminds.computation as omcmp
+
+
+class TestSpaceStatistics:
+
+    def test_counts_cached_per_space(self, mock_kg_client, monkeypatch):
+        counted = []
+
+        def spaces(permissions, names_only):
+            return ["collab-a", "collab-b", "computation", "other"]
+
+        def fake_count(name):
+            def count(cls, client, scope, space):
+                counted.append((name, space))
+                return len(space)
+            return classmethod(count)
+
+        monkeypatch.setattr(omcmp.WorkflowExecution, "count", fake_count("workflow"))
+        monkeypatch.setattr(omcmp.Simulation, "count", fake_count("simulation"))
+        monkeypatch.setattr(mock_kg_client, "spaces", spaces, raising=False)
+        monkeypatch.setattr(statistics_resources, "get_async_kg_client_for_user_account",
+                            lambda token: AsyncKGClient(mock_kg_client, user=token))
+        statistics_resources._counts.clear()
+
+        results = asyncio.run(statistics_resources.query_spaces(
+            types=[ComputationType.simulation], token=SimpleNamespace(credentials="alice")))
+        assert [(r.space, r.count, r.counts) for r in results] == [
+            ("myspace", 7, {"simulation": 7}),
+            ("collab-a", 8, {"simulation": 8}),
+            ("collab-b", 8, {"simulation": 8}),
+            ("computation", 11, {"simulation": 11}),
+        ]
+        assert len(counted) == 8
+        # counts are reused for the same user
+        asyncio.run(statistics_resources.query_spaces(
+            types=[ComputationType.simulation], token=SimpleNamespace(credentials="alice")))
+        assert len(counted) == 8
+        # but not for other users, who may have different permissions
+        results = asyncio.run(statistics_resources.query_spaces(
+            types=None, token=SimpleNamespace(credentials="bob")))
+        assert results[0].counts is None
+        assert sorted(counted[8:]) == [("workflow", "collab-a"), ("workflow", "collab-b"),
+                                       ("workflow", "computation"), ("workflow", "myspace")]
+
+    def test_errors_in_one_space(self, mock_kg_client, monkeypatch, caplog):
+        def count(cls, client, scope, space):
+            if space == "collab-a":
+                raise ConnectionError("KG unavailable")
+            return len(space)
+
+        monkeypatch.setattr(omcmp.WorkflowExecution, "count", classmethod(count), raising=False)
+        monkeypatch.setattr(mock_kg_client, "spaces", lambda permissions, names_only: ["collab-a", "collab-b"],
+                            raising=False)
+        monkeypatch.setattr(statistics_resources, "get_async_kg_client_for_user_account",
+                            lambda token: AsyncKGClient(mock_kg_client, user=token))
+        statistics_resources._counts.clear()
+        results = asyncio.run(statistics_resources.query_spaces(types=None, token=SimpleNamespace(credentials="alice")))
+        assert [(r.space, r.count) for r in results] == [("myspace", 7), ("collab-a", 0), ("collab-b", 8)]
+        assert "Unable to count WorkflowExecution records in space collab-a" in caplog.text
+        # the failed count is not cached
+        assert len(statistics_resources._counts) == 2
+
+
+class TestServiceMetrics:
+
+    def test_metrics_only_for_administrators(self, monkeypatch):
+        async def is_global_admin(token):
+            return token == "admin-token"
+
+        monkeypatch.setattr(statistics_resources, "is_global_admin", is_global_admin)
+        with pytest.raises(HTTPException) as exc_info:
+            asyncio.run(statistics_resources.query_metrics(SimpleNamespace(credentials="user-token")))
+        assert exc_info.value.status_code == 403
+        assert "vocabularies" in asyncio.run(
+            statistics_resources.query_metrics(SimpleNamespace(credentials="admin-token")))
@@ -0,0 +1,114 @@
+
+import sys
+import threading
+import time
+
+import pytest
+from pydantic import BaseModel, ValidationError
+
+sys.path.append(".")
+from provenance.vocab import snapshot
+from provenance.vocab.snapshot import save_snapshot, load_snapshot
+from provenance.vocab.registry import VocabularyRegistry, ControlledTerm
+from provenance import settings
+import fairgraph.openminds.controlledterms as omterms
+
+
+ID_PREFIX = "https://kg.ebrains.eu/api/instances"
+
+
+class TestVocabularySnapshot:
+
+    def test_round_trip(self, tmp_path, monkeypatch):
+        data = {
+            "@id": f"{ID_PREFIX}/b2c2f7ba-e5a4-4d4c-a1c6-2a1e9b1c8f0e",
+            "@type": omterms.ActionStatusType.type,
+            "https://openminds.ebrains.eu/vocab/name": "completed"
+        }
+        obj = omterms.ActionStatusType.from_kg_instance(data, None, scope="released")
+        path = str(tmp_path / "snapshot.json")
+        save_snapshot({"action_status_types": [obj]}, path)
+        loaded = load_snapshot(path)
+        assert loaded["action_status_types"][0].name == "completed"
+        assert loaded["action_status_types"][0].id == obj.id
+        # a snapshot from a different KG instance should not be used
+        monkeypatch.setattr(settings, "KG_CORE_API_HOST", "core.kg.example.org")
+        assert load_snapshot(path) is None
+
+    def test_missing_snapshot(self, tmp_path):
+        assert load_snapshot(str(tmp_path / "snapshot.json")) is None
+
+    def test_refresh_written_to_writable_path(self, tmp_path, monkeypatch):
+        data = {
+            "@id": f"{ID_PREFIX}/b2c2f7ba-e5a4-4d4c-a1c6-2a1e9b1c8f0e",
+            "@type": omterms.ActionStatusType.type,
+            "https://openminds.ebrains.eu/vocab/name": "completed"
+        }
+        obj = omterms.ActionStatusType.from_kg_instance(data, None, scope="released")
+        original_path = str(tmp_path / "snapshot.json")
+        refresh_path = str(tmp_path / "refreshed.json")
+        save_snapshot({"action_status_types": []}, original_path)
+        monkeypatch.setattr(settings, "VOCAB_SNAPSHOT_PATH", original_path)
+        monkeypatch.setattr(settings, "VOCAB_SNAPSHOT_REFRESH", True)
+        monkeypatch.setattr(settings, "VOCAB_SNAPSHOT_REFRESH_PATH", refresh_path)
+        monkeypatch.setattr(snapshot, "VOCABULARIES", {"action_status_types": snapshot.VOCABULARIES["action_status_types"]})
+        monkeypatch.setattr(snapshot, "fetch_vocabularies", lambda names=None: {"action_status_types": [obj]})
+        assert snapshot.refresh_snapshot()
+        assert load_snapshot(original_path)["action_status_types"] == []
+        assert snapshot.load_vocabularies()["action_status_types"][0].name == "completed"
+        # unchanged vocabularies are not written again
+        assert not snapshot.refresh_snapshot()
+
+    def test_concurrent_fetch(self, mock_kg_client, monkeypatch):
+        calls = []
+        # the three "slow" vocabularies can only be retrieved if they are retrieved in parallel
+        in_progress = threading.Barrier(3, timeout=5)
+
+        def slow(client):
+            in_progress.wait()
+            return ["slow"]
+
+        def flaky(client):
+            calls.append(client)
+            if len(calls) == 1:
+                raise ConnectionError("temporary failure")
+            return ["ok"]
+
+        monkeypatch.setattr(snapshot, "VOCABULARIES", {
+            "a": (None, "released", slow),
+            "b": (None, "any", {"x": slow, "y": slow}),
+            "c": (None, "released", flaky),
+        })
+        vocabularies = snapshot.fetch_vocabularies(mock_kg_client, timeout=10, retries=1)
+        assert vocabularies == {"a": ["slow"], "b": {"x": ["slow"], "y": ["slow"]}, "c": ["ok"]}
+        assert snapshot.last_fetch_timings["c"]["requests"] == 2
+
+    def test_fetch_timeout(self, mock_kg_client, monkeypatch):
+        monkeypatch.setattr(snapshot, "VOCABULARIES", {
+            "a": (None, "released", lambda client: time.sleep(1))
+        })
+        with pytest.raises(snapshot.VocabularyFetchError):
+            snapshot.fetch_vocabularies(mock_kg_client, timeout=0.1, retries=1)
+
+
+class TestVocabularyRegistry:
+
+    def test_refresh_updates_views_and_terms(self):
+        registry = VocabularyRegistry(lambda vocabularies: {"terms": {name: name.upper() for name in vocabularies}})
+        registry.load(["a", "b"])
+        view = registry.view("terms")
+
+        class Term(ControlledTerm):
+            _vocabulary = (registry, "terms")
+
+        class Model(BaseModel):
+            term: Term
+
+        assert view[Model(term="a").term] == "A"
+        with pytest.raises(ValidationError):
+            Model(term="c")
+        registry.load(["a", "b", "c"])
+        assert view[Model(term="c").term] == "C"
+        assert Model.schema()["properties"]["term"]["enum"] == ["a", "b", "c"]
+        assert len(view) == 3
+        assert registry.metrics()["sizes"] == {"terms": 3}